@@ -51,6 +51,7 @@
 #include <HTTPClient.h>
 #include <WebServer.h>
 #include <esp_task_wdt.h>
+#include "mbedtls/md.h"
 
 // TFT Display (ILI9341 via TFT_eSPI)
 #include <TFT_eSPI.h>
@@ -153,6 +154,22 @@ String currentSessionUrl   = "";
 String currentExpiresAt    = "";
 String claimedByName       = "";
 
+// Pre-issued successor: swapped in locally at expiry (no round trip)
+bool          hasNextSession  = false;
+String        nextSessionToken = "";
+String        nextSessionUrl   = "";
+unsigned long nextSwapAt       = 0;   // millis()
+
+// Rotating QR (server SESSION_ROTATION_MODE=totp): codes derived locally
+bool          rotationEnabled    = false;
+uint8_t       rotationSecret[32];
+unsigned long rotationWindowSec  = 60;
+uint8_t       rotationTokenLen   = 6;
+String        rotationUrlPrefix  = "";
+unsigned long rotationSyncUnix   = 0;   // server unix time at sync
+unsigned long rotationSyncMillis = 0;   // millis() at sync (wrap-safe delta)
+long          lastRotationWindow = -1;
+
 // Motor
 bool motorRunning = false;
 unsigned long motorStartTime    = 0;
@@ -160,6 +177,7 @@ unsigned long motorRunDuration  = 0;
 unsigned long dispenseQuantity  = 0;
 String currentTransactionId     = "";
 unsigned long jamStartTime      = 0;
+bool pipelinedDispense          = false;  // Motor runs behind the next customer's QR
 
 // Timing constants
 const unsigned long BASE_RUN_TIME         = 4000;
@@ -600,6 +618,96 @@ void motorRunForward(unsigned long durationMs) {
   Serial.printf("[Motor] Running for %lu ms\n", durationMs);
 }
 
+// ══════════════════════════════════════════════
+//  PRE-ISSUED NEXT SESSION
+// ══════════════════════════════════════════════
+
+void applyNextSession(JsonVariant next) {
+  const char *token = next["token"];
+  const char *url   = next["url"];
+  if (!token || !url) {
+    hasNextSession = false;
+    return;
+  }
+  nextSessionToken = String(token);
+  nextSessionUrl   = String(url);
+  nextSwapAt       = millis() + next["in_ms"].as<unsigned long>();
+  hasNextSession   = true;
+}
+
+// Show the successor QR at the current one's expiry (IDLE only)
+void tickNextSession() {
+  if (!hasNextSession || state != STATE_IDLE) return;
+  if ((long)(millis() - nextSwapAt) < 0) return;
+  hasNextSession      = false;
+  currentSessionToken = nextSessionToken;
+  currentSessionUrl   = nextSessionUrl;
+  displayQRCode(currentSessionUrl.c_str());
+  Serial.printf("[Session] Swapped to pre-issued: %s\n", currentSessionToken.c_str());
+}
+
+// ══════════════════════════════════════════════
+//  ROTATING QR TOKENS (mirrors backend/session_tokens.py)
+// ══════════════════════════════════════════════
+
+unsigned long rotationUnixNow() {
+  return rotationSyncUnix + (millis() - rotationSyncMillis) / 1000UL;
+}
+
+String deriveRotatingToken(long window) {
+  static const char BASE62[] =
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789";
+  char msg[48];
+  snprintf(msg, sizeof(msg), "%s:%ld", machine_id, window);
+
+  uint8_t digest[32];
+  mbedtls_md_context_t ctx;
+  mbedtls_md_init(&ctx);
+  mbedtls_md_setup(&ctx, mbedtls_md_info_from_type(MBEDTLS_MD_SHA256), 1);
+  mbedtls_md_hmac_starts(&ctx, rotationSecret, sizeof(rotationSecret));
+  mbedtls_md_hmac_update(&ctx, (const uint8_t *)msg, strlen(msg));
+  mbedtls_md_hmac_finish(&ctx, digest);
+  mbedtls_md_free(&ctx);
+
+  String token = "";
+  for (uint8_t i = 0; i < rotationTokenLen && i < sizeof(digest); i++)
+    token += BASE62[digest[i] % 62];
+  return token;
+}
+
+void applyRotation(JsonObject rot) {
+  const char *secretHex = rot["secret"];
+  const char *prefix    = rot["url_prefix"];
+  if (!secretHex || !prefix || strlen(secretHex) != 64) {
+    rotationEnabled = false;
+    return;
+  }
+  for (int i = 0; i < 32; i++) {
+    char byteHex[3] = { secretHex[2 * i], secretHex[2 * i + 1], 0 };
+    rotationSecret[i] = (uint8_t)strtoul(byteHex, NULL, 16);
+  }
+  rotationWindowSec  = rot["window"] | 60;
+  rotationTokenLen   = rot["length"] | 6;
+  rotationUrlPrefix  = String(prefix);
+  rotationSyncUnix   = rot["server_time"].as<unsigned long>();
+  rotationSyncMillis = millis();
+  lastRotationWindow = rotationUnixNow() / rotationWindowSec;
+  rotationEnabled    = true;
+  Serial.printf("[Rotation] Local QR rotation every %lus\n", rotationWindowSec);
+}
+
+// Redraw the QR when the time window rolls over (IDLE only, no server traffic)
+void tickRotation() {
+  if (!rotationEnabled || state != STATE_IDLE) return;
+  long window = rotationUnixNow() / rotationWindowSec;
+  if (window == lastRotationWindow) return;
+  lastRotationWindow  = window;
+  currentSessionToken = deriveRotatingToken(window);
+  currentSessionUrl   = rotationUrlPrefix + currentSessionToken;
+  displayQRCode(currentSessionUrl.c_str());
+  Serial.printf("[Rotation] %s\n", currentSessionToken.c_str());
+}
+
 // ══════════════════════════════════════════════
 //  WEBSOCKET MESSAGING
 // ══════════════════════════════════════════════
@@ -616,8 +724,11 @@ void sendRegister() {
 }
 
 void sendPong() {
-  StaticJsonDocument<64> doc;
+  StaticJsonDocument<128> doc;
   doc["type"] = "pong";
+  // Piggyback vitals so telemetry doesn't need a separate HTTPS request
+  JsonObject telemetry = doc.createNestedObject("telemetry");
+  telemetry["rssi"] = WiFi.RSSI();
   String message;
   serializeJson(doc, message);
   webSocket.sendTXT(message);
@@ -683,7 +794,7 @@ void webSocketEvent(WStype_t type, uint8_t *payload, size_t length) {
 
     case WStype_TEXT: {
       Serial.printf("[WS] Received: %s\n", payload);
-      StaticJsonDocument<512> doc;
+      StaticJsonDocument<768> doc;
       DeserializationError error = deserializeJson(doc, payload);
       if (error) {
         Serial.printf("[WS] JSON parse error: %s\n", error.c_str());
@@ -701,6 +812,11 @@ void webSocketEvent(WStype_t type, uint8_t *payload, size_t length) {
           currentSessionUrl   = String(url);
           if (doc.containsKey("expires_at"))
             currentExpiresAt = doc["expires_at"].as<String>();
+          if (doc.containsKey("rotation"))
+            applyRotation(doc["rotation"].as<JsonObject>());
+          else
+            rotationEnabled = false;  // Server is issuing a row per rotation
+          applyNextSession(doc["next"]);
           state = STATE_IDLE;
           stateEnteredAt = millis();
           claimedByName = "";
@@ -714,6 +830,7 @@ void webSocketEvent(WStype_t type, uint8_t *payload, size_t length) {
           ? doc["claimed_by_name"].as<const char*>()
           : "User";
         claimedByName = String(name);
+        hasNextSession = false;  // Stale by the time the machine is idle again
         state = STATE_IN_USE;
         stateEnteredAt = millis();
         displayInUse(name);
@@ -724,21 +841,24 @@ void webSocketEvent(WStype_t type, uint8_t *payload, size_t length) {
         const char *token = doc["token"];
         const char *url   = doc["url"];
         if (token && url) {
+          // Already showing it (swapped to the pre-issued successor): skip the redraw
+          bool alreadyShown = state == STATE_IDLE && currentSessionToken == token;
           currentSessionToken = String(token);
           currentSessionUrl   = String(url);
           if (doc.containsKey("expires_at"))
             currentExpiresAt = doc["expires_at"].as<String>();
+          applyNextSession(doc["next"]);
           state = STATE_IDLE;
           stateEnteredAt = millis();
           claimedByName = "";
-          displayQRCode(url);
+          if (!alreadyShown) displayQRCode(url);
           Serial.printf("[Session] Renewed: %s\n", token);
         }
       }
 
       else if (strcmp(msgType, "command") == 0) {
         const char *action = doc["action"];
-        if (action && strcmp(action, "dispense") == 0 &&
+        if (action && strcmp(action, "dispense") == 0 && !motorRunning &&
             (state == STATE_IN_USE || state == STATE_IDLE)) {
           currentTransactionId = doc["transaction_id"].as<String>();
           dispenseQuantity     = doc["duration"].as<unsigned long>();
@@ -750,9 +870,13 @@ void webSocketEvent(WStype_t type, uint8_t *payload, size_t length) {
           else
             duration = BASE_RUN_TIME;
 
-          state = STATE_DISPENSING;
-          stateEnteredAt = millis();
-          displayDispensing(dispenseQuantity);
+          // Pipelined: the screen stays on the next customer's QR / claim
+          pipelinedDispense = doc["pipelined"] | false;
+          if (!pipelinedDispense) {
+            state = STATE_DISPENSING;
+            stateEnteredAt = millis();
+            displayDispensing(dispenseQuantity);
+          }
           motorRunForward(duration);
           Serial.printf("[Dispense] qty=%lu, duration=%lums, tx=%s\n",
                         dispenseQuantity, duration, currentTransactionId.c_str());
@@ -1009,16 +1133,19 @@ void pollHttpCommands() {
         }
         else if (strcmp(type, "command") == 0) {
           const char *action = cmd["action"] | "";
-          if (strcmp(action, "dispense") == 0 &&
+          if (strcmp(action, "dispense") == 0 && !motorRunning &&
               (state == STATE_IN_USE || state == STATE_IDLE)) {
             currentTransactionId = cmd["transaction_id"].as<String>();
             dispenseQuantity = cmd["duration"] | 1;
             unsigned long duration = cmd.containsKey("duration_sec")
               ? cmd["duration_sec"].as<unsigned long>() * 1000UL
               : dispenseQuantity * BASE_RUN_TIME;
-            state = STATE_DISPENSING;
-            stateEnteredAt = millis();
-            displayDispensing(dispenseQuantity);
+            pipelinedDispense = cmd["pipelined"] | false;
+            if (!pipelinedDispense) {
+              state = STATE_DISPENSING;
+              stateEnteredAt = millis();
+              displayDispensing(dispenseQuantity);
+            }
             motorRunForward(duration);
           }
         }
@@ -1132,6 +1259,10 @@ void loop() {
     lastHeartbeat = now;
   }
 
+  // ── Rotating QR (totp mode) / pre-issued successor swap ──
+  tickRotation();
+  tickNextSession();
+
   // ── HTTP fallback polling (when WS is down) ──
   if (!webSocket.isConnected() && now - lastCommandPoll > COMMAND_POLL_INTERVAL) {
     pollHttpCommands();
@@ -1182,10 +1313,14 @@ void loop() {
       motorStop();
       motorRunning = false;
       sendConfirmation(dispenseQuantity);
-      state = STATE_COMPLETED;
-      stateEnteredAt = now;
-      completedFlashStart = now;
-      displayCompleted();
+      if (pipelinedDispense) {
+        pipelinedDispense = false;  // Screen already belongs to the next customer
+      } else {
+        state = STATE_COMPLETED;
+        stateEnteredAt = now;
+        completedFlashStart = now;
+        displayCompleted();
+      }
     }
   }
 
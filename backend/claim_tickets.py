@@ -0,0 +1,119 @@
+"""
+SmartVend v3.0 — Claim Tickets
+==============================
+Signed proof of a claim, kept by the browser (CLAIM_TICKETS_ENABLED).
+
+After a claim the browser only held its client_id, so every create-order,
+cancel and status call re-read the session row to compare `claimed_by`.
+The claim reply now also carries a ticket:
+
+    payload = {"s": session_id, "m": machine_id, "t": session_token,
+               "o": owner, "e": claim expiry (unix seconds)}
+    owner   = first 8 bytes of SHA-256(client_id), hex
+    ticket  = "v1." + base64url(payload) + "." + base64url(mac)
+    mac     = HMAC-SHA256(SESSION_TOKEN_SECRET, "sv-ticket:" + payload)[:16]
+
+A ticket that verifies for the presented token and client_id proves
+ownership until the claim window ends. create-order and cancel then skip the
+session lookup. Session state can still change, so state-dependent writes
+stay conditional on it: cancel only expires an in_progress row, and
+trigger-dispense checks the session as before. An absent, stale or forged
+ticket falls back to the database check.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import clock
+from config import CLAIM_TICKETS_ENABLED, SESSION_TOKEN_SECRET
+
+_VERSION = "v1"
+_MAC_BYTES = 16
+
+
+def enabled() -> bool:
+    return CLAIM_TICKETS_ENABLED and bool(SESSION_TOKEN_SECRET)
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _unb64(value: str) -> bytes:
+    return base64.urlsafe_b64decode((value + "=" * (-len(value) % 4)).encode("ascii"))
+
+
+def _mac(payload: bytes) -> bytes:
+    return hmac.new(
+        SESSION_TOKEN_SECRET.encode("utf-8"), b"sv-ticket:" + payload, hashlib.sha256
+    ).digest()[:_MAC_BYTES]
+
+
+def _owner(client_id: str) -> str:
+    return hashlib.sha256(client_id.encode("utf-8")).hexdigest()[:16]
+
+
+def issue(session: Dict, client_id: str) -> Optional[str]:
+    """Ticket for a claimed (in_progress) session row, or None if disabled."""
+    if not enabled() or not session.get("id") or not session.get("expires_at"):
+        return None
+    expires_at = datetime.fromisoformat(str(session["expires_at"]).replace("Z", "+00:00"))
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    payload = json.dumps({
+        "s": session["id"],
+        "m": session.get("machine_id"),
+        "t": session.get("session_token"),
+        "o": _owner(client_id),
+        "e": int(expires_at.timestamp()),
+    }, separators=(",", ":")).encode("utf-8")
+    return f"{_VERSION}.{_b64(payload)}.{_b64(_mac(payload))}"
+
+
+def verify(
+    ticket: Optional[str], session_token: str, client_id: str, now: Optional[float] = None
+) -> Optional[Dict]:
+    """{ session_id, machine_id, expires_at } if `ticket` proves client_id
+    holds session_token's claim right now, else None."""
+    if not enabled() or not ticket or not session_token or not client_id:
+        return None
+    try:
+        version, payload_b64, mac_b64 = ticket.split(".")
+        payload = _unb64(payload_b64)
+        mac = _unb64(mac_b64)
+    except ValueError:
+        return None
+    if version != _VERSION or not hmac.compare_digest(_mac(payload), mac):
+        return None
+    try:
+        claims = json.loads(payload)
+    except ValueError:
+        return None
+    now = clock.time() if now is None else now
+    if (
+        claims.get("t") != session_token
+        or not hmac.compare_digest(str(claims.get("o")), _owner(client_id))
+        or now >= claims.get("e", 0)
+    ):
+        return None
+    return {
+        "session_id": claims["s"],
+        "machine_id": claims.get("m"),
+        "expires_at": datetime.fromtimestamp(claims["e"], tz=timezone.utc).isoformat(),
+    }
+
+
+def as_session(claims: Dict, session_token: str, client_id: str) -> Dict:
+    """The session row as of the claim, for callers that take a prefetched `session`."""
+    return {
+        "id": claims["session_id"],
+        "machine_id": claims["machine_id"],
+        "session_token": session_token,
+        "status": "in_progress",
+        "claimed_by": client_id,
+        "expires_at": claims["expires_at"],
+    }
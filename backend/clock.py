@@ -0,0 +1,134 @@
+"""
+SmartVend v3.0 — Clock
+======================
+Injectable time source for session, lock and sweeper code.
+
+`session_db._now()`, `database._now()`, the expiry scheduler, the reconcile
+sweep, the TTL policy and rotating tokens all read time through this module
+instead of the wall clock. Production uses `SystemClock`. Tests and
+`simulation.py` install a `VirtualClock`, whose time only moves on
+`advance()`, so days of session lifecycle run in seconds and deterministically.
+
+Presence timestamps stay on the wall clock: they are shared across worker
+processes through shared memory.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time as _time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+
+class SystemClock:
+    """Wall-clock time and real sleeps."""
+
+    def time(self) -> float:
+        return _time.time()
+
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]) -> bool:
+        """Wait for `event` up to `timeout` seconds. Returns True if it was set."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class VirtualClock:
+    """Time that moves only on advance(); sleepers wake in deadline order."""
+
+    def __init__(self, start: Optional[float] = None):
+        self._now = _time.time() if start is None else start
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    def time(self) -> float:
+        return self._now
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self._now, tz=timezone.utc)
+
+    async def sleep(self, seconds: float):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + seconds, next(self._seq), fut))
+        await fut
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]) -> bool:
+        if event.is_set():
+            return True
+        if timeout is None:
+            await event.wait()
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        done, pending = await asyncio.wait({waiter, sleeper}, return_when=asyncio.FIRST_COMPLETED)
+        for t in pending:
+            t.cancel()
+        return waiter in done
+
+    def next_wakeup(self) -> Optional[float]:
+        """Earliest pending sleeper deadline (cancelled sleepers included)."""
+        return self._sleepers[0][0] if self._sleepers else None
+
+    async def advance(self, seconds: float):
+        """Move time forward, waking each sleeper at its own deadline.
+
+        After each wakeup the event loop gets a few turns so woken tasks can
+        run (and schedule new sleeps) before time moves on.
+        """
+        target = self._now + max(0.0, seconds)
+        await _settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            due, _, fut = heapq.heappop(self._sleepers)
+            self._now = max(self._now, due)
+            if not fut.done():
+                fut.set_result(None)
+                await _settle()
+        self._now = target
+        await _settle()
+
+
+async def _settle(rounds: int = 10):
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+
+# ──────────────────────────────────────────────
+#  Module-level clock (one per process)
+# ──────────────────────────────────────────────
+
+clock = SystemClock()
+
+
+def use(new_clock) -> object:
+    """Install `new_clock`; returns the previous one (for restoring)."""
+    global clock
+    previous, clock = clock, new_clock
+    return previous
+
+
+def time() -> float:
+    return clock.time()
+
+
+def now() -> datetime:
+    return clock.now()
+
+
+async def sleep(seconds: float):
+    await clock.sleep(seconds)
+
+
+async def wait(event: asyncio.Event, timeout: Optional[float]) -> bool:
+    return await clock.wait(event, timeout)
@@ -15,6 +15,8 @@ RAZORPAY_KEY_ID= os.getenv('RAZORPAY_KEY_ID')
 RAZORPAY_SECRET_KEY= os.getenv('RAZORPAY_SECRET_KEY')
 # FIX: architecture_review.md — "Payment Reconciliation"
 RAZORPAY_WEBHOOK_SECRET = os.getenv('RAZORPAY_WEBHOOK_SECRET')
+# API base URL override, e.g. http://localhost:9010 for fake_razorpay.py in load tests
+RAZORPAY_BASE_URL = os.getenv('RAZORPAY_BASE_URL')
 ADMIN_PASSWORD=os.getenv('ADMIN_PASSWORD')
 # SMTP Configuration for Email Alerts
 SMTP_SERVER = os.getenv('SMTP_SERVER')
@@ -30,10 +32,67 @@ DISPLAY_CODE_TTL_MINUTES = os.getenv('DISPLAY_CODE_TTL_MINUTES')
 SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL_SECONDS', '60'))     # QR rotation interval
 CLAIM_TTL_SECONDS = int(os.getenv('CLAIM_TTL_SECONDS', '300'))       # 5 min payment window
 MOTOR_TIMEOUT_SECONDS = int(os.getenv('MOTOR_TIMEOUT_SECONDS', '120'))  # 2 min motor max
+# Adaptive per-machine QR rotation (ttl_policy.py), bounded around SESSION_TTL_SECONDS
+SESSION_TTL_ADAPTIVE = os.getenv('SESSION_TTL_ADAPTIVE', 'true').lower() == 'true'
+SESSION_TTL_MIN_SECONDS = int(os.getenv('SESSION_TTL_MIN_SECONDS', '30'))
+SESSION_TTL_MAX_SECONDS = int(os.getenv('SESSION_TTL_MAX_SECONDS', '300'))
+# Use the transactional procedures from migrations/002_session_procedures.sql
+# (falls back to step-by-step queries automatically if they aren't installed)
+SESSION_PROCEDURES_ENABLED = os.getenv('SESSION_PROCEDURES_ENABLED', 'true').lower() == 'true'
+# Session expiry fires from an in-process timer; the database sweep is only a backstop
+SESSION_RECONCILE_SECONDS = int(os.getenv('SESSION_RECONCILE_SECONDS', '60'))
+# Workers split that sweep by consistent hashing over Redis-held leases
+SWEEPER_LEASE_SECONDS = int(os.getenv('SWEEPER_LEASE_SECONDS', '15'))
+# QR rotation: "db" (a session row per rotation) or "totp" (tokens derived
+# on-device from a per-machine secret; rows are written only on claim)
+SESSION_ROTATION_MODE = os.getenv('SESSION_ROTATION_MODE', 'db').lower()
+SESSION_TOKEN_SECRET = os.getenv('SESSION_TOKEN_SECRET')
+# QR token format: "short" (4-char random) or "signed" (13-char, carries the
+# machine slot, issue minute and a MAC; bogus scans are rejected without a
+# database hit). "signed" needs SESSION_TOKEN_SECRET.
+SESSION_TOKEN_FORMAT = os.getenv('SESSION_TOKEN_FORMAT', 'short').lower()
+# Claim replies carry a signed ticket (session, machine, owner, expiry) so
+# create-order and cancel can check ownership without reading the session.
+# Needs SESSION_TOKEN_SECRET.
+CLAIM_TICKETS_ENABLED = os.getenv('CLAIM_TICKETS_ENABLED', 'true').lower() == 'true'
+# Pipelined sessions (apply migrations/004_pipelined_sessions.sql): the next
+# customer can scan and pay while the motor is still dispensing; paid sales
+# queue per machine and the motor takes them in payment order
+SESSION_PIPELINE_ENABLED = os.getenv('SESSION_PIPELINE_ENABLED', 'false').lower() == 'true'
 
 # Pricing (paise)
 PRICE_PER_UNIT_PAISA = int(os.getenv('PRICE_PER_UNIT_PAISA', '100'))  # default ₹1.00
+# Speculative orders (apply migrations/007_speculative_orders.sql): create the
+# Razorpay order for the likeliest quantity in the background right after a
+# claim, so /create-order for that quantity answers without calling Razorpay
+SPECULATIVE_ORDERS_ENABLED = os.getenv('SPECULATIVE_ORDERS_ENABLED', 'false').lower() == 'true'
+SPECULATIVE_ORDER_QUANTITY = int(os.getenv('SPECULATIVE_ORDER_QUANTITY', '1'))
+
+# Razorpay webhook queue (apply migrations/008_webhook_events.sql): events are
+# persisted and acknowledged at once, then reconciled by a worker pool
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_RECOVERY_SECONDS = int(os.getenv('WEBHOOK_RECOVERY_SECONDS', '30'))
+
+# Orphaned-order reconciliation (apply migrations/009_payment_reconciliation.sql);
+# orders younger than the grace period are left to the normal flow
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '200'))
+RECONCILE_GRACE_SECONDS = int(os.getenv('RECONCILE_GRACE_SECONDS', '900'))
+RECONCILE_GATEWAY_CONCURRENCY = int(os.getenv('RECONCILE_GATEWAY_CONCURRENCY', '8'))
+
+# Idempotency-Key on claim / create-order / trigger-dispense: first response
+# is replayed to retries for this long (shared through Redis when configured)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '600'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '10'))
 
 FRONTEND_URL = os.getenv('FRONTEND_URL')
+# /s/{token} serves a pre-rendered landing page (state inlined, claim in the
+# same request) instead of a bare redirect to the SPA
+SHORT_LINK_LANDING_ENABLED = os.getenv('SHORT_LINK_LANDING_ENABLED', 'true').lower() == 'true'
 # Optional Redis URL for cross-worker WebSocket coordination (e.g. redis://localhost:6379)
 REDIS_URL = os.getenv('REDIS_URL')
+
+# Shared-memory presence table (cross-worker "is this machine online" without I/O)
+PRESENCE_SHM_NAME = os.getenv('PRESENCE_SHM_NAME', 'smartvend_presence')
+PRESENCE_MAX_MACHINES = int(os.getenv('PRESENCE_MAX_MACHINES', '4096'))
+PRESENCE_STALE_SECONDS = int(os.getenv('PRESENCE_STALE_SECONDS', '90'))  # > WS receive timeout (75s)
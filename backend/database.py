@@ -1,4 +1,5 @@
 from config import SUPABASE_KEY, SUPABASE_URL, DISPLAY_CODE_TTL_MINUTES
+import clock
 from supabase import create_client, Client
 import asyncio
 import secrets
@@ -56,7 +57,7 @@ def _res_error(res):
 
 
 def _now():
-    return datetime.now(timezone.utc)
+    return clock.now()
 
 
 def _hash_code(code: str) -> str:
@@ -210,6 +211,7 @@ async def get_public_status(machine_id: str, client_id: Optional[str] = None):
             locked_by = lock.get("locked_by")
     out = {
         "machine_id": m.get("machine_id"),
+        "location": m.get("location"),
         "status": m.get("status"),
         "current_stock": m.get("current_stock"),
         "display_code_expires_at": m.get("display_code_expires_at"),
@@ -0,0 +1,160 @@
+"""
+SmartVend v3.0 — Session Expiry Scheduler
+=========================================
+Fires session expiry at `expires_at` instead of waiting for the next sweep.
+
+The sweeper used to poll the sessions table every 5 seconds, so QR codes
+rotated up to 5s late and the table was scanned even when nothing was due.
+`session_db` now feeds this scheduler whenever it writes a session deadline
+(create, claim, dispense: the motor timeout) and removes it when the session
+leaves ACTIVE/IN_PROGRESS/DISPENSING (cancel, expiry, completion). A single task sleeps until the earliest deadline
+in a heap keyed by expires_at, then hands each due session to the callback
+registered by main.py.
+
+Deadlines live only in this worker's memory. The database sweep remains as a
+slow reconciliation backstop for sessions scheduled on another worker or
+before a restart.
+"""
+
+import asyncio
+import heapq
+import itertools
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import clock
+import metrics
+
+# Statuses whose expires_at is acted on: expiry (session_db.expire_stale_sessions)
+# and the dispensing watchdog (session_db.fail_stale_dispenses)
+_EXPIRING_STATUSES = ("active", "in_progress", "dispensing")
+
+OnFire = Callable[[str, str, str], Awaitable[None]]
+
+
+def _parse_ts(value: str) -> float:
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+class ExpiryScheduler:
+    """Min-heap of session deadlines with lazy deletion."""
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        # session_id → (due, machine_id, status); heap entries not matching are stale
+        self._entries: Dict[str, Tuple[float, str, str]] = {}
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._firing: Set[asyncio.Task] = set()
+        self._on_fire: Optional[OnFire] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, on_fire: OnFire):
+        """Start firing `on_fire(session_id, machine_id, status)` at each deadline."""
+        self._on_fire = on_fire
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._firing] if t and not t.done()]
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except BaseException:
+                pass
+        self._task = None
+        self._heap.clear()
+        self._entries.clear()
+
+    # ── Feeding ──
+
+    def schedule(self, session: Optional[Dict]):
+        """(Re)schedule a session row; anything not ACTIVE/IN_PROGRESS/DISPENSING is unscheduled."""
+        if not self.running or not session or not session.get("id"):
+            return
+        session_id = str(session["id"])
+        status = session.get("status")
+        expires_at = session.get("expires_at")
+        if status not in _EXPIRING_STATUSES or not expires_at:
+            self.cancel(session_id)
+            return
+
+        due = _parse_ts(expires_at)
+        self._entries[session_id] = (due, session.get("machine_id"), status)
+        heapq.heappush(self._heap, (due, next(self._seq), session_id))
+        if self._heap[0][2] == session_id:
+            self._wake.set()  # New earliest deadline
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+
+    def cancel(self, session_id: Optional[str]):
+        if session_id is not None:
+            self._entries.pop(str(session_id), None)
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def _compact(self):
+        self._heap = [
+            item for item in self._heap
+            if self._entries.get(item[2], (None,))[0] == item[0]
+        ]
+        heapq.heapify(self._heap)
+
+    # ── Firing ──
+
+    async def _run(self):
+        while True:
+            now = clock.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, session_id = heapq.heappop(self._heap)
+                entry = self._entries.get(session_id)
+                if entry is None or entry[0] != due:
+                    continue  # Cancelled or rescheduled
+                del self._entries[session_id]
+                _, machine_id, status = entry
+                metrics.incr("expiry_fired")
+                metrics.observe("expiry_fire_lag_seconds", now - due)
+                task = asyncio.create_task(self._fire(session_id, machine_id, status))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+
+            timeout = (self._heap[0][0] - now) if self._heap else None
+            self._wake.clear()
+            await clock.wait(self._wake, timeout)
+
+    async def _fire(self, session_id: str, machine_id: str, status: str):
+        try:
+            await self._on_fire(session_id, machine_id, status)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.incr("expiry_fire_errors")
+            print(f"Expiry fire error for {machine_id} ({session_id}): {e}")
+
+
+# ──────────────────────────────────────────────
+#  Module-level scheduler (one per worker process)
+# ──────────────────────────────────────────────
+
+scheduler = ExpiryScheduler()
+
+
+def schedule(session: Optional[Dict]):
+    try:
+        scheduler.schedule(session)
+    except Exception as e:
+        print(f"Expiry schedule error: {e}")
+
+
+def cancel(session_id: Optional[str]):
+    scheduler.cancel(session_id)
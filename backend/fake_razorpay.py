@@ -0,0 +1,299 @@
+"""
+SmartVend v3.0 — Fake Razorpay
+==============================
+Local stand-in for the Razorpay API, for end-to-end purchase load tests.
+
+Point the backend at it with RAZORPAY_BASE_URL and use the same test key
+pair and webhook secret on both sides. The official SDK then creates orders
+here, `verify_payment_signature` accepts the signatures this server issues,
+and `/api/razorpay-webhook` accepts its webhooks:
+
+    python fake_razorpay.py --port 9010 --key-id rzp_test_load --key-secret s3cret \\
+        --webhook-secret wh_s3cret --webhook-url http://localhost:8000/api/razorpay-webhook
+
+Implemented (HTTP Basic auth with the key pair):
+
+    POST /v1/orders                      create an order
+    GET  /v1/orders/{id}                 fetch an order
+    GET  /v1/orders/{id}/payments        payments of an order (reconciliation.py)
+
+Checkout stand-in (no auth; what the Razorpay popup does for a customer):
+
+    POST /test/orders/{id}/pay           capture a payment; returns the
+                                         razorpay_order_id / _payment_id /
+                                         _signature the handler receives
+    GET  /test/stats                     counters
+
+A captured payment fires a signed `payment.captured` webhook after
+--webhook-delay seconds. --webhook-drop-rate and --webhook-duplicate-rate
+lose or redeliver some of them. --payment-fail-rate declines payments.
+--api-error-rate answers API calls with 503, and --latency delays them.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import random
+import secrets
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+Sender = Callable[[str, bytes, Dict[str, str]], Awaitable[int]]
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_{secrets.token_hex(7)}"
+
+
+def payment_signature(key_secret: str, order_id: str, payment_id: str) -> str:
+    """What Checkout hands the browser; verify_payment_signature recomputes it."""
+    return hmac.new(
+        key_secret.encode("utf-8"), f"{order_id}|{payment_id}".encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def webhook_signature(webhook_secret: str, body: bytes) -> str:
+    return hmac.new(webhook_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class FakeRazorpay:
+    """Orders, payments and webhook delivery, in memory."""
+
+    def __init__(
+        self,
+        key_id: str,
+        key_secret: str,
+        webhook_secret: Optional[str] = None,
+        webhook_url: Optional[str] = None,
+        webhook_delay: float = 0.0,
+        webhook_drop_rate: float = 0.0,
+        webhook_duplicate_rate: float = 0.0,
+        payment_fail_rate: float = 0.0,
+        api_error_rate: float = 0.0,
+        latency: float = 0.0,
+        seed: Optional[int] = None,
+        send: Optional[Sender] = None,
+    ):
+        self.key_id = key_id
+        self.key_secret = key_secret
+        self.webhook_secret = webhook_secret
+        self.webhook_url = webhook_url
+        self.webhook_delay = webhook_delay
+        self.webhook_drop_rate = webhook_drop_rate
+        self.webhook_duplicate_rate = webhook_duplicate_rate
+        self.payment_fail_rate = payment_fail_rate
+        self.api_error_rate = api_error_rate
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.send = send or self._post
+        self._http: Optional[httpx.AsyncClient] = None
+        self.orders: Dict[str, Dict] = {}
+        self.payments: Dict[str, List[Dict]] = {}
+        self.stats: Counter = Counter()
+        self._deliveries: Set[asyncio.Task] = set()
+
+    def authorized(self, header: Optional[str]) -> bool:
+        expected = base64.b64encode(f"{self.key_id}:{self.key_secret}".encode("utf-8")).decode("ascii")
+        return bool(header) and hmac.compare_digest(header, f"Basic {expected}")
+
+    # ── API ──
+
+    def create_order(self, amount: int, currency: str = "INR", receipt: Optional[str] = None) -> Dict:
+        order = {
+            "id": _id("order"),
+            "entity": "order",
+            "amount": amount,
+            "amount_paid": 0,
+            "amount_due": amount,
+            "currency": currency,
+            "receipt": receipt,
+            "status": "created",
+            "attempts": 0,
+            "created_at": int(time.time()),
+        }
+        self.orders[order["id"]] = order
+        self.stats["orders_created"] += 1
+        return order
+
+    def pay(self, order_id: str, outcome: Optional[str] = None) -> Dict:
+        """Customer completes Checkout for `order_id`."""
+        order = self.orders[order_id]
+        order["attempts"] += 1
+        if outcome is None:
+            outcome = "failed" if self.rng.random() < self.payment_fail_rate else "captured"
+        payment = {
+            "id": _id("pay"),
+            "entity": "payment",
+            "order_id": order_id,
+            "amount": order["amount"],
+            "currency": order["currency"],
+            "status": outcome,
+            "captured": outcome == "captured",
+            "method": "upi",
+            "created_at": int(time.time()),
+        }
+        self.payments.setdefault(order_id, []).append(payment)
+        self.stats[f"payments_{outcome}"] += 1
+        if outcome != "captured":
+            return {"error": {"code": "BAD_REQUEST_ERROR", "reason": "payment_failed"}, "payment": payment}
+
+        order.update(status="paid", amount_paid=order["amount"], amount_due=0)
+        self._schedule_webhook(payment)
+        return {
+            "razorpay_order_id": order_id,
+            "razorpay_payment_id": payment["id"],
+            "razorpay_signature": payment_signature(self.key_secret, order_id, payment["id"]),
+        }
+
+    # ── Webhooks ──
+
+    async def _post(self, url: str, body: bytes, headers: Dict[str, str]) -> int:
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=10)
+        res = await self._http.post(url, content=body, headers=headers)
+        return res.status_code
+
+    def webhook_body(self, payment: Dict) -> bytes:
+        event = {
+            "entity": "event",
+            "account_id": "acc_fake",
+            "event": "payment.captured",
+            "contains": ["payment"],
+            "payload": {"payment": {"entity": payment}},
+            "created_at": int(time.time()),
+        }
+        return json.dumps(event, separators=(",", ":")).encode("utf-8")
+
+    def _schedule_webhook(self, payment: Dict):
+        if not self.webhook_url or not self.webhook_secret:
+            return
+        if self.rng.random() < self.webhook_drop_rate:
+            self.stats["webhooks_dropped"] += 1
+            return
+        copies = 2 if self.rng.random() < self.webhook_duplicate_rate else 1
+        task = asyncio.create_task(self._deliver(payment, _id("evt"), copies))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, payment: Dict, event_id: str, copies: int):
+        body = self.webhook_body(payment)
+        headers = {
+            "Content-Type": "application/json",
+            "X-Razorpay-Signature": webhook_signature(self.webhook_secret, body),
+            "X-Razorpay-Event-Id": event_id,
+        }
+        await asyncio.sleep(self.webhook_delay)
+        for _ in range(copies):
+            try:
+                status = await self.send(self.webhook_url, body, headers)
+                self.stats[f"webhooks_{'delivered' if status < 300 else 'rejected'}"] += 1
+            except Exception as e:
+                self.stats["webhooks_failed"] += 1
+                print(f"Webhook delivery failed: {e}")
+
+    async def drain(self):
+        """Wait for scheduled webhooks (tests)."""
+        while self._deliveries:
+            await asyncio.gather(*list(self._deliveries), return_exceptions=True)
+
+
+def create_app(gateway: FakeRazorpay) -> FastAPI:
+    app = FastAPI(title="Fake Razorpay")
+
+    async def _api_gate(request: Request) -> Optional[JSONResponse]:
+        if gateway.latency:
+            await asyncio.sleep(gateway.latency)
+        if not gateway.authorized(request.headers.get("authorization")):
+            return JSONResponse({"error": {"code": "BAD_REQUEST_ERROR",
+                                           "description": "Authentication failed"}}, status_code=401)
+        if gateway.rng.random() < gateway.api_error_rate:
+            gateway.stats["api_errors"] += 1
+            return JSONResponse({"error": {"code": "SERVER_ERROR",
+                                           "description": "temporarily unavailable"}}, status_code=503)
+        return None
+
+    def _missing(order_id: str) -> JSONResponse:
+        return JSONResponse({"error": {"code": "BAD_REQUEST_ERROR",
+                                       "description": f"The id provided does not exist: {order_id}"}},
+                            status_code=400)
+
+    @app.post("/v1/orders")
+    async def create_order(request: Request):
+        denied = await _api_gate(request)
+        if denied:
+            return denied
+        data = await request.json()
+        return gateway.create_order(int(data["amount"]), data.get("currency", "INR"), data.get("receipt"))
+
+    @app.get("/v1/orders/{order_id}")
+    async def fetch_order(order_id: str, request: Request):
+        denied = await _api_gate(request)
+        if denied:
+            return denied
+        order = gateway.orders.get(order_id)
+        return order if order else _missing(order_id)
+
+    @app.get("/v1/orders/{order_id}/payments")
+    async def order_payments(order_id: str, request: Request):
+        denied = await _api_gate(request)
+        if denied:
+            return denied
+        if order_id not in gateway.orders:
+            return _missing(order_id)
+        items = gateway.payments.get(order_id, [])
+        return {"entity": "collection", "count": len(items), "items": items}
+
+    @app.post("/test/orders/{order_id}/pay")
+    async def pay(order_id: str, request: Request):
+        if order_id not in gateway.orders:
+            return _missing(order_id)
+        data = await request.json() if await request.body() else {}
+        result = gateway.pay(order_id, data.get("outcome"))
+        return JSONResponse(result, status_code=400 if "error" in result else 200)
+
+    @app.get("/test/stats")
+    async def stats():
+        return {"orders": len(gateway.orders), **gateway.stats}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local Razorpay stand-in for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9010)
+    parser.add_argument("--key-id", required=True)
+    parser.add_argument("--key-secret", required=True)
+    parser.add_argument("--webhook-secret")
+    parser.add_argument("--webhook-url")
+    parser.add_argument("--webhook-delay", type=float, default=1.0)
+    parser.add_argument("--webhook-drop-rate", type=float, default=0.0)
+    parser.add_argument("--webhook-duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--payment-fail-rate", type=float, default=0.0)
+    parser.add_argument("--api-error-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    uvicorn.run(create_app(FakeRazorpay(
+        key_id=args.key_id,
+        key_secret=args.key_secret,
+        webhook_secret=args.webhook_secret,
+        webhook_url=args.webhook_url,
+        webhook_delay=args.webhook_delay,
+        webhook_drop_rate=args.webhook_drop_rate,
+        webhook_duplicate_rate=args.webhook_duplicate_rate,
+        payment_fail_rate=args.payment_fail_rate,
+        api_error_rate=args.api_error_rate,
+        latency=args.latency,
+        seed=args.seed,
+    )), host=args.host, port=args.port, log_level="warning")
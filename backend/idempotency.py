@@ -0,0 +1,190 @@
+"""
+SmartVend v3.0 — Idempotency Keys
+=================================
+Replays the first response to retried POSTs that carry an `Idempotency-Key`
+header (claim, create-order, trigger-dispense).
+
+Phones on a weak signal resend these requests. Each retry used to run the
+whole chain again (session lookup, Razorpay order or signature check,
+procedure call) only to end in `already_claimed` / `already_processed`. Now
+the first response (status, headers, body bytes) is stored under
+path + key for IDEMPOTENCY_TTL_SECONDS and sent back unchanged to every
+retry, marked `Idempotent-Replayed: true`.
+
+    record    = {"fingerprint", "status", "headers", "body" (base64)}
+    Redis     = idem:{path}:{key} (SETEX), idem-lock:{path}:{key} (SET NX)
+    no Redis  = this worker's memory (bounded, oldest evicted first)
+
+A duplicate that arrives while the first request is still running waits for
+its result instead of running too: on a future on the same worker, or by
+polling the stored record behind the Redis lock across workers. Reusing a key
+with a different body is rejected with 422. 5xx responses are not stored, so
+a retry after a server error runs again.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from starlette.responses import JSONResponse, Response
+
+import clock
+import metrics
+from config import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_WAIT_SECONDS
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+_LOCAL_CAPACITY = 4096
+_POLL_SECONDS = 0.05
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def _to_record(fp: str, status: int, headers, body: bytes) -> Dict:
+    return {
+        "fingerprint": fp,
+        "status": status,
+        "headers": [[k.decode("latin-1"), v.decode("latin-1")] for k, v in headers],
+        "body": base64.b64encode(body).decode("ascii"),
+    }
+
+
+def _to_response(record: Dict, replayed: bool = True) -> Response:
+    response = Response(content=base64.b64decode(record["body"]), status_code=record["status"])
+    response.raw_headers = [
+        (k.encode("latin-1"), v.encode("latin-1")) for k, v in record["headers"]
+    ]
+    if replayed:
+        response.raw_headers.append((b"idempotent-replayed", b"true"))
+    return response
+
+
+class IdempotencyStore:
+    """Stored responses by key, shared through Redis when attached."""
+
+    def __init__(self, ttl_seconds: int = 600, wait_seconds: float = 10):
+        self.ttl_seconds = ttl_seconds
+        self.wait_seconds = wait_seconds
+        self._redis = None
+        # key → (expires at, record)
+        self._local: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        # key → result of the request running on this worker (None: not stored)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def attach(self, redis_client):
+        self._redis = redis_client
+
+    # ── Storage ──
+
+    async def _get(self, key: str) -> Optional[Dict]:
+        entry = self._local.get(key)
+        if entry:
+            if entry[0] > clock.time():
+                return entry[1]
+            self._local.pop(key, None)
+        if self._redis:
+            try:
+                raw = await self._redis.get(f"idem:{key}")
+                if raw:
+                    return json.loads(raw)
+            except Exception as e:
+                print(f"Idempotency read failed: {e}")
+        return None
+
+    async def _put(self, key: str, record: Dict):
+        self._local[key] = (clock.time() + self.ttl_seconds, record)
+        self._local.move_to_end(key)
+        while len(self._local) > _LOCAL_CAPACITY:
+            self._local.popitem(last=False)
+        if self._redis:
+            try:
+                await self._redis.set(f"idem:{key}", json.dumps(record), ex=self.ttl_seconds)
+            except Exception as e:
+                print(f"Idempotency write failed: {e}")
+
+    async def _lock(self, key: str) -> bool:
+        """Cross-worker ownership of `key` (always True without Redis)."""
+        if not self._redis:
+            return True
+        try:
+            return bool(await self._redis.set(
+                f"idem-lock:{key}", "1", nx=True, ex=max(1, int(self.wait_seconds))
+            ))
+        except Exception as e:
+            print(f"Idempotency lock failed: {e}")
+            return True
+
+    async def _unlock(self, key: str):
+        if self._redis:
+            try:
+                await self._redis.delete(f"idem-lock:{key}")
+            except Exception:
+                pass
+
+    # ── Request handling ──
+
+    async def handle(
+        self, key: str, fp: str, call: Callable[[], Awaitable[Response]]
+    ) -> Response:
+        """The stored response for `key`, or `call()`'s (stored for retries)."""
+        deadline = clock.time() + self.wait_seconds
+        while True:
+            record = await self._get(key)
+            if record:
+                return self._replay(record, fp)
+
+            pending = self._inflight.get(key)
+            if pending is not None:
+                metrics.incr("idempotency_waits")
+                record = await asyncio.shield(pending)
+                if record:
+                    return self._replay(record, fp)
+                continue  # the first attempt failed: run it ourselves
+
+            if await self._lock(key):
+                break
+            # Another worker is running it: wait for its record
+            if clock.time() >= deadline:
+                return JSONResponse(
+                    {"error": "request_in_progress", "detail": "Retry shortly."}, status_code=409
+                )
+            metrics.incr("idempotency_waits")
+            await clock.sleep(_POLL_SECONDS)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        record = None
+        try:
+            response = await call()
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            record = _to_record(fp, response.status_code, response.raw_headers, body)
+            if response.status_code < 500:
+                await self._put(key, record)
+                metrics.incr("idempotency_stored")
+            return _to_response(record, replayed=False)
+        finally:
+            self._inflight.pop(key, None)
+            future.set_result(record if record and record["status"] < 500 else None)
+            await self._unlock(key)
+
+    def _replay(self, record: Dict, fp: str) -> Response:
+        if record["fingerprint"] != fp:
+            metrics.incr("idempotency_key_mismatch")
+            return JSONResponse(
+                {"error": "idempotency_key_reused", "detail": "Key was used with a different request."},
+                status_code=422,
+            )
+        metrics.incr("idempotency_replays")
+        return _to_response(record)
+
+
+# ──────────────────────────────────────────────
+#  Module-level store (one per worker process)
+# ──────────────────────────────────────────────
+
+store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_WAIT_SECONDS)
@@ -0,0 +1,126 @@
+"""
+SmartVend v3.0 — Short-Link Landing Page
+========================================
+Server-rendered page for `/s/{token}` (SHORT_LINK_LANDING_ENABLED).
+
+A scan used to cost a lookup and 302, the SPA bootstrap, then status, claim
+and machine-status calls, one after another on a phone at the machine. The
+backend now answers the scan itself. It renders the session state, machine
+stock and unit price into the page and claims in the same request when it
+already knows the customer: the `sv_cid` / `sv_name` cookies from an earlier
+scan, or a name typed into the page's one-field form.
+
+The page forwards to the SPA at `/vend/{machine}/{token}` with the same state
+in the URL fragment (`#sv=<base64url JSON>`). The SPA starts from it instead
+of fetching, so the scan is the only round trip before the customer can pay.
+"""
+
+import base64
+import html
+import json
+from typing import Dict, Optional
+
+CLIENT_COOKIE = "sv_cid"
+NAME_COOKIE = "sv_name"
+COOKIE_MAX_AGE = 365 * 86400
+FRAGMENT_KEY = "sv"
+
+# Session states the SPA can continue from; anything else ends on this page
+_FORWARD_STATUSES = ("active", "in_progress", "queued", "dispensing", "completed", "failed")
+
+
+def encode_state(state: Dict) -> str:
+    raw = json.dumps(state, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_state(value: str) -> Dict:
+    padded = value + "=" * (-len(value) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+
+def forward_url(base_url: str, machine_id: str, token: str, state: Dict) -> str:
+    return f"{base_url}/vend/{machine_id}/{token}#{FRAGMENT_KEY}={encode_state(state)}"
+
+
+def should_forward(state: Dict) -> bool:
+    session = state.get("session") or {}
+    if session.get("status") not in _FORWARD_STATUSES or session.get("expired_by_time"):
+        return False
+    if session.get("status") == "in_progress" and not session.get("is_owner"):
+        return False
+    return True
+
+
+def needs_name(state: Dict) -> bool:
+    return (state.get("session") or {}).get("status") == "active" and not state.get("claim")
+
+
+def _page(title: str, body: str, head: str = "") -> str:
+    return (
+        "<!doctype html><html><head><meta charset='utf-8'>"
+        "<meta name='viewport' content='width=device-width,initial-scale=1'>"
+        f"<title>{html.escape(title)}</title>{head}"
+        "<style>body{font-family:system-ui,sans-serif;background:#f5f3ff;margin:0;padding:24px}"
+        ".c{background:#fff;border-radius:16px;max-width:360px;margin:auto;padding:24px;text-align:center}"
+        "h1{color:#6d28d9;font-size:22px}.m{color:#6b7280;font-size:14px}"
+        "input,button,a.b{display:block;width:100%;box-sizing:border-box;padding:12px;margin-top:12px;"
+        "border-radius:8px;font-size:16px}button,a.b{background:#7c3aed;color:#fff;border:0;text-decoration:none}"
+        "</style></head>"
+        f"<body><div class='c'>{body}</div></body></html>"
+    )
+
+
+def render_expired() -> str:
+    return _page(
+        "SmartVend",
+        "<h1>Session expired or invalid.</h1>"
+        "<p>Please scan the new QR code on the machine.</p>",
+    )
+
+
+def render(state: Dict, token: str, base_url: str) -> str:
+    """Landing page for a scanned token; `state` is the bootstrap inlined into it."""
+    session = state.get("session") or {}
+    machine = state.get("machine") or {}
+    machine_id = session.get("machine_id") or machine.get("machine_id") or ""
+    stock = machine.get("current_stock")
+    price = (state.get("unit_price_paise") or 0) / 100
+    summary = (
+        f"<h1>SmartVend</h1><p><b>{html.escape(str(machine.get('location') or machine_id))}</b></p>"
+        f"<p class='m'>Machine {html.escape(machine_id)} · "
+        f"{html.escape(str(stock if stock is not None else '?'))} available · ₹{price:g} each</p>"
+    )
+
+    if not should_forward(state):
+        if session.get("status") == "in_progress":
+            message = "This session is in use by another customer."
+        else:
+            message = "This QR code has expired. Please scan the new QR on the machine."
+        return _page("SmartVend", summary + f"<p>{html.escape(message)}</p>")
+
+    if needs_name(state):
+        return _page(
+            "SmartVend",
+            summary
+            + f"<form method='get' action='/s/{html.escape(token)}'>"
+            "<input name='name' placeholder='Your name' autofocus required maxlength='40'>"
+            "<button type='submit'>Continue</button></form>",
+        )
+
+    target = html.escape(forward_url(base_url, machine_id, token, state), quote=True)
+    inline = json.dumps(state, default=str).replace("</", "<\\/")
+    return _page(
+        "SmartVend",
+        summary + f"<a class='b' href='{target}'>Continue</a>",
+        head=(
+            f"<meta http-equiv='refresh' content='0;url={target}'>"
+            f"<script id='sv-bootstrap' type='application/json'>"
+            f"{inline}</script>"
+        ),
+    )
+
+
+def client_name(query_name: Optional[str], cookie_name: Optional[str]) -> Optional[str]:
+    name = (query_name or cookie_name or "").strip()
+    return name[:40] or None
@@ -0,0 +1,240 @@
+"""
+SmartVend v3.0 — Purchase Load Driver
+=====================================
+Pushes complete purchases through a running backend, end to end.
+
+Each simulated machine holds a device WebSocket (register, QR tokens,
+dispense commands) and runs one customer after another against it:
+
+    claim → create-order → pay at the fake gateway → trigger-dispense
+          → dispense command on the socket → device confirm → next QR
+
+Run it against a backend whose RAZORPAY_BASE_URL points at fake_razorpay.py
+(same key pair and webhook secret). Parallelism comes from the number of
+machines, since a machine serves one customer at a time.
+
+    python load_driver.py --backend http://localhost:8000 --gateway http://localhost:9010 \\
+        --machines 200 --duration 60 --admin-password ... --stock 100000
+
+--webhook-only skips trigger-dispense for that share of purchases, leaving
+the dispense to the gateway's payment.captured webhook. The report gives
+purchases per minute, latency percentiles and a count per failure reason.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+import httpx
+import websockets
+
+
+class _Machine:
+    def __init__(self, machine_id: str, api_key: str):
+        self.machine_id = machine_id
+        self.api_key = api_key
+        self.token: Optional[str] = None
+        self.used: Set[str] = set()
+        self.token_changed = asyncio.Event()
+        self.commands: asyncio.Queue = asyncio.Queue()
+
+    def set_token(self, token: Optional[str]):
+        if token and token != self.token:
+            self.token = token
+            self.token_changed.set()
+
+    async def next_token(self, timeout: float) -> Optional[str]:
+        """A QR token no customer of this run has used yet."""
+        deadline = time.monotonic() + timeout
+        while self.token is None or self.token in self.used:
+            self.token_changed.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self.token_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        self.used.add(self.token)
+        return self.token
+
+
+class LoadDriver:
+    def __init__(self, args):
+        self.args = args
+        self.backend = args.backend.rstrip("/")
+        self.gateway = args.gateway.rstrip("/")
+        self.rng = random.Random(args.seed)
+        self.stats: Counter = Counter()
+        self.latencies: List[float] = []
+        self.machines = [
+            _Machine(f"{args.machine_prefix}{i:04d}", args.api_key) for i in range(args.machines)
+        ]
+
+    # ── Device side ──
+
+    async def _device(self, machine: _Machine, stop: asyncio.Event):
+        ws_url = self.backend.replace("http", "ws", 1) + "/ws"
+        async with websockets.connect(ws_url, max_queue=None) as ws:
+            await ws.send(json.dumps({
+                "type": "register", "machine_id": machine.machine_id, "api_key": machine.api_key,
+            }))
+            while not stop.is_set():
+                try:
+                    frame = json.loads(await asyncio.wait_for(ws.recv(), 1))
+                except asyncio.TimeoutError:
+                    continue
+                kind = frame.get("type")
+                if kind in ("session", "new_session"):
+                    machine.set_token(frame.get("token"))
+                elif kind == "command" and frame.get("action") == "dispense":
+                    machine.commands.put_nowait(frame)
+                elif kind == "ping":
+                    await ws.send(json.dumps({"type": "pong"}))
+
+    # ── Customer side ──
+
+    async def _post(self, http: httpx.AsyncClient, path: str, body: Dict, **headers) -> httpx.Response:
+        return await http.post(f"{self.backend}{path}", json=body, headers=headers)
+
+    async def _purchase(self, http: httpx.AsyncClient, machine: _Machine) -> Optional[str]:
+        """One customer's purchase. Returns a failure reason, or None on success."""
+        token = await machine.next_token(self.args.timeout)
+        if not token:
+            return "no_token"
+        client_id = uuid.uuid4().hex
+        quantity = self.rng.randint(1, self.args.max_quantity)
+        started = time.monotonic()
+
+        res = await self._post(http, "/api/session/claim", {
+            "session_token": token, "client_id": client_id,
+            "machine_id": machine.machine_id, "name": "Load",
+        }, **{"Idempotency-Key": f"claim:{token}:{client_id}"})
+        if res.status_code != 200:
+            return f"claim_{res.status_code}"
+        ticket = res.json().get("ticket")
+
+        res = await self._post(http, "/create-order", {
+            "quantity": quantity, "machine_id": machine.machine_id,
+            "session_token": token, "client_id": client_id, "ticket": ticket,
+        }, **{"Idempotency-Key": f"order:{token}:{client_id}:{quantity}"})
+        if res.status_code != 200:
+            return f"create_order_{res.status_code}"
+        order_id = res.json()["id"]
+
+        res = await http.post(f"{self.gateway}/test/orders/{order_id}/pay", json={})
+        if res.status_code != 200:
+            await self._post(http, "/api/session/cancel", {
+                "session_token": token, "client_id": client_id, "ticket": ticket,
+            })
+            return "payment_declined"
+        proof = res.json()
+
+        if self.rng.random() >= self.args.webhook_only:
+            res = await self._post(http, "/api/session/trigger-dispense", {
+                "session_token": token, "client_id": client_id, "quantity": quantity, **proof,
+            }, **{"Idempotency-Key": f"dispense:{proof['razorpay_payment_id']}"})
+            # 409 duplicate: the webhook got there first
+            if res.status_code not in (200, 409):
+                return f"trigger_{res.status_code}"
+        else:
+            self.stats["webhook_dispenses"] += 1
+
+        try:
+            command = await asyncio.wait_for(machine.commands.get(), self.args.timeout)
+        except asyncio.TimeoutError:
+            return "no_dispense_command"
+        if self.args.motor_seconds:
+            await asyncio.sleep(self.args.motor_seconds * command.get("duration", 1))
+
+        res = await http.post(
+            f"{self.backend}/api/machine/{machine.machine_id}/confirm",
+            json={"transaction_id": command.get("transaction_id"), "dispensed": command.get("duration")},
+            headers={"Authorization": f"Bearer {machine.api_key}"},
+        )
+        if res.status_code != 200:
+            return f"confirm_{res.status_code}"
+        machine.set_token(res.json().get("new_session_token"))
+        self.latencies.append(time.monotonic() - started)
+        return None
+
+    async def _customers(self, http: httpx.AsyncClient, machine: _Machine, deadline: float):
+        while time.monotonic() < deadline:
+            try:
+                failure = await self._purchase(http, machine)
+            except httpx.HTTPError as e:
+                failure = f"http_{type(e).__name__}"
+            self.stats[failure or "purchases"] += 1
+
+    # ── Run ──
+
+    async def _stock_up(self, http: httpx.AsyncClient):
+        res = await http.post(f"{self.backend}/api/admin/login", json={"password": self.args.admin_password})
+        res.raise_for_status()
+        auth = {"Authorization": f"Bearer {res.json()['token']}"}
+        for machine in self.machines:
+            await http.post(
+                f"{self.backend}/api/machine/{machine.machine_id}/update-stock",
+                json={"stock": self.args.stock}, headers=auth,
+            )
+
+    async def run(self) -> Dict:
+        stop = asyncio.Event()
+        limits = httpx.Limits(max_connections=self.args.machines * 2)
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as http:
+            devices = [asyncio.create_task(self._device(m, stop)) for m in self.machines]
+            await asyncio.gather(*(m.next_token(self.args.timeout) for m in self.machines))
+            for m in self.machines:
+                m.used.clear()
+            if self.args.admin_password:
+                await self._stock_up(http)
+
+            started = time.monotonic()
+            deadline = started + self.args.duration
+            await asyncio.gather(*(self._customers(http, m, deadline) for m in self.machines))
+            elapsed = time.monotonic() - started
+
+            stop.set()
+            await asyncio.gather(*devices, return_exceptions=True)
+            try:
+                gateway_stats = (await http.get(f"{self.gateway}/test/stats")).json()
+            except httpx.HTTPError:
+                gateway_stats = None
+
+        latencies = sorted(self.latencies)
+
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+
+        return {
+            "machines": len(self.machines),
+            "seconds": round(elapsed, 1),
+            "purchases": self.stats["purchases"],
+            "purchases_per_minute": round(self.stats["purchases"] * 60 / elapsed, 1) if elapsed else None,
+            "latency_seconds": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)},
+            "outcomes": dict(self.stats),
+            "gateway": gateway_stats,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SmartVend end-to-end purchase load driver")
+    parser.add_argument("--backend", default="http://localhost:8000")
+    parser.add_argument("--gateway", default="http://localhost:9010")
+    parser.add_argument("--machines", type=int, default=50)
+    parser.add_argument("--machine-prefix", default="LOAD")
+    parser.add_argument("--api-key", default="load-test-key")
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--max-quantity", type=int, default=2)
+    parser.add_argument("--motor-seconds", type=float, default=0.0)
+    parser.add_argument("--webhook-only", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--admin-password")
+    parser.add_argument("--stock", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    print(json.dumps(asyncio.run(LoadDriver(parser.parse_args()).run()), indent=2))
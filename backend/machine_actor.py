@@ -0,0 +1,235 @@
+"""
+SmartVend v3.0 — Per-Machine Session Actor
+==========================================
+Serializes session lifecycle mutations for one machine.
+
+WS `register`, `fetch_display`, the expiry sweeper, `cancel` and `complete`
+used to read and write a machine's session row concurrently, so two of them
+could both try `create_session` and one would fail on the partial unique index.
+Every machine now gets an actor: a mailbox plus a single task that runs one
+operation at a time against `session_db`.
+
+The actor caches the machine's current session, so `fetch_display` for a live
+ACTIVE session is answered without touching the database, and identical
+requests that are already queued (e.g. two concurrent `fetch_display`) share
+one result instead of running twice.
+
+Operations must call `session_db` directly — never back into this module for
+the same machine, or the mailbox deadlocks.
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import session_db
+
+# An actor's task exits after this long with an empty mailbox; the actor
+# (and its cached session) stays registered and restarts on the next call.
+ACTOR_IDLE_SECONDS = 300
+
+_LIVE_STATUSES = ("active", "in_progress", "dispensing")
+
+
+class MachineActor:
+    """Mailbox + single task owning one machine's session mutations."""
+
+    def __init__(self, machine_id: str):
+        self.machine_id = machine_id
+        self.session: Optional[Dict] = None
+        self._mailbox: asyncio.Queue = asyncio.Queue()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def call(
+        self,
+        op: str,
+        fn: Callable[["MachineActor"], Awaitable[Any]],
+        dedupe: bool = False,
+    ) -> Any:
+        """Queue `fn(actor)` and wait for its result.
+
+        With dedupe=True, a call while another `op` of the same name is queued
+        or running returns that call's result instead of running again.
+        """
+        if dedupe and op in self._inflight:
+            return await asyncio.shield(self._inflight[op])
+
+        fut = asyncio.get_running_loop().create_future()
+        if dedupe:
+            self._inflight[op] = fut
+        self._mailbox.put_nowait((op, fn, fut))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await asyncio.shield(fut)
+
+    async def _run(self):
+        while True:
+            try:
+                op, fn, fut = await asyncio.wait_for(
+                    self._mailbox.get(), timeout=ACTOR_IDLE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                if self._mailbox.empty():
+                    return
+                continue
+            try:
+                result = await fn(self)
+                if not fut.done():
+                    fut.set_result(result)
+            except asyncio.CancelledError:
+                if not fut.done():
+                    fut.cancel()
+                raise
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                if self._inflight.get(op) is fut:
+                    del self._inflight[op]
+
+    # ── Cached session ──
+
+    def live_active_session(self) -> Optional[Dict]:
+        """The cached session if it is ACTIVE and not yet past expires_at."""
+        s = self.session
+        if not s or s.get("status") != "active":
+            return None
+        expires_at = s.get("expires_at")
+        if expires_at and session_db._now() >= _parse_ts(expires_at):
+            return None
+        return s
+
+
+def _parse_ts(value: str) -> datetime:
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+# ──────────────────────────────────────────────
+#  Registry
+# ──────────────────────────────────────────────
+
+_actors: Dict[str, MachineActor] = {}
+
+
+def get_actor(machine_id: str) -> MachineActor:
+    actor = _actors.get(machine_id)
+    if actor is None:
+        actor = _actors[machine_id] = MachineActor(machine_id)
+    return actor
+
+
+def observe(machine_id: str, session: Optional[Dict]):
+    """Record a session state change made outside the actor (claim, dispense)."""
+    actor = _actors.get(machine_id)
+    if actor is not None:
+        actor.session = session if session and session.get("status") in _LIVE_STATUSES else None
+
+
+async def shutdown():
+    """Cancel all actor tasks (app shutdown)."""
+    tasks = [a._task for a in _actors.values() if a._task and not a._task.done()]
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        try:
+            await t
+        except BaseException:
+            pass
+    _actors.clear()
+
+
+# ──────────────────────────────────────────────
+#  Lifecycle operations
+# ──────────────────────────────────────────────
+
+async def _create_or_adopt(actor: MachineActor) -> Optional[Dict]:
+    """Create a new ACTIVE session, adopting the existing one on a unique-index conflict.
+    In totp rotation mode this is the current derived token (no write)."""
+    new_session = await session_db.next_idle_session(actor.machine_id)
+    if not new_session:
+        existing = await session_db.get_active_session_for_machine(actor.machine_id)
+        if existing and existing.get("status") == "active":
+            new_session = existing
+    actor.session = new_session
+    return new_session
+
+
+async def register(machine_id: str, api_key: str) -> Dict:
+    """ESP32 (re)registered: expire whatever it had and issue a fresh session."""
+    async def _op(actor: MachineActor):
+        info = await session_db.register_machine_session(machine_id, api_key)
+        actor.session = info.get("session") if info and not info.get("error") else None
+        return info
+
+    return await get_actor(machine_id).call("register", _op, dedupe=True)
+
+
+async def ensure_session(machine_id: str) -> Optional[Dict]:
+    """Current session for the display, creating one if the machine has none."""
+    async def _op(actor: MachineActor):
+        cached = actor.live_active_session()
+        if cached:
+            return cached
+        session = await session_db.get_active_session_for_machine(machine_id)
+        if session:
+            actor.session = session
+            return session
+        return await _create_or_adopt(actor)
+
+    return await get_actor(machine_id).call("ensure_session", _op, dedupe=True)
+
+
+async def renew(machine_id: str, expired_session_id: Optional[str] = None) -> Optional[Dict]:
+    """Issue the next ACTIVE session after expiry or cancellation.
+
+    If a live ACTIVE session already exists (e.g. `fetch_display` created one
+    in the meantime), it is returned instead of attempting a conflicting insert.
+    """
+    async def _op(actor: MachineActor):
+        if actor.session and actor.session.get("id") == expired_session_id:
+            actor.session = None
+        cached = actor.live_active_session()
+        if cached:
+            return cached
+        return await _create_or_adopt(actor)
+
+    return await get_actor(machine_id).call("renew", _op, dedupe=True)
+
+
+async def cancel(
+    machine_id: str, session_token: str, client_id: str, session: Optional[Dict] = None
+) -> Tuple[Dict, Optional[Dict]]:
+    """Cancel the owner's session and issue the next one. Returns (result, new_session)."""
+    async def _op(actor: MachineActor):
+        result = await session_db.cancel_session(session_token, client_id, session=session)
+        if result.get("error"):
+            return result, None
+        actor.session = None
+        return result, await _create_or_adopt(actor)
+
+    return await get_actor(machine_id).call(f"cancel:{session_token}", _op, dedupe=True)
+
+
+async def complete(machine_id: str, transaction_id: str, dispensed: int) -> Dict:
+    """Complete the dispensing session; caches the successor session."""
+    async def _op(actor: MachineActor):
+        result = await session_db.complete_session(machine_id, transaction_id, dispensed)
+        if not result.get("error"):
+            actor.session = result.get("new_session")
+        return result
+
+    return await get_actor(machine_id).call(f"complete:{transaction_id}", _op, dedupe=True)
+
+
+async def complete_batch(machine_id: str, items: List[Dict]) -> Dict:
+    """Apply replayed confirmations in one pass; caches the successor session."""
+    async def _op(actor: MachineActor):
+        result = await session_db.confirm_batch(machine_id, items)
+        if result.get("new_session"):
+            actor.session = result["new_session"]
+        return result
+
+    key = ",".join(str(i.get("transaction_id")) for i in items)
+    return await get_actor(machine_id).call(f"complete_batch:{key}", _op, dedupe=True)
@@ -10,10 +10,13 @@ Phase 1: Backend session system (this file).
 
 import asyncio
 import contextlib
+import hashlib
 import json
 import os
 import secrets
 import smtplib
+import uuid
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
@@ -25,6 +28,7 @@ import redis.asyncio as aioredis
 import uvicorn
 from fastapi import (
     BackgroundTasks,
+    Cookie,
     Depends,
     FastAPI,
     Header,
@@ -35,12 +39,26 @@ from fastapi import (
 )
 from services.email_service import send_email_async
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse
-from pydantic import BaseModel, Field, constr
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, constr
 
 from auth import AuthHandler
+import claim_tickets
+import clock
 import database as db
+import expiry_scheduler
+import idempotency
+import landing_page
+import machine_actor
+import metrics
+import presence
+import reconciliation
 import session_db
+import session_events
+import session_tokens
+import signed_tokens
+import sweeper_partition
+import webhook_queue
 from config import (
     ADMIN_PASSWORD,
     CLAIM_TTL_SECONDS,
@@ -48,6 +66,7 @@ from config import (
     FRONTEND_URL,
     MOTOR_TIMEOUT_SECONDS,
     PRICE_PER_UNIT_PAISA,
+    RAZORPAY_BASE_URL,
     RAZORPAY_KEY_ID,
     RAZORPAY_SECRET_KEY,
     RAZORPAY_WEBHOOK_SECRET,
@@ -55,9 +74,17 @@ from config import (
     REDIS_URL,
     SENDER_EMAIL,
     SENDER_PASSWORD,
+    SESSION_PIPELINE_ENABLED,
+    SESSION_RECONCILE_SECONDS,
     SESSION_TTL_SECONDS,
+    SHORT_LINK_LANDING_ENABLED,
+    SPECULATIVE_ORDERS_ENABLED,
+    SPECULATIVE_ORDER_QUANTITY,
     SMTP_PORT,
     SMTP_SERVER,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_RECOVERY_SECONDS,
+    WEBHOOK_WORKERS,
 )
 from services import machine_service, payment_service
 
@@ -77,8 +104,23 @@ connected_machines: dict = {}
 redis_client = None
 redis_listener_task = None
 session_sweeper_task = None
+sweeper_membership_task = None
 REDIS_CHANNEL = "ws:commands"
 
+# Fire-and-forget tasks, referenced until done so they aren't collected
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# IDs of messages this worker already wrote to a local socket (bounded, FIFO)
+_local_deliveries: "OrderedDict[str, None]" = OrderedDict()
+_LOCAL_DELIVERY_MEMORY = 1024
+
 
 def _is_transient_razorpay_error(err: Exception) -> bool:
     """Best-effort classifier for temporary network failures to Razorpay."""
@@ -101,7 +143,7 @@ def _is_transient_razorpay_error(err: Exception) -> bool:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Start/stop resources in a Render-friendly way."""
-    global redis_client, redis_listener_task, session_sweeper_task
+    global redis_client, redis_listener_task, session_sweeper_task, sweeper_membership_task
     try:
         await db.init_pool()
         if db.pool:
@@ -109,35 +151,64 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print("❌ DB pool init error:", e)
 
+    if presence.init_presence():
+        print(f"✅ Presence table attached ({presence.table.capacity} slots)")
+
     try:
         if REDIS_URL:
             redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+            session_events.attach(redis_client)
+            idempotency.store.attach(redis_client)
             redis_listener_task = asyncio.create_task(
                 _redis_pubsub_listener(redis_client)
             )
             print("✅ Redis pubsub listener started")
+            sweeper_membership_task = asyncio.create_task(
+                sweeper_partition.run_membership(redis_client)
+            )
     except Exception as e:
         print("⚠️ Redis init error:", e)
 
     try:
+        expiry_scheduler.scheduler.start(_on_session_due)
         session_sweeper_task = asyncio.create_task(_session_expiry_sweeper())
-        print("✅ Session expiry sweeper started")
+        print("✅ Session expiry scheduler started")
     except Exception as e:
         print("❌ Session sweeper start error:", e)
 
+    try:
+        webhook_queue.queue.start(
+            _process_webhook_event,
+            workers=WEBHOOK_WORKERS,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+            recovery_seconds=WEBHOOK_RECOVERY_SECONDS,
+        )
+        print(f"✅ Webhook queue started ({WEBHOOK_WORKERS} workers)")
+    except Exception as e:
+        print("❌ Webhook queue start error:", e)
+
     try:
         yield
     finally:
-        for task in [session_sweeper_task, redis_listener_task]:
+        for task in [session_sweeper_task, sweeper_membership_task, redis_listener_task]:
             if task:
                 task.cancel()
                 with contextlib.suppress(Exception):
                     await task
         if redis_client:
+            with contextlib.suppress(Exception):
+                await sweeper_partition.leave(redis_client)
             with contextlib.suppress(Exception):
                 await redis_client.close()
         with contextlib.suppress(Exception):
             await db.close_pool()
+        with contextlib.suppress(Exception):
+            await expiry_scheduler.scheduler.stop()
+        with contextlib.suppress(Exception):
+            await webhook_queue.queue.stop()
+        with contextlib.suppress(Exception):
+            await machine_actor.shutdown()
+        presence.close_presence()
 
 
 # ──────────────────────────────────────────────
@@ -173,10 +244,30 @@ async def _rate_limit_handler(request: Request, exc: RateLimitExceeded):
     )
 
 
+# Idempotency-Key: retried mutations get the first response back
+IDEMPOTENT_PATHS = {"/api/session/claim", "/create-order", "/api/session/trigger-dispense"}
+
+
+@app.middleware("http")
+async def _idempotency_middleware(request: Request, call_next):
+    key = request.headers.get(idempotency.HEADER)
+    if not key or request.method != "POST" or request.url.path not in IDEMPOTENT_PATHS:
+        return await call_next(request)
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        return JSONResponse({"error": "Idempotency-Key too long"}, status_code=400)
+    body = await request.body()
+    return await idempotency.store.handle(
+        f"{request.url.path}:{key}", idempotency.fingerprint(body), lambda: call_next(request)
+    )
+
+
 # Razorpay
 razorpay_client = None
 if RAZORPAY_KEY_ID and RAZORPAY_SECRET_KEY:
-    razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET_KEY))
+    razorpay_options = {"base_url": RAZORPAY_BASE_URL} if RAZORPAY_BASE_URL else {}
+    razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET_KEY), **razorpay_options)
+    if RAZORPAY_BASE_URL:
+        print(f"⚠️ Razorpay API overridden: {RAZORPAY_BASE_URL}")
 else:
     print("⚠️ Razorpay credentials missing; payment endpoints will return errors.")
 
@@ -185,30 +276,138 @@ else:
 #  Helper: Send WS + Redis
 # ──────────────────────────────────────────────
 
+def _remember_local_delivery(msg_id: str):
+    _local_deliveries[msg_id] = None
+    while len(_local_deliveries) > _LOCAL_DELIVERY_MEMORY:
+        _local_deliveries.popitem(last=False)
+
+
 async def _send_to_machine(machine_id: str, payload: dict, store_pending: bool = True):
-    """Send a message to an ESP32 via WebSocket + Redis. Best-effort."""
+    """Send a message to an ESP32 via WebSocket, falling back to Redis. Best-effort.
+
+    A message delivered on a local socket is only published when the presence
+    table says a newer connection for the machine lives on another worker.
+    Published messages carry this worker's ID so our own listener drops the echo.
+    """
     if store_pending:
         pending_http_commands.setdefault(machine_id, []).append(payload)
-    
+
+    msg_id = secrets.token_hex(8)
+    delivered = False
+
     # Local WebSocket
     ws = connected_machines.get(machine_id)
     if ws:
         try:
             await ws.send_text(json.dumps(payload))
+            delivered = True
+            _remember_local_delivery(msg_id)
+            metrics.incr("ws_local_delivered")
         except Exception as e:
             print(f"WS send failed for {machine_id}: {e}")
 
+    if delivered:
+        owner = presence.get_presence(machine_id)
+        if not owner or owner.get("worker_id") in (None, presence.WORKER_ID):
+            return
+
     # Redis cross-worker
     if redis_client:
         try:
             await redis_client.publish(
                 REDIS_CHANNEL,
-                json.dumps({"machine_id": machine_id, "payload": payload}),
+                json.dumps({
+                    "machine_id": machine_id,
+                    "payload": payload,
+                    "origin": presence.ORIGIN_ID,
+                    "msg_id": msg_id,
+                }),
             )
+            metrics.incr("redis_published")
         except Exception as e:
             print(f"Redis publish failed: {e}")
 
 
+def _session_frame(
+    frame_type: str, machine_id: str, session: Dict, rotation: bool = False
+) -> Dict:
+    """Build a `session` / `new_session` frame for the ESP32.
+
+    Adds the pre-issued successor as "next" (the device swaps to it after
+    "in_ms" without waiting for the server) and, in totp rotation mode with
+    `rotation` set, the parameters the device needs to derive codes itself.
+    Those carry the machine's permanent secret: only pass `rotation` for a
+    socket whose API key was verified.
+    """
+    base_url = FRONTEND_URL or "https://smartvend.onrender.com"
+    url_prefix = f"{base_url}/vend/{machine_id}/"
+    token = session.get("session_token")
+    frame = {
+        "type": frame_type,
+        "token": token,
+        "url": f"{url_prefix}{token}",
+        "expires_at": session.get("expires_at"),
+    }
+    successor = session.get("next")
+    if successor and session.get("expires_at"):
+        remaining = session_db._parse_ts(session["expires_at"]) - session_db._now()
+        frame["next"] = {
+            "token": successor.get("session_token"),
+            "url": f"{url_prefix}{successor.get('session_token')}",
+            "expires_at": successor.get("expires_at"),
+            "in_ms": max(0, int(remaining.total_seconds() * 1000)),
+        }
+    if rotation and session.get("rotating"):
+        frame["rotation"] = session_tokens.rotation_params(machine_id, url_prefix)
+    return frame
+
+
+def _dispense_command(transaction_id: str, quantity: int) -> Dict:
+    cmd = {
+        "type": "command",
+        "action": "dispense",
+        "duration": quantity,
+        "transaction_id": transaction_id,
+    }
+    if SESSION_PIPELINE_ENABLED:
+        cmd["pipelined"] = True  # Run the motor without taking over the display
+    return cmd
+
+
+async def _start_dispense(machine_id: str, started: Optional[Dict]):
+    """Pipelined: run the queued sale start_next_dispense promoted on the motor."""
+    if not started:
+        return
+    await _send_to_machine(machine_id, _dispense_command(
+        started.get("dispense_transaction_id"), started.get("dispense_quantity")
+    ))
+    await session_events.publish(machine_id, "dispensing", session_id=started.get("id"))
+
+
+async def _dispatch_dispense(machine_id: str, result: Dict, transaction_id: str, quantity: int) -> bool:
+    """Send the dispense command for a successful trigger.
+
+    Pipelined mode: the motor runs whichever queued sale start_next_dispense
+    promoted (possibly none yet), and the next customer's QR goes up at once.
+    Returns False if this sale is waiting in the machine's queue.
+    """
+    session_id = (result.get("session") or {}).get("id")
+    await _discard_speculative(session_id)
+    if "dispense" not in result:
+        await _send_to_machine(machine_id, _dispense_command(transaction_id, quantity))
+        await session_events.publish(machine_id, "dispensing", session_id=session_id)
+        return True
+
+    started = result.get("dispense")
+    if result.get("queued") or (started or {}).get("id") != session_id:
+        await session_events.publish(machine_id, "queued", session_id=session_id)
+    await _start_dispense(machine_id, started)
+    new_session = await machine_actor.renew(machine_id)
+    if new_session:
+        await _push_new_session(machine_id, new_session)
+    return not result.get("queued")
+
+
 # ══════════════════════════════════════════════
 #  WEBSOCKET — ESP32 Connection
 # ══════════════════════════════════════════════
@@ -220,11 +419,14 @@ async def websocket_endpoint(websocket: WebSocket):
     v3.0 Protocol:
     ESP32 → Server:
       - {"type": "register", "machine_id": "M001", "api_key": "sv_001mmsg"}
-      - {"type": "pong"}
+      - {"type": "pong"}  (optional "telemetry": {...} piggyback)
+      - {"type": "telemetry", "rssi": -61, "battery": 87.5, "status": "idle"}
       - {"type": "confirm", "transaction_id": "...", "dispensed": 2}
     
     Server → ESP32:
       - {"type": "session", "token": "xK9mBq2P", "url": "https://..."}
+        (adds "next": {token, url, expires_at, in_ms} — the pre-issued successor —
+         or, in totp rotation mode, "rotation": {secret, window, length, server_time, url_prefix})
       - {"type": "claimed", "name": "Goutham"}
       - {"type": "new_session", "token": "pR7nWm4K", "url": "https://..."}
       - {"type": "command", "action": "dispense", "duration": 2, "transaction_id": "..."}
@@ -232,6 +434,8 @@ async def websocket_endpoint(websocket: WebSocket):
     """
     await websocket.accept()
     machine_id = None
+    # API key verified at register: only then may the socket get the rotation secret
+    authenticated = False
     heartbeat_task = None
 
     async def heartbeat():
@@ -261,11 +465,24 @@ async def websocket_endpoint(websocket: WebSocket):
                 continue
 
             mtype = msg.get("type")
+            if machine_id:
+                presence.touch(machine_id)
 
             # ── REGISTER ──
             if mtype == "register":
                 machine_id = msg.get("machine_id")
                 api_key = msg.get("api_key")
+                if machine_id and db.pool:
+                    # Before register, which stores the key it is given
+                    authenticated = await _api_key_valid(machine_id, api_key)
+                    if authenticated is False:
+                        print(f"🚫 WS: register for {machine_id} with a wrong API key")
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "error": "invalid_api_key",
+                        }))
+                        machine_id = None
+                        continue
                 if machine_id:
                     # Remove old connection if exists
                     if machine_id in connected_machines:
@@ -274,6 +491,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         except Exception:
                             pass
                     connected_machines[machine_id] = websocket
+                    presence.mark_connected(machine_id)
                     
                     # Start heartbeat
                     if heartbeat_task:
@@ -284,17 +502,18 @@ async def websocket_endpoint(websocket: WebSocket):
                     # v3.0: Register machine + create session + send QR URL
                     try:
                         if db.pool:
-                            session_info = await session_db.register_machine_session(
+                            session_info = await machine_actor.register(
                                 machine_id, api_key or "none"
                             )
+                            if authenticated is None:
+                                # First registration: the key was just provisioned
+                                authenticated = bool(await _api_key_valid(machine_id, api_key))
                             if session_info and not session_info.get("error"):
                                 # Send session to ESP32 for QR generation
-                                await websocket.send_text(json.dumps({
-                                    "type": "session",
-                                    "token": session_info["session_token"],
-                                    "url": session_info["url"],
-                                    "expires_at": session_info["expires_at"],
-                                }))
+                                session = session_info.get("session") or session_info
+                                await websocket.send_text(json.dumps(
+                                    _session_frame("session", machine_id, session, rotation=authenticated)
+                                ))
                                 print(f"📱 Sent session to {machine_id}: {session_info['session_token']}")
                             else:
                                 print(f"⚠️ Session creation failed for {machine_id}: {session_info}")
@@ -307,12 +526,21 @@ async def websocket_endpoint(websocket: WebSocket):
 
             # ── PONG (response to our ping) ──
             elif mtype == "pong":
-                if machine_id and db.pool:
+                if isinstance(msg.get("telemetry"), dict):
+                    # Piggybacked vitals: ingestion also refreshes last_seen
+                    await _ingest_ws_telemetry(machine_id, msg["telemetry"])
+                elif machine_id and db.pool:
                     try:
                         await db.set_machine_last_seen(machine_id)
                     except Exception:
                         pass
 
+            # ── TELEMETRY (same payload as POST /device/telemetry) ──
+            elif mtype == "telemetry":
+                await _ingest_ws_telemetry(
+                    machine_id, {k: v for k, v in msg.items() if k != "type"}
+                )
+
             # ── STATUS (legacy, kept for backward compat) ──
             elif mtype == "status":
                 value = msg.get("value")
@@ -333,35 +561,18 @@ async def websocket_endpoint(websocket: WebSocket):
                     continue
                 try:
                     if db.pool:
-                        session = await session_db.get_active_session_for_machine(machine_id)
+                        # Served from the machine actor's cache when the session is live;
+                        # creates one (once, even if requested concurrently) when missing.
+                        session = await machine_actor.ensure_session(machine_id)
                         if session:
-                            base_url = FRONTEND_URL or "https://smartvend.onrender.com"
-                            token = session.get("session_token")
-                            url = f"{base_url}/vend/{machine_id}/{token}"
+                            await websocket.send_text(json.dumps(
+                                _session_frame("session", machine_id, session, rotation=authenticated)
+                            ))
+                        else:
                             await websocket.send_text(json.dumps({
-                                "type": "session",
-                                "token": token,
-                                "url": url,
-                                "expires_at": session.get("expires_at"),
+                                "type": "error",
+                                "error": "no_session",
                             }))
-                        else:
-                            # No active session — create one
-                            new_session = await session_db.create_session(machine_id)
-                            if new_session:
-                                base_url = FRONTEND_URL or "https://smartvend.onrender.com"
-                                token = new_session.get("session_token")
-                                url = f"{base_url}/vend/{machine_id}/{token}"
-                                await websocket.send_text(json.dumps({
-                                    "type": "session",
-                                    "token": token,
-                                    "url": url,
-                                    "expires_at": new_session.get("expires_at"),
-                                }))
-                            else:
-                                await websocket.send_text(json.dumps({
-                                    "type": "error",
-                                    "error": "no_session",
-                                }))
                 except Exception as e:
                     print("Error responding to fetch_display:", e)
 
@@ -372,6 +583,7 @@ async def websocket_endpoint(websocket: WebSocket):
         print(f"🔌 WebSocket disconnected: {machine_id}")
         if machine_id and connected_machines.get(machine_id) is websocket:
             connected_machines.pop(machine_id, None)
+            presence.mark_disconnected(machine_id)
             try:
                 if db.pool:
                     await db.update_machine_status(machine_id, "offline")
@@ -381,6 +593,7 @@ async def websocket_endpoint(websocket: WebSocket):
         print("WebSocket error:", e)
         if machine_id and connected_machines.get(machine_id) is websocket:
             connected_machines.pop(machine_id, None)
+            presence.mark_disconnected(machine_id)
     finally:
         if heartbeat_task:
             heartbeat_task.cancel()
@@ -390,13 +603,34 @@ async def websocket_endpoint(websocket: WebSocket):
 #  Redis PubSub Listener
 # ──────────────────────────────────────────────
 
+async def _forward_redis_message(obj: dict):
+    """Deliver a cross-worker message to a local socket, dropping our own echoes."""
+    if obj.get("origin") == presence.ORIGIN_ID:
+        # Our own publish; already delivered (or undeliverable) here
+        metrics.incr("redis_echo_dropped")
+        return
+    if obj.get("msg_id") in _local_deliveries:
+        metrics.incr("ws_duplicate_deliveries")
+        return
+    machine = obj.get("machine_id")
+    payload = obj.get("payload")
+    if machine and payload:
+        ws = connected_machines.get(machine)
+        if ws:
+            try:
+                await ws.send_text(json.dumps(payload))
+                metrics.incr("redis_forwarded")
+            except Exception as e:
+                print("Error forwarding to ws client:", e)
+
+
 async def _redis_pubsub_listener(rclient):
     """Background task: forward Redis messages to local WebSocket connections."""
     pubsub = None
     try:
         pubsub = rclient.pubsub()
-        await pubsub.subscribe(REDIS_CHANNEL)
-        print(f"📡 Subscribed to redis channel {REDIS_CHANNEL}")
+        await pubsub.subscribe(REDIS_CHANNEL, session_events.CHANNEL)
+        print(f"📡 Subscribed to redis channels {REDIS_CHANNEL}, {session_events.CHANNEL}")
         while True:
             try:
                 msg = await pubsub.get_message(
@@ -414,15 +648,10 @@ async def _redis_pubsub_listener(rclient):
                     obj = json.loads(data)
                 except Exception:
                     continue
-                machine = obj.get("machine_id")
-                payload = obj.get("payload")
-                if machine and payload:
-                    ws = connected_machines.get(machine)
-                    if ws:
-                        try:
-                            await ws.send_text(json.dumps(payload))
-                        except Exception as e:
-                            print("Error forwarding to ws client:", e)
+                if msg.get("channel") == session_events.CHANNEL:
+                    session_events.deliver_remote(obj)
+                    continue
+                await _forward_redis_message(obj)
             except asyncio.CancelledError:
                 raise
             except Exception as e:
@@ -431,37 +660,159 @@ async def _redis_pubsub_listener(rclient):
     finally:
         if pubsub:
             with contextlib.suppress(Exception):
-                await pubsub.unsubscribe(REDIS_CHANNEL)
+                await pubsub.unsubscribe(REDIS_CHANNEL, session_events.CHANNEL)
 
 
 # ══════════════════════════════════════════════
 #  v3.0 SESSION ENDPOINTS
 # ══════════════════════════════════════════════
 
+async def _claim_and_notify(
+    session_token: str, client_id: str, user_name: str, machine_id: Optional[str] = None
+) -> Dict:
+    """session_db.claim_session, then tell the machine (TFT: QR → "In Use")."""
+    result = await session_db.claim_session(session_token, client_id, machine_id=machine_id)
+    if result.get("error"):
+        return result
+
+    machine_id = result.get("machine_id")
+    machine_actor.observe(machine_id, result.get("session", {}))
+    if result.get("status") == "claimed":
+        await _send_to_machine(machine_id, {
+            "type": "claimed",
+            "claimed_by_name": user_name,
+        }, store_pending=True)
+        session = result.get("session", {})
+        await session_events.publish(
+            machine_id, "in_progress", session_id=session.get("id"), expires_at=session.get("expires_at")
+        )
+        if SPECULATIVE_ORDERS_ENABLED and razorpay_client and session.get("id"):
+            _spawn(_speculate_order(session, client_id))
+    return result
+
+
 @app.get("/s/{token}")
-async def short_link_redirect(token: str):
-    """Short URL redirection for ESP32 QR codes to minimize length.
-    Maps /s/TOKEN straight to the frontend /vend/M001/TOKEN route.
+@limiter.limit("30/minute")
+async def short_link_redirect(
+    token: str,
+    request: Request,
+    name: Optional[str] = None,
+    sv_cid: Optional[str] = Cookie(None),
+    sv_name: Optional[str] = Cookie(None),
+):
+    """Short URL for ESP32 QR codes to minimize length.
+
+    With SHORT_LINK_LANDING_ENABLED this serves landing_page: session state,
+    stock and price rendered in, claimed in the same request when the
+    customer is known (cookies or ?name=), then forwarded to the SPA with
+    that state in the fragment. Otherwise it redirects /s/TOKEN to the
+    frontend /vend/M001/TOKEN route.
+    Signed tokens are checked in memory; if this worker knows the token's
+    machine slot, the redirect needs no lookup at all.
     """
-    if not db.pool:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    session = await session_db.get_session_by_token(token)
-    if not session:
-        return HTMLResponse("<h1>Session expired or invalid.</h1><p>Please scan the new QR code on the machine.</p>", 404)
-    
-    machine_id = session.get("machine_id")
+    expired = HTMLResponse(landing_page.render_expired(), 404)
+    if signed_tokens.rejects(token, session_db.LIVE_TOKEN_AGE_SECONDS):
+        return expired
     base_url = FRONTEND_URL or "https://smartvend.onrender.com"
+    if SHORT_LINK_LANDING_ENABLED:
+        return await _short_link_landing(token, base_url, name, sv_cid, sv_name)
+    machine_id = signed_tokens.machine_for(token) if signed_tokens.enabled() else None
+    if not machine_id:
+        if not db.pool:
+            raise HTTPException(status_code=500, detail="Database not configured")
+        session = await session_db.get_session_by_token(token)
+        if not session:
+            return expired
+        machine_id = session.get("machine_id")
+        signed_tokens.remember(machine_id)
+    else:
+        metrics.incr("short_link_lookups_skipped")
+
     return RedirectResponse(f"{base_url}/vend/{machine_id}/{token}")
 
+
+async def _short_link_landing(
+    token: str, base_url: str, name: Optional[str], client_id: Optional[str], cookie_name: Optional[str]
+) -> HTMLResponse:
+    if not db.pool:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    client_id = client_id or str(uuid.uuid4())
+    user_name = landing_page.client_name(name, cookie_name)
+    machine_hint = signed_tokens.machine_for(token) if signed_tokens.enabled() else None
+
+    boot = await session_db.get_session_bootstrap(machine_hint, token, client_id)
+    status = boot["session"]
+    if status.get("error"):
+        return HTMLResponse(landing_page.render_expired(), 404)
+    machine_id = status.get("machine_id")
+    signed_tokens.remember(machine_id)
+
+    claim = None
+    if status.get("status") == "active" and not status.get("expired_by_time") and user_name:
+        result = await _claim_and_notify(token, client_id, user_name, machine_id=machine_id)
+        if result.get("error") == "already_claimed":
+            status = {**status, "status": "in_progress", "is_owner": False}
+        elif result.get("error"):
+            status = {**status, "status": "expired"}
+        else:
+            session = result.get("session", {})
+            claim = {
+                "status": result.get("status"),
+                "name": user_name,
+                "ticket": claim_tickets.issue(session, client_id),
+            }
+            status = {
+                **status,
+                "status": session.get("status", "in_progress"),
+                "expires_at": session.get("expires_at"),
+                "is_owner": True,
+            }
+    metrics.incr("short_link_landings", claimed=str(bool(claim)).lower())
+
+    state = {**boot, "session": status, "client_id": client_id, "claim": claim}
+    response = HTMLResponse(landing_page.render(state, token, base_url))
+    response.headers["Cache-Control"] = "no-store"
+    response.set_cookie(
+        landing_page.CLIENT_COOKIE, client_id,
+        max_age=landing_page.COOKIE_MAX_AGE, httponly=True, samesite="lax",
+    )
+    if user_name:
+        response.set_cookie(
+            landing_page.NAME_COOKIE, user_name,
+            max_age=landing_page.COOKIE_MAX_AGE, httponly=True, samesite="lax",
+        )
+    return response
+
+@app.get("/api/session/bootstrap")
+async def session_bootstrap(
+    machine_id: str, session_token: Optional[str] = None, client_id: Optional[str] = None
+):
+    """Everything the vending pages need on load, in one response.
+
+    Query: ?machine_id=M001&session_token=xK9mBq2P&client_id=abc123
+    Returns: { "session": {...} | { "error": "session_not_found" } | null,
+               "machine": {...public-status fields, location},
+               "unit_price_paise": 100, "server_time": "..." }
+    """
+    if not db.pool:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    boot = await session_db.get_session_bootstrap(machine_id, session_token, client_id)
+    if not boot.get("machine"):
+        raise HTTPException(status_code=404, detail="Machine not found")
+    return boot
+
+
 @app.post("/api/session/claim")
 @limiter.limit("15/minute")
 async def claim_session(request: Request):
     """Claim an active session after QR scan.
     
-    Body: { "session_token": "xK9mBq2P", "client_id": "abc123", "name": "Goutham" }
+    Body: { "session_token": "xK9mBq2P", "client_id": "abc123", "name": "Goutham",
+            "machine_id": "M001" }  (machine_id required for rotating tokens)
     
     Returns:
-      200: { "status": "claimed", "machine_id": "M001", "expires_at": "..." }
+      200: { "status": "claimed", "machine_id": "M001", "expires_at": "...",
+             "ticket": "v1...." }  (signed ownership proof for create-order/cancel)
       200: { "status": "already_claimed", ... }  (same user resuming)
       409: { "error": "already_claimed" }  (different user)
       410: { "error": "expired_or_invalid" }
@@ -477,7 +828,9 @@ async def claim_session(request: Request):
     if not session_token or not client_id:
         raise HTTPException(status_code=400, detail="session_token and client_id required")
 
-    result = await session_db.claim_session(session_token, client_id)
+    result = await _claim_and_notify(
+        session_token, client_id, user_name, machine_id=data.get("machine_id")
+    )
 
     if result.get("error"):
         error = result["error"]
@@ -497,28 +850,27 @@ async def claim_session(request: Request):
 
     machine_id = result.get("machine_id")
     session = result.get("session", {})
-
-    # Send "claimed" notification to ESP32 → TFT switches from QR to "In Use"
-    if result.get("status") == "claimed":
-        await _send_to_machine(machine_id, {
-            "type": "claimed",
-            "claimed_by_name": user_name,
-        }, store_pending=True)
-
     return {
         "status": result.get("status"),
         "machine_id": machine_id,
         "session_token": session.get("session_token"),
         "expires_at": session.get("expires_at"),
         "is_owner": True,
+        "ticket": claim_tickets.issue(session, client_id),
     }
 
 
 @app.get("/api/session/status")
-async def get_session_status(session_token: str, client_id: Optional[str] = None):
+async def get_session_status(
+    session_token: str,
+    client_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    ticket: Optional[str] = None,
+):
     """Check session status (for frontend reload/resume).
     
-    Query: ?session_token=xK9mBq2P&client_id=abc123
+    Query: ?session_token=xK9mBq2P&client_id=abc123&machine_id=M001&ticket=v1....
+    The status itself is read fresh; a valid claim ticket settles ownership.
     """
     if not db.pool:
         raise HTTPException(status_code=500, detail="Database not configured")
@@ -526,7 +878,9 @@ async def get_session_status(session_token: str, client_id: Optional[str] = None
     if not session_token:
         raise HTTPException(status_code=400, detail="session_token required")
 
-    result = await session_db.get_session_status(session_token, client_id)
+    result = await session_db.get_session_status(session_token, client_id, machine_id)
+    if not result.get("error") and claim_tickets.verify(ticket, session_token, client_id or ""):
+        result["is_owner"] = True
 
     if result.get("error"):
         if result["error"] == "session_not_found":
@@ -539,11 +893,37 @@ async def get_session_status(session_token: str, client_id: Optional[str] = None
     return result
 
 
+@app.get("/api/session/events")
+async def session_event_stream(session_token: str, client_id: Optional[str] = None):
+    """Server-Sent Events for one session: the current status, then each
+    transition (in_progress, queued, dispensing, completed, expired,
+    cancelled, failed) as it happens. Replaces status polling.
+
+    Query: ?session_token=xK9mBq2P&client_id=abc123
+    Frames: `event: status` with data { "status": "...", ... }
+    """
+    if not db.pool:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    if signed_tokens.rejects(session_token, session_db.LIVE_TOKEN_AGE_SECONDS):
+        return JSONResponse({"error": "session_not_found"}, status_code=404)
+
+    session = await session_db.get_session_by_token(session_token)
+    if not session:
+        return JSONResponse({"error": "session_not_found"}, status_code=404)
+    status = await session_db.get_session_status(session_token, client_id, session=session)
+    sub = session_events.subscribe(session["id"], session["machine_id"], status.get("status"))
+    return StreamingResponse(
+        session_events.stream(sub, status),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/session/cancel")
 async def cancel_session(request: Request):
     """Explicitly cancel a session (user decides not to pay).
     
-    Body: { "session_token": "xK9mBq2P", "client_id": "abc123" }
+    Body: { "session_token": "xK9mBq2P", "client_id": "abc123", "ticket": "v1...." }
     """
     if not db.pool:
         raise HTTPException(status_code=500, detail="Database not configured")
@@ -555,7 +935,22 @@ async def cancel_session(request: Request):
     if not session_token or not client_id:
         raise HTTPException(status_code=400, detail="session_token and client_id required")
 
-    result = await session_db.cancel_session(session_token, client_id)
+    # A valid claim ticket stands in for the lookup; the cancel itself only
+    # expires a row that is still in_progress
+    claims = claim_tickets.verify(data.get("ticket"), session_token, client_id)
+    if claims:
+        session = claim_tickets.as_session(claims, session_token, client_id)
+        metrics.incr("claim_ticket_lookups_skipped", endpoint="cancel")
+    else:
+        session = await session_db.get_session_by_token(session_token)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    # Cancel + next session run in the machine's actor (serialized with sweeper/confirm)
+    machine_id = session.get("machine_id")
+    result, new_session = await machine_actor.cancel(
+        machine_id, session_token, client_id, session=session
+    )
 
     if result.get("error"):
         error = result["error"]
@@ -565,21 +960,12 @@ async def cancel_session(request: Request):
             raise HTTPException(status_code=404, detail="Session not found")
         return JSONResponse({"error": error, "detail": result.get("detail")}, status_code=400)
 
-    machine_id = result.get("machine_id")
+    await session_events.publish(machine_id, "cancelled", session_id=session.get("id"))
+    await _discard_speculative(session.get("id"))
 
-    # Create new session for the machine and notify ESP32
-    if machine_id:
-        new_session = await session_db.create_session(machine_id)
-        if new_session:
-            base_url = FRONTEND_URL or "https://smartvend.onrender.com"
-            token = new_session.get("session_token")
-            url = f"{base_url}/vend/{machine_id}/{token}"
-            await _send_to_machine(machine_id, {
-                "type": "new_session",
-                "token": token,
-                "url": url,
-                "expires_at": new_session.get("expires_at"),
-            })
+    # Notify ESP32 of the new session
+    if machine_id and new_session:
+        await _push_new_session(machine_id, new_session)
 
     return {"status": "cancelled"}
 
@@ -713,14 +1099,11 @@ async def session_trigger_dispense(request: Request):
         return JSONResponse({"error": error}, status_code=400)
 
     machine_id = result.get("machine_id")
+    machine_actor.observe(machine_id, {**result.get("session", {}), "status": "dispensing"})
 
     # Send dispense command to ESP32
-    await _send_to_machine(machine_id, {
-        "type": "command",
-        "action": "dispense",
-        "duration": quantity,
-        "transaction_id": razorpay_order_id,
-    })
+    if not await _dispatch_dispense(machine_id, result, razorpay_order_id, quantity):
+        return {"status": "queued", "machine_id": machine_id}
 
     return {"status": "dispatch_sent", "machine_id": machine_id}
 
@@ -762,6 +1145,10 @@ async def list_machines():
     for m in machines:
         if m.get("status") == "idle" and (m.get("current_stock") or 0) <= 0:
             m["status"] = "out_of_stock"
+        # Live WebSocket presence from shared memory (no extra I/O)
+        if presence.table is not None:
+            p = presence.get_presence(m.get("machine_id") or "")
+            m["online"] = bool(p and p["online"])
     return machines
 
 
@@ -790,6 +1177,30 @@ def verify_token(user_id=Depends(auth_handler.auth_wrapper)):
     return {"status": "valid", "user_id": user_id}
 
 
+@app.get("/api/admin/metrics")
+def get_metrics(user_id=Depends(auth_handler.auth_wrapper)):
+    """Per-worker counters (WS delivery, Redis echoes, ...). Requires admin authentication."""
+    return {
+        "worker_id": presence.WORKER_ID,
+        "origin_id": presence.ORIGIN_ID,
+        "expiry_pending": expiry_scheduler.scheduler.pending(),
+        "sweeper_members": list(sweeper_partition.members()),
+        **metrics.snapshot(),
+    }
+
+
+@app.post("/api/admin/reconcile-payments")
+async def reconcile_payments(
+    max_batches: int = 10, user_id=Depends(auth_handler.auth_wrapper)
+):
+    """Run the orphaned-order reconciliation from its checkpoint. Requires admin authentication."""
+    if not razorpay_client:
+        raise HTTPException(status_code=503, detail="Razorpay not configured")
+    return await reconciliation.run(
+        reconciliation.RazorpayGateway(razorpay_client), max_batches=max_batches
+    )
+
+
 @app.post("/api/machine/{machine_id}/update-stock")
 async def update_machine_stock(
     machine_id: str, request: Request, user_id=Depends(auth_handler.auth_wrapper)
@@ -840,6 +1251,15 @@ async def verify_api_key(machine_id: str, authorization: Optional[str]):
         raise HTTPException(status_code=401, detail="Invalid API key")
 
 
+async def _api_key_valid(machine_id: str, api_key: Optional[str]) -> Optional[bool]:
+    """verify_api_key for register messages. None: machine not registered yet."""
+    try:
+        await verify_api_key(machine_id, f"Bearer {api_key}" if api_key else None)
+        return True
+    except HTTPException as e:
+        return None if e.status_code == 404 else False
+
+
 @app.post("/api/machine/register")
 async def register_machine(request: Request):
     """ESP32 calls this once on boot (HTTP fallback for WebSocket registration)."""
@@ -851,9 +1271,11 @@ async def register_machine(request: Request):
         raise HTTPException(status_code=500, detail="Database not configured")
 
     api_key = data.get("api_key", "none")
-    
+    if await _api_key_valid(machine_id, api_key) is False:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
     # v3.0: Use session registration
-    session_info = await session_db.register_machine_session(machine_id, api_key)
+    session_info = await machine_actor.register(machine_id, api_key)
     if not session_info or session_info.get("error"):
         raise HTTPException(status_code=500, detail="Failed to register machine")
 
@@ -912,7 +1334,7 @@ async def confirm_dispense(
         raise HTTPException(status_code=500, detail="Database not configured")
 
     # v3.0: Complete the session and create a new one
-    result = await session_db.complete_session(machine_id, transaction_id, dispensed)
+    result = await machine_actor.complete(machine_id, transaction_id, dispensed)
 
     if result.get("error"):
         # Fallback to legacy confirm if session system fails
@@ -931,18 +1353,22 @@ async def confirm_dispense(
         background_tasks.add_task(send_email_async, subject, body)
         print(f"📧 Low stock alert queued for {machine_id} (remaining: {remaining})")
 
+    # Browsers: the procedure path doesn't say which session it completed,
+    # but it can only be the machine's dispensing one
+    await session_events.publish(
+        machine_id, "completed",
+        session_id=result.get("session_id"),
+        from_statuses=None if result.get("session_id") else ("dispensing",),
+        dispensed=dispensed,
+    )
+
+    # Pipelined: the motor moves on to the next paid sale
+    await _start_dispense(machine_id, result.get("dispense"))
+
     # Send new session to ESP32 for fresh QR
     new_session = result.get("new_session")
     if new_session:
-        base_url = FRONTEND_URL or "https://smartvend.onrender.com"
-        token = new_session.get("session_token")
-        url = f"{base_url}/vend/{machine_id}/{token}"
-        await _send_to_machine(machine_id, {
-            "type": "new_session",
-            "token": token,
-            "url": url,
-            "expires_at": new_session.get("expires_at"),
-        })
+        await _push_new_session(machine_id, new_session)
 
     return {
         "status": "confirmed",
@@ -951,6 +1377,66 @@ async def confirm_dispense(
     }
 
 
+CONFIRM_BATCH_MAX_ITEMS = 50
+
+
+@app.post("/api/machine/{machine_id}/confirm-batch")
+async def confirm_dispense_batch(
+    machine_id: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    authorization: Optional[str] = Header(None),
+):
+    """ESP32 replays confirmations held through an outage, in one call.
+
+    Body: { "confirmations": [{ "transaction_id": "order_xxx", "dispensed": 2 }, ...] }
+    Returns: { "status": "ok", "results": [{ transaction_id, status | error }],
+               "new_session_token": "...", "new_session": { token, url, expires_at } }
+    """
+    await verify_api_key(machine_id, authorization)
+    data = await request.json()
+    items = data.get("confirmations")
+    if (
+        not isinstance(items, list) or not items or len(items) > CONFIRM_BATCH_MAX_ITEMS
+        or not all(isinstance(i, dict) and i.get("transaction_id") for i in items)
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"confirmations: 1-{CONFIRM_BATCH_MAX_ITEMS} items with transaction_id required",
+        )
+
+    result = await machine_actor.complete_batch(machine_id, items)
+    if result.get("error"):
+        return JSONResponse(
+            {"message": "confirm_failed", "error": result["error"]}, status_code=400
+        )
+
+    if result.get("low_stock") and result.get("completed"):
+        subject = f"Low Stock Alert - {machine_id}"
+        remaining = result.get("remaining_stock", 0)
+        body = f"Machine {machine_id} stock is low.\nRemaining stock: {remaining}."
+        background_tasks.add_task(send_email_async, subject, body)
+
+    for item in result.get("results", []):
+        if item.get("status") == "completed" and item.get("session_id"):
+            await session_events.publish(
+                machine_id, "completed", session_id=str(item["session_id"])
+            )
+
+    await _start_dispense(machine_id, result.get("dispense"))
+
+    new_session = result.get("new_session")
+    if new_session:
+        await _push_new_session(machine_id, new_session)
+
+    return {
+        "status": "ok",
+        "results": result.get("results", []),
+        "new_session_token": new_session.get("session_token") if new_session else None,
+        "new_session": _session_frame("new_session", machine_id, new_session) if new_session else None,
+    }
+
+
 @app.post("/api/machine/{machine_id}/report-error")
 async def report_error(
     machine_id: str, request: Request, authorization: Optional[str] = Header(None)
@@ -978,6 +1464,61 @@ async def report_error(
 #  PAYMENT ENDPOINTS
 # ══════════════════════════════════════════════
 
+async def _create_razorpay_order(amount: int) -> Dict:
+    """razorpay order.create with up to three attempts on transient failures."""
+    order_payload = {"amount": amount, "currency": "INR", "payment_capture": 1}
+    last_order_error = None
+    for attempt in range(3):
+        try:
+            return razorpay_client.order.create(order_payload)
+        except Exception as e:
+            last_order_error = e
+            if not _is_transient_razorpay_error(e) or attempt == 2:
+                raise
+            backoff_s = 0.35 * (attempt + 1)
+            print(
+                f"⚠️ Razorpay order.create transient failure "
+                f"(attempt {attempt + 1}/3): {e}. Retrying in {backoff_s:.2f}s..."
+            )
+            await asyncio.sleep(backoff_s)
+    raise RuntimeError(f"Razorpay order creation failed: {last_order_error}")
+
+
+async def _true() -> bool:
+    return True
+
+
+async def _speculate_order(session: Dict, client_id: str):
+    """Right after a claim: create the order for the likeliest quantity and
+    map it as speculative, so /create-order can hand it out at once."""
+    machine_id = session.get("machine_id")
+    quantity = SPECULATIVE_ORDER_QUANTITY
+    try:
+        if not await db.check_stock_available(machine_id, quantity):
+            return
+        amount = quantity * PRICE_PER_UNIT_PAISA
+        order = await _create_razorpay_order(amount)
+        record = await session_db.create_order_record(
+            order_id=order["id"],
+            session_id=session["id"],
+            machine_id=machine_id,
+            client_id=client_id,
+            quantity=quantity,
+            amount=amount,
+            speculative=True,
+        )
+        metrics.incr("speculative_orders", outcome="created" if record else "mapping_failed")
+    except Exception as e:
+        metrics.incr("speculative_orders", outcome="failed")
+        print(f"Speculative order error for {machine_id}: {e}")
+
+
+async def _discard_speculative(session_id: Optional[str]):
+    if SPECULATIVE_ORDERS_ENABLED and session_id:
+        if await session_db.discard_speculative_orders(session_id):
+            metrics.incr("speculative_orders", outcome="discarded")
+
+
 @app.post("/create-order")
 async def create_order(request: Request):
     """Create Razorpay order after session validation.
@@ -996,8 +1537,17 @@ async def create_order(request: Request):
         client_id = data.get("client_id")
         session = None
 
-        # v3.0: Validate session ownership before creating order
-        if session_token and client_id:
+        # v3.0: Validate session ownership before creating order. A valid
+        # claim ticket proves it without a lookup; trigger-dispense still
+        # checks the session's state before anything is dispensed.
+        claims = (
+            claim_tickets.verify(data.get("ticket"), session_token, client_id)
+            if session_token and client_id else None
+        )
+        if claims and machine_id in (None, claims["machine_id"]):
+            session = claim_tickets.as_session(claims, session_token, client_id)
+            metrics.incr("claim_ticket_lookups_skipped", endpoint="create_order")
+        elif session_token and client_id:
             session = await session_db.get_session_by_token(session_token)
             if not session:
                 return JSONResponse({"error": "Session not found"}, status_code=404)
@@ -1009,6 +1559,24 @@ async def create_order(request: Request):
             if session.get("claimed_by") != client_id:
                 return JSONResponse({"error": "Session not owned by this client"}, status_code=403)
 
+        # Speculative order for this quantity, pre-created at claim: adopt it
+        # (stock is checked alongside, so still one round trip)
+        if session and SPECULATIVE_ORDERS_ENABLED and quantity == SPECULATIVE_ORDER_QUANTITY:
+            adopted, stock_ok = await asyncio.gather(
+                session_db.adopt_speculative_order(session["id"], quantity),
+                db.check_stock_available(machine_id, quantity) if machine_id else _true(),
+            )
+            if adopted and stock_ok:
+                metrics.incr("speculative_orders", outcome="hit")
+                return JSONResponse({
+                    "id": adopted["order_id"],
+                    "amount": adopted["amount"],
+                    "currency": "INR",
+                    "unit_price_paise": PRICE_PER_UNIT_PAISA,
+                    "quantity": quantity,
+                })
+            metrics.incr("speculative_orders", outcome="miss")
+
         # Stock check only (no decrement at order creation)
         if machine_id:
             stock_ok = await db.check_stock_available(machine_id, quantity)
@@ -1021,27 +1589,7 @@ async def create_order(request: Request):
                 )
 
         amount = quantity * PRICE_PER_UNIT_PAISA
-        order_payload = {"amount": amount, "currency": "INR", "payment_capture": 1}
-        order = None
-        last_order_error = None
-        for attempt in range(3):
-            try:
-                order = razorpay_client.order.create(order_payload)
-                break
-            except Exception as e:
-                last_order_error = e
-                if not _is_transient_razorpay_error(e) or attempt == 2:
-                    raise
-                backoff_s = 0.35 * (attempt + 1)
-                print(
-                    f"⚠️ Razorpay order.create transient failure "
-                    f"(attempt {attempt + 1}/3): {e}. Retrying in {backoff_s:.2f}s..."
-                )
-                await asyncio.sleep(backoff_s)
-
-        if order is None:
-            raise RuntimeError(f"Razorpay order creation failed: {last_order_error}")
-
+        order = await _create_razorpay_order(amount)
         order["unit_price_paise"] = PRICE_PER_UNIT_PAISA
         order["quantity"] = quantity
 
@@ -1109,12 +1657,95 @@ async def send_mail(request: Request, background_tasks: BackgroundTasks):
 #  RAZORPAY WEBHOOK (v3.0: auto-dispense)
 # ══════════════════════════════════════════════
 
+async def _process_webhook_event(event: Dict[str, Any]):
+    """Reconcile one verified webhook event (called by the webhook queue).
+
+    v3.0: When payment is captured but frontend never called trigger-dispense
+    (tab closed, network failure), this auto-dispenses.
+    """
+    event_type = event.get("event", "")
+    if event_type != "payment.captured":
+        return
+
+    payment_entity = event.get("payload", {}).get("payment", {}).get("entity", {})
+    order_id = payment_entity.get("order_id")
+    payment_id = payment_entity.get("id")
+    amount = payment_entity.get("amount")
+    print(
+        f"🔔 WEBHOOK: payment.captured — order={order_id} payment={payment_id} amount={amount}"
+    )
+
+    # v3.0: Check if order exists in our orders table
+    if order_id:
+        order = await session_db.get_order_by_id(order_id)
+        if order:
+            session_id = order.get("session_id")
+            machine_id = order.get("machine_id")
+            client_id = order.get("client_id")
+            quantity = order.get("quantity")
+
+            # Check: does a transaction already exist for this session?
+            # If not, auto-trigger dispense (the safety net). Look the
+            # order's own session up: in pipelined mode the machine's
+            # newest session may already belong to the next customer.
+            if session_id:
+                session = await session_db.get_session_by_id(session_id)
+            else:
+                session = await session_db.get_active_session_for_machine(machine_id)
+            if session and session.get("status") == "in_progress":
+                print(f"🔄 WEBHOOK: Auto-triggering dispense for order {order_id}")
+
+                # Use order_id as transaction key for cross-path idempotency
+                # (frontend trigger + webhook race on same payment).
+                tx_id = order_id
+                result = await session_db.trigger_dispense_session(
+                    session.get("session_token"),
+                    client_id,
+                    quantity,
+                    tx_id,
+                    amount or (quantity * PRICE_PER_UNIT_PAISA),
+                    order_id=order_id,
+                )
+
+                if result.get("status") == "ok":
+                    machine_actor.observe(machine_id, {**session, "status": "dispensing"})
+                    # Send dispense command to ESP32
+                    if await _dispatch_dispense(machine_id, result, tx_id, quantity):
+                        print(f"✅ WEBHOOK: Dispense command sent for order {order_id}")
+                    else:
+                        print(f"⏳ WEBHOOK: Order {order_id} queued behind the running dispense")
+                elif result.get("error") in ("already_processed", "duplicate"):
+                    print(f"ℹ️ WEBHOOK: Order {order_id} already processed")
+                else:
+                    print(f"❌ WEBHOOK: Dispense failed for order {order_id}: {result}")
+            elif session and session.get("status") in ("queued", "dispensing"):
+                print(f"ℹ️ WEBHOOK: Order {order_id} already being dispensed")
+            else:
+                print(f"⚠️ WEBHOOK: No active session for machine {machine_id}, order {order_id}")
+                await session_db.log_event(
+                    machine_id=machine_id,
+                    event_type="webhook_orphan_payment",
+                    payload={"order_id": order_id, "amount": amount},
+                )
+        else:
+            print(f"⚠️ WEBHOOK: No order record found for {order_id}")
+
+
+def _webhook_event_id(request: Request, body: bytes) -> str:
+    """Razorpay's event ID; a body digest if the header is missing
+    (redeliveries of one event carry the same body)."""
+    event_id = request.headers.get("X-Razorpay-Event-Id")
+    if event_id:
+        return event_id
+    return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
 @app.post("/api/razorpay-webhook")
 async def razorpay_webhook(request: Request):
-    """Handle Razorpay webhook for payment reconciliation.
-    
-    v3.0: When payment is captured but frontend never called trigger-dispense
-    (tab closed, network failure), this webhook auto-dispenses.
+    """Acknowledge a Razorpay webhook once it is verified and persisted.
+
+    payment.captured events are stored in webhook_events (deduplicated by
+    event ID) and reconciled by the webhook queue after the 200 is sent.
     """
     body = await request.body()
     signature = request.headers.get("X-Razorpay-Signature", "")
@@ -1129,90 +1760,87 @@ async def razorpay_webhook(request: Request):
 
     try:
         event = json.loads(body)
-        event_type = event.get("event", "")
+    except ValueError:
+        return JSONResponse({"error": "Invalid payload"}, status_code=400)
 
-        if event_type == "payment.captured":
-            payment_entity = event.get("payload", {}).get("payment", {}).get("entity", {})
-            order_id = payment_entity.get("order_id")
-            payment_id = payment_entity.get("id")
-            amount = payment_entity.get("amount")
-            print(
-                f"🔔 WEBHOOK: payment.captured — order={order_id} payment={payment_id} amount={amount}"
-            )
+    event_type = event.get("event", "")
+    if event_type != "payment.captured":
+        print(f"🔔 WEBHOOK: Received event '{event_type}', no action taken.")
+        return JSONResponse({"status": "ok"})
 
-            # v3.0: Check if order exists in our orders table
-            if order_id:
-                order = await session_db.get_order_by_id(order_id)
-                if order:
-                    session_id = order.get("session_id")
-                    machine_id = order.get("machine_id")
-                    client_id = order.get("client_id")
-                    quantity = order.get("quantity")
-
-                    # Check: does a transaction already exist for this session?
-                    # If not, auto-trigger dispense (the safety net)
-                    session = await session_db.get_active_session_for_machine(machine_id)
-                    if session and session.get("status") == "in_progress":
-                        print(f"🔄 WEBHOOK: Auto-triggering dispense for order {order_id}")
-                        
-                        # Use order_id as transaction key for cross-path idempotency
-                        # (frontend trigger + webhook race on same payment).
-                        tx_id = order_id
-                        result = await session_db.trigger_dispense_session(
-                            session.get("session_token"),
-                            client_id,
-                            quantity,
-                            tx_id,
-                            amount or (quantity * PRICE_PER_UNIT_PAISA),
-                            order_id=order_id,
-                        )
-
-                        if result.get("status") == "ok":
-                            # Send dispense command to ESP32
-                            await _send_to_machine(machine_id, {
-                                "type": "command",
-                                "action": "dispense",
-                                "duration": quantity,
-                                "transaction_id": tx_id,
-                            })
-                            print(f"✅ WEBHOOK: Dispense command sent for order {order_id}")
-                        elif result.get("error") in ("already_processed", "duplicate"):
-                            print(f"ℹ️ WEBHOOK: Order {order_id} already processed")
-                        else:
-                            print(f"❌ WEBHOOK: Dispense failed for order {order_id}: {result}")
-                    elif session and session.get("status") == "dispensing":
-                        print(f"ℹ️ WEBHOOK: Order {order_id} already being dispensed")
-                    else:
-                        print(f"⚠️ WEBHOOK: No active session for machine {machine_id}, order {order_id}")
-                        await session_db.log_event(
-                            machine_id=machine_id,
-                            event_type="webhook_orphan_payment",
-                            payload={"order_id": order_id, "amount": amount},
-                        )
-                else:
-                    print(f"⚠️ WEBHOOK: No order record found for {order_id}")
-        else:
-            print(f"🔔 WEBHOOK: Received event '{event_type}', no action taken.")
+    event_id = _webhook_event_id(request, body)
+    order_id = event.get("payload", {}).get("payment", {}).get("entity", {}).get("order_id")
+    recorded = await session_db.record_webhook_event(event_id, event_type, order_id, event)
 
-        return JSONResponse({"status": "ok"})
-    except Exception as e:
-        print(f"❌ WEBHOOK error: {e}")
-        return JSONResponse({"error": "Processing failed"}, status_code=500)
+    if recorded is False:
+        metrics.incr("webhook_duplicates_skipped")
+        print(f"ℹ️ WEBHOOK: Duplicate event {event_id} skipped")
+        return JSONResponse({"status": "duplicate"})
+
+    if recorded is None:
+        # Table missing (008 not applied) or DB error: reconcile inline as
+        # before; a failure here makes Razorpay redeliver
+        try:
+            await _process_webhook_event(event)
+            metrics.incr("webhook_events", outcome="inline")
+            return JSONResponse({"status": "ok"})
+        except Exception as e:
+            print(f"❌ WEBHOOK error: {e}")
+            return JSONResponse({"error": "Processing failed"}, status_code=500)
+
+    webhook_queue.queue.submit({
+        "event_id": event_id,
+        "order_id": order_id,
+        "payload": event,
+        "status": "pending",
+        "attempts": 0,
+        "received_at": clock.now().isoformat(),
+    })
+    return JSONResponse({"status": "queued"})
 
 
 # ══════════════════════════════════════════════
 #  DEVICE HTTP FALLBACK ENDPOINTS
 # ══════════════════════════════════════════════
 
-@app.post("/device/telemetry")
-async def ingest_telemetry(payload: TelemetryPayload):
-    """HTTP fallback when WS is unavailable."""
+async def _ingest_telemetry(payload: TelemetryPayload):
+    """Shared ingestion path for telemetry from HTTP and WebSocket."""
     device_id = payload.device_id
+    presence.touch(device_id)
     if db.pool:
         try:
             await db.set_machine_last_seen(device_id)
         except Exception as e:
             print(f"Telemetry update error for {device_id}: {e}")
+
+
+async def _ingest_ws_telemetry(machine_id: Optional[str], data: Dict[str, Any]):
+    """Validate a WS telemetry frame with TelemetryPayload and ingest it.
+
+    The device_id defaults to the registered machine and may not name another one.
+    Invalid frames are logged and dropped (an "error" frame would take the TFT
+    off the QR screen).
+    """
+    if not machine_id:
+        print("WS telemetry before register, ignoring")
+        return
+    data = dict(data)
+    data.setdefault("device_id", machine_id)
+    if data.get("device_id") != machine_id:
+        print(f"WS telemetry device_id mismatch on {machine_id}: {data.get('device_id')}")
+        return
+    try:
+        payload = TelemetryPayload(**data)
+    except ValidationError as e:
+        print(f"Invalid WS telemetry from {machine_id}: {e.errors()}")
+        return
+    await _ingest_telemetry(payload)
+
+
+@app.post("/device/telemetry")
+async def ingest_telemetry(payload: TelemetryPayload):
+    """HTTP fallback when WS is unavailable."""
+    await _ingest_telemetry(payload)
     return {"status": "ok", "proto": payload.proto}
 
 
@@ -1227,36 +1855,94 @@ async def get_device_commands(device_id: str):
 #  SESSION EXPIRY SWEEPER (v3.0 — replaces lock sweeper)
 # ══════════════════════════════════════════════
 
+async def _push_new_session(machine_id: str, new_session: Dict):
+    """Send a renewed session's QR URL to the ESP32."""
+    await _send_to_machine(machine_id, _session_frame("new_session", machine_id, new_session))
+
+
+def _machine_online(machine_id: str) -> bool:
+    """Whether the ESP32 may hold a connection somewhere we can reach.
+
+    The presence table only covers the workers of this host. With Redis
+    configured the socket may be on another host (commands reach it through
+    `ws:commands`), so a machine missing here still counts as online. Without
+    the presence table there is no cross-worker view at all, so every machine
+    counts as online and keeps rotating.
+    """
+    if machine_id in connected_machines or presence.table is None:
+        return True
+    p = presence.get_presence(machine_id)
+    if p and p.get("online"):
+        return True
+    return redis_client is not None
+
+
+async def _recover_dispense(failed: Dict):
+    """Dispensing watchdog fired: move the motor on (pipelined) and put up a fresh QR."""
+    machine_id = failed["machine_id"]
+    print(f"⏱️ Dispense timeout on {machine_id} (tx {failed.get('transaction_id')}) — session failed")
+    await session_events.publish(machine_id, "failed", session_id=failed.get("session_id"))
+    if SESSION_PIPELINE_ENABLED:
+        await _start_dispense(machine_id, await session_db.start_next_dispense(machine_id))
+    if not _machine_online(machine_id):
+        return
+    new_session = await machine_actor.renew(machine_id, failed["session_id"])
+    if new_session:
+        await _push_new_session(machine_id, new_session)
+
+
+async def _on_session_due(session_id: str, machine_id: str, old_status: str):
+    """Expiry scheduler callback: expire the session at its deadline and renew.
+    Offline machines are left without a session until they register again.
+    A DISPENSING deadline is the motor timeout: the dispensing watchdog."""
+    if old_status == "dispensing":
+        failed = await session_db.fail_dispense(session_id, machine_id)
+        if failed:
+            await _recover_dispense(failed)
+        return
+    if not await session_db.expire_session(session_id, machine_id, old_status):
+        return  # Claimed, extended or already expired elsewhere
+    await session_events.publish(machine_id, "expired", session_id=session_id)
+    await _discard_speculative(session_id)
+    if not _machine_online(machine_id):
+        metrics.incr("expiry_offline_skipped")
+        return
+    new_session = await machine_actor.renew(machine_id, session_id)
+    if new_session:
+        await _push_new_session(machine_id, new_session)
+        print(f"🔄 Expiry: renewed session for {machine_id} → {new_session.get('session_token')}")
+
+
 async def _session_expiry_sweeper():
-    """Periodically expire stale sessions and create new ones.
+    """Reconciliation backstop for the expiry scheduler.
     
-    v3.0: Queries DB directly for all expired sessions (not just connected machines).
-    This ensures sessions expire even if the ESP32 is connected to a different worker.
+    Deadlines normally fire on time from `expiry_scheduler`; this slow scan
+    catches sessions whose timer lived on another worker or was lost in a
+    restart. Queries DB directly for all expired sessions (not just
+    connected machines), but only expires machines in this worker's
+    partition (`sweeper_partition`). Also fails DISPENSING sessions past
+    their motor timeout (dispensing watchdog).
     """
     while True:
         try:
-            await asyncio.sleep(5)  # Check every 5 seconds
-            
-            if not db.pool:
-                continue
-
-            # Expire stale sessions and get list of machines that need new sessions
-            renewed = await session_db.expire_and_renew_sessions()
+            if db.pool:
+                # Renewals go through each machine's actor so they can't race
+                # fetch_display/cancel/confirm on the partial unique index
+                renewed = await session_db.expire_and_renew_sessions(
+                    renew=machine_actor.renew,
+                    owns=sweeper_partition.owns,
+                    online=_machine_online,
+                )
 
-            for machine_id, new_session in renewed:
-                base_url = FRONTEND_URL or "https://smartvend.onrender.com"
-                token = new_session.get("session_token")
-                url = f"{base_url}/vend/{machine_id}/{token}"
+                for machine_id, new_session in renewed:
+                    await _push_new_session(machine_id, new_session)
+                    metrics.incr("expiry_backstop_renewed")
+                    print(f"🔄 Sweeper: renewed session for {machine_id} → {new_session.get('session_token')}")
 
-                # Send new QR to ESP32
-                await _send_to_machine(machine_id, {
-                    "type": "new_session",
-                    "token": token,
-                    "url": url,
-                    "expires_at": new_session.get("expires_at"),
-                })
+                for failed in await session_db.fail_stale_dispenses(owns=sweeper_partition.owns):
+                    await _recover_dispense(failed)
 
-                print(f"🔄 Sweeper: renewed session for {machine_id} → {token}")
+            await clock.sleep(SESSION_RECONCILE_SECONDS)
 
         except asyncio.CancelledError:
             break
@@ -0,0 +1,65 @@
+"""
+SmartVend v3.0 — In-process Metrics
+===================================
+Lightweight per-worker counters and value summaries.
+Exposed to admins via GET /api/admin/metrics; no external dependency.
+
+    metrics.incr("redis_echo_dropped")
+    metrics.incr("dispense_timeouts", machine_id="M001")
+    metrics.observe("expiry_fire_lag_seconds", 0.012)
+"""
+
+from typing import Any, Dict, Tuple
+
+_counters: Dict[Tuple[str, Tuple], float] = {}
+_summaries: Dict[str, Dict[str, float]] = {}
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name: str, value: float = 1, **labels):
+    """Increment a counter, optionally split by labels (e.g. machine_id)."""
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def get(name: str, **labels) -> float:
+    return _counters.get(_key(name, labels), 0)
+
+
+def observe(name: str, value: float):
+    """Record a sample into a count/sum/max/last summary."""
+    s = _summaries.get(name)
+    if s is None:
+        s = _summaries[name] = {"count": 0, "sum": 0.0, "max": value, "last": value}
+    s["count"] += 1
+    s["sum"] += value
+    s["max"] = max(s["max"], value)
+    s["last"] = value
+
+
+def snapshot() -> Dict[str, Any]:
+    """Return all counters and summaries as plain JSON-friendly dicts."""
+    counters: Dict[str, Any] = {}
+    for (name, labels), value in sorted(_counters.items(), key=lambda kv: len(kv[0][1])):
+        if labels:
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            current = counters.get(name)
+            if not isinstance(current, dict):
+                # Keep the unlabeled total (if any) next to the labeled split
+                counters[name] = {} if current is None else {"total": current}
+            counters[name][label] = value
+        else:
+            counters[name] = value
+    summaries = {
+        name: {**s, "avg": (s["sum"] / s["count"]) if s["count"] else 0.0}
+        for name, s in _summaries.items()
+    }
+    return {"counters": counters, "summaries": summaries}
+
+
+def reset():
+    _counters.clear()
+    _summaries.clear()
@@ -0,0 +1,260 @@
+"""
+SmartVend v3.0 — Shared-Memory Presence Table
+=============================================
+Cross-worker view of which ESP32s hold a WebSocket, and on which worker.
+
+Each uvicorn worker keeps its own `connected_machines` dict, so answering
+"is M001 online?" used to need Redis or a database read. This module maps a
+fixed-layout array into `multiprocessing.shared_memory` that every worker on
+the host attaches to:
+
+    header : magic(4s) version(I) capacity(I)
+    record : machine_id(32s) worker_id(i) _pad(i) connected_at(d) last_recv_at(d)
+
+Machine IDs are interned into a slot by open addressing (crc32 + linear probe).
+Slots are never freed, so a slot index is stable for the lifetime of the segment.
+Writers never take a lock: a worker only writes records for machines whose
+socket it owns, and slot claims are verified by re-reading the stored ID.
+Readers get an O(1) lookup with no I/O.
+"""
+
+import os
+import struct
+import time
+import uuid
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional
+
+from config import PRESENCE_MAX_MACHINES, PRESENCE_SHM_NAME, PRESENCE_STALE_SECONDS
+
+
+# ──────────────────────────────────────────────
+#  Layout
+# ──────────────────────────────────────────────
+
+_MAGIC = b"SVPT"
+_VERSION = 1
+_HEADER = struct.Struct("<4sII")
+_RECORD = struct.Struct("<32siidd")
+_ID_BYTES = 32
+
+# Identifies this worker in presence records (0 means "not connected").
+# Only meaningful within this host's segment.
+WORKER_ID = os.getpid()
+
+# Identifies this process on the Redis channels, where messages from other
+# hosts arrive too. PIDs repeat across containers (often all PID 1).
+ORIGIN_ID = uuid.uuid4().hex
+
+
+class PresenceTable:
+    """Array-backed presence records in a named shared-memory segment."""
+
+    def __init__(self, name: str, capacity: int, create: bool = True):
+        size = _HEADER.size + capacity * _RECORD.size
+        self._owner = False
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+            self._owner = create
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        # The segment outlives any single worker; don't let the resource
+        # tracker unlink it when the process that created it exits.
+        try:
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        except Exception:
+            pass
+
+        buf = self._shm.buf
+        if self._owner:
+            _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, capacity)
+        magic, version, stored_capacity = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self._shm.close()
+            raise ValueError(f"Presence segment {name!r} has an unknown layout")
+
+        self.name = name
+        self.capacity = stored_capacity
+        self._slots: Dict[str, int] = {}
+
+    # ── Slots ──
+
+    @staticmethod
+    def _encode(machine_id: str) -> bytes:
+        raw = machine_id.encode("utf-8")
+        if len(raw) > _ID_BYTES:
+            raise ValueError(f"machine_id longer than {_ID_BYTES} bytes: {machine_id!r}")
+        return raw.ljust(_ID_BYTES, b"\0")
+
+    def _offset(self, slot: int) -> int:
+        return _HEADER.size + slot * _RECORD.size
+
+    def _stored_id(self, slot: int) -> bytes:
+        off = self._offset(slot)
+        return bytes(self._shm.buf[off:off + _ID_BYTES])
+
+    def slot_for(self, machine_id: str, create: bool = False) -> Optional[int]:
+        """Return the interned slot for machine_id, claiming one if `create`."""
+        key = self._encode(machine_id)
+
+        cached = self._slots.get(machine_id)
+        if cached is not None and self._stored_id(cached) == key:
+            return cached
+
+        start = zlib.crc32(key) % self.capacity
+        for i in range(self.capacity):
+            slot = (start + i) % self.capacity
+            stored = self._stored_id(slot)
+            if stored == key:
+                self._slots[machine_id] = slot
+                return slot
+            if stored.strip(b"\0"):
+                continue
+            # Empty slot: the probe chain ends here
+            if not create:
+                return None
+            off = self._offset(slot)
+            self._shm.buf[off:off + _ID_BYTES] = key
+            if self._stored_id(slot) == key:
+                self._slots[machine_id] = slot
+                return slot
+            # Lost the claim to another worker; keep probing
+        return None
+
+    def machine_at(self, slot: int) -> Optional[str]:
+        """Reverse lookup: the machine interned at `slot`, if any."""
+        if not 0 <= slot < self.capacity:
+            return None
+        stored = self._stored_id(slot).rstrip(b"\0")
+        return stored.decode("utf-8") if stored else None
+
+    # ── Writes (owning worker only) ──
+
+    def _write(self, slot: int, worker_id: int, connected_at: float, last_recv_at: float):
+        off = self._offset(slot) + _ID_BYTES
+        struct.pack_into("<iidd", self._shm.buf, off, worker_id, 0, connected_at, last_recv_at)
+
+    def _read(self, slot: int):
+        _, worker_id, _, connected_at, last_recv_at = _RECORD.unpack_from(
+            self._shm.buf, self._offset(slot)
+        )
+        return worker_id, connected_at, last_recv_at
+
+    def mark_connected(self, machine_id: str, worker_id: int = WORKER_ID) -> Optional[int]:
+        slot = self.slot_for(machine_id, create=True)
+        if slot is None:
+            return None
+        now = time.time()
+        self._write(slot, worker_id, now, now)
+        return slot
+
+    def touch(self, machine_id: str, worker_id: int = WORKER_ID):
+        """Record a receive from machine_id on this worker."""
+        slot = self.slot_for(machine_id, create=True)
+        if slot is None:
+            return
+        owner, connected_at, _ = self._read(slot)
+        if owner != worker_id:
+            connected_at = time.time()
+        self._write(slot, worker_id, connected_at, time.time())
+
+    def mark_disconnected(self, machine_id: str, worker_id: int = WORKER_ID):
+        """Clear the record, unless another worker has since taken the machine over."""
+        slot = self.slot_for(machine_id)
+        if slot is None:
+            return
+        owner, connected_at, last_recv_at = self._read(slot)
+        if owner == worker_id:
+            self._write(slot, 0, connected_at, last_recv_at)
+
+    # ── Reads (any worker) ──
+
+    def lookup(self, machine_id: str) -> Optional[Dict]:
+        slot = self.slot_for(machine_id)
+        if slot is None:
+            return None
+        worker_id, connected_at, last_recv_at = self._read(slot)
+        online = bool(worker_id) and (time.time() - last_recv_at) <= PRESENCE_STALE_SECONDS
+        return {
+            "machine_id": machine_id,
+            "slot": slot,
+            "worker_id": worker_id or None,
+            "connected_at": connected_at or None,
+            "last_recv_at": last_recv_at or None,
+            "online": online,
+        }
+
+    def close(self, unlink: bool = False):
+        self._shm.close()
+        if unlink:
+            try:
+                # unlink() unregisters from the resource tracker; re-register first
+                resource_tracker.register(self._shm._name, "shared_memory")
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# ──────────────────────────────────────────────
+#  Module-level table (one per worker process)
+# ──────────────────────────────────────────────
+
+table: Optional[PresenceTable] = None
+
+
+def init_presence():
+    """Create or attach to the host-wide presence segment. Best-effort."""
+    global table
+    if table is not None:
+        return table
+    try:
+        table = PresenceTable(PRESENCE_SHM_NAME, PRESENCE_MAX_MACHINES)
+    except Exception as e:
+        print(f"⚠️ Presence table unavailable: {e}")
+        table = None
+    return table
+
+
+def close_presence():
+    global table
+    if table is not None:
+        table.close()
+        table = None
+
+
+def mark_connected(machine_id: str):
+    if table is None:
+        return
+    try:
+        table.mark_connected(machine_id)
+    except Exception as e:
+        print(f"Presence mark_connected error for {machine_id}: {e}")
+
+
+def touch(machine_id: str):
+    if table is None:
+        return
+    try:
+        table.touch(machine_id)
+    except Exception as e:
+        print(f"Presence touch error for {machine_id}: {e}")
+
+
+def mark_disconnected(machine_id: str):
+    if table is None:
+        return
+    try:
+        table.mark_disconnected(machine_id)
+    except Exception as e:
+        print(f"Presence mark_disconnected error for {machine_id}: {e}")
+
+
+def get_presence(machine_id: str) -> Optional[Dict]:
+    if table is None:
+        return None
+    try:
+        return table.lookup(machine_id)
+    except Exception:
+        return None
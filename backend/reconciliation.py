@@ -0,0 +1,198 @@
+"""
+SmartVend v3.0 — Payment Reconciliation
+=======================================
+Finds orders that never became a transaction and asks Razorpay what happened.
+
+A payment can be captured without a transactions row: the tab closed before
+trigger-dispense, the webhook was missed, or the webhook found no live
+session (`webhook_orphan_payment`). This job walks `orders` in
+(created_at, order_id) keyset batches. For each batch it:
+
+  1. looks up the matching transactions rows (id = uuid5(order_id)) in one query,
+  2. loads the sessions of the orders that have none, in one query,
+  3. fetches those orders' payments from the gateway, a few at a time, and
+  4. upserts one verdict per order into payment_reconciliation:
+
+     dispense_pending  paid, and the session is still claimed and unexpired
+     refund_needed     paid, but the session can no longer dispense
+     abandoned         no captured payment (or a speculative order never used)
+
+The cursor is saved in reconciliation_checkpoints after each batch, so a run
+that stops (max_batches, gateway error, restart) resumes at the next order.
+Orders younger than RECONCILE_GRACE_SECONDS are left for the normal flow.
+
+    python reconciliation.py --batch-size 200 --max-batches 50
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import clock
+import metrics
+import session_db
+from config import (
+    RAZORPAY_BASE_URL,
+    RAZORPAY_KEY_ID,
+    RAZORPAY_SECRET_KEY,
+    RECONCILE_BATCH_SIZE,
+    RECONCILE_GATEWAY_CONCURRENCY,
+    RECONCILE_GRACE_SECONDS,
+)
+
+JOB = "orders"
+PAID_STATUSES = ("captured", "authorized")
+
+
+class RazorpayGateway:
+    """Payment lookups through the Razorpay SDK client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def order_payments(self, order_id: str) -> List[Dict]:
+        res = await asyncio.to_thread(self.client.order.payments, order_id)
+        return (res or {}).get("items", [])
+
+
+def classify(order: Dict, payments: List[Dict], session: Optional[Dict]) -> Dict:
+    """Verdict row for an order without a transaction."""
+    paid = next((p for p in payments if p.get("status") in PAID_STATUSES), None)
+    if paid is None or order.get("speculative"):
+        classification = "abandoned"
+    elif (
+        session
+        and session.get("status") == "in_progress"
+        and session.get("expires_at")
+        and session_db._parse_ts(session["expires_at"]) > clock.now()
+    ):
+        classification = "dispense_pending"
+    else:
+        classification = "refund_needed"
+    latest = paid or (payments[-1] if payments else {})
+    return {
+        "order_id": order["order_id"],
+        "session_id": order.get("session_id"),
+        "machine_id": order.get("machine_id"),
+        "amount": (paid or {}).get("amount") or order.get("amount"),
+        "classification": classification,
+        "payment_id": latest.get("id"),
+        "payment_status": latest.get("status"),
+        "checked_at": clock.now().isoformat(),
+    }
+
+
+class _GatewayFailure(Exception):
+    def __init__(self, order: Dict, error: Exception, verdicts: List[Dict]):
+        super().__init__(str(error))
+        self.order = order
+        self.verdicts = verdicts
+
+
+async def _reconcile_batch(gateway, orders: List[Dict], concurrency: int) -> List[Dict]:
+    """Verdicts for the orphaned orders in `orders`, in order. Stops at the
+    first gateway failure; the caller checkpoints only what was returned."""
+    by_tx = {session_db._transaction_uuid(o["order_id"]): o for o in orders}
+    recorded = await session_db.existing_transaction_ids(list(by_tx))
+    orphans = [o for tx, o in by_tx.items() if tx not in recorded]
+    sessions = await session_db.sessions_by_ids([o.get("session_id") for o in orphans])
+
+    gate = asyncio.Semaphore(concurrency)
+
+    async def _fetch(order):
+        if order.get("speculative"):
+            return []
+        async with gate:
+            return await gateway.order_payments(order["order_id"])
+
+    fetched = await asyncio.gather(*(_fetch(o) for o in orphans), return_exceptions=True)
+    verdicts = []
+    for order, payments in zip(orphans, fetched):
+        if isinstance(payments, Exception):
+            raise _GatewayFailure(order, payments, verdicts)
+        verdicts.append(classify(order, payments, sessions.get(str(order.get("session_id")))))
+    return verdicts
+
+
+async def run(
+    gateway,
+    batch_size: int = RECONCILE_BATCH_SIZE,
+    max_batches: Optional[int] = None,
+    grace_seconds: int = RECONCILE_GRACE_SECONDS,
+    concurrency: int = RECONCILE_GATEWAY_CONCURRENCY,
+    job: str = JOB,
+) -> Dict:
+    """Reconcile from the saved checkpoint. Returns a summary of this run."""
+    checkpoint = await session_db.get_reconcile_checkpoint(job) or {}
+    cursor = (checkpoint.get("cursor_created_at"), checkpoint.get("cursor_order_id"))
+    before = (clock.now() - timedelta(seconds=grace_seconds)).isoformat()
+    counts: Counter = Counter()
+    scanned = batches = 0
+    error = None
+    started = time.perf_counter()
+
+    while max_batches is None or batches < max_batches:
+        orders = await session_db.orders_after(cursor[0], cursor[1], before, batch_size)
+        if not orders:
+            break
+        batch_started = time.perf_counter()
+        try:
+            verdicts = await _reconcile_batch(gateway, orders, concurrency)
+            done = orders
+        except _GatewayFailure as e:
+            verdicts = e.verdicts
+            done = orders[: orders.index(e.order)]
+            error = f"gateway error at order {e.order['order_id']}: {e}"
+
+        await session_db.record_reconciliation(verdicts)
+        if done:
+            cursor = (str(done[-1]["created_at"]), done[-1]["order_id"])
+            await session_db.save_reconcile_checkpoint(job, *cursor)
+        for v in verdicts:
+            counts[v["classification"]] += 1
+            metrics.incr("reconcile_orders", classification=v["classification"])
+        scanned += len(done)
+        batches += 1
+        elapsed = time.perf_counter() - batch_started
+        if elapsed > 0 and done:
+            metrics.observe("reconcile_orders_per_second", len(done) / elapsed)
+        if error:
+            print(f"❌ Reconciliation stopped: {error}")
+            break
+        if len(orders) < batch_size:
+            break
+
+    seconds = time.perf_counter() - started
+    return {
+        "job": job,
+        "batches": batches,
+        "scanned": scanned,
+        "orphaned": sum(counts.values()),
+        "classified": dict(counts),
+        "seconds": round(seconds, 3),
+        "orders_per_second": round(scanned / seconds, 1) if seconds > 0 else None,
+        "cursor": {"created_at": cursor[0], "order_id": cursor[1]},
+        "error": error,
+    }
+
+
+if __name__ == "__main__":
+    import razorpay
+
+    parser = argparse.ArgumentParser(description="SmartVend orphaned-order reconciliation")
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE)
+    parser.add_argument("--max-batches", type=int, default=None)
+    parser.add_argument("--grace-seconds", type=int, default=RECONCILE_GRACE_SECONDS)
+    args = parser.parse_args()
+    options = {"base_url": RAZORPAY_BASE_URL} if RAZORPAY_BASE_URL else {}
+    client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_SECRET_KEY), **options)
+    print(json.dumps(asyncio.run(run(
+        RazorpayGateway(client),
+        batch_size=args.batch_size,
+        max_batches=args.max_batches,
+        grace_seconds=args.grace_seconds,
+    )), indent=2))
@@ -12,26 +12,44 @@ Session States: active → in_progress → dispensing → completed
 import asyncio
 import secrets
 import string
+import uuid
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Tuple
-
-from config import SUPABASE_KEY, SUPABASE_URL
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from config import (
+    CLAIM_TTL_SECONDS,
+    MOTOR_TIMEOUT_SECONDS,
+    PRICE_PER_UNIT_PAISA,
+    SESSION_PIPELINE_ENABLED,
+    SESSION_PROCEDURES_ENABLED,
+    SESSION_TTL_MAX_SECONDS,
+    SESSION_TTL_SECONDS,
+    SUPABASE_KEY,
+    SUPABASE_URL,
+)
 
 # Reuse supabase client from database.py
+import clock
 import database as db
+import expiry_scheduler
+import metrics
+import session_tokens
+import signed_tokens
+import ttl_policy
 
 
-# ──────────────────────────────────────────────
-#  Configuration
-# ──────────────────────────────────────────────
-
-SESSION_TTL_SECONDS = 60       # QR rotation interval (how long before QR refreshes)
-CLAIM_TTL_SECONDS = 300        # 5 minutes to complete payment after scanning
-MOTOR_TIMEOUT_SECONDS = 120    # 2 minutes max for dispensing
+# SESSION_TTL_SECONDS (QR rotation), CLAIM_TTL_SECONDS (payment window) and
+# MOTOR_TIMEOUT_SECONDS (dispensing) come from config.py; the per-machine
+# rotation TTL is ttl_policy.ttl_for().
 
 
 def _now() -> datetime:
-    return datetime.now(timezone.utc)
+    return clock.now()
+
+
+def _parse_ts(value: str) -> datetime:
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
 
 
 def _generate_session_token(length: int = 4) -> str:
@@ -43,12 +61,94 @@ def _generate_session_token(length: int = 4) -> str:
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
 
+def _new_session_token(machine_id: str) -> str:
+    """A signed token (SESSION_TOKEN_FORMAT=signed) or a short random one."""
+    if signed_tokens.enabled():
+        return signed_tokens.issue(machine_id)
+    return _generate_session_token()
+
+
+# Oldest a token can be and still be claimable: a pre-issued successor is
+# minted a full rotation before it starts, then lives one more rotation.
+CLAIMABLE_TOKEN_AGE_SECONDS = 2 * max(SESSION_TTL_SECONDS, SESSION_TTL_MAX_SECONDS) + 60
+# Oldest a token can be and still have a session worth reporting
+# (claimed at the last moment, paid, then dispensed).
+LIVE_TOKEN_AGE_SECONDS = CLAIMABLE_TOKEN_AGE_SECONDS + CLAIM_TTL_SECONDS + MOTOR_TIMEOUT_SECONDS
+
+
+def _transaction_uuid(transaction_id: str) -> str:
+    """Deterministic transactions.id for a payment/transaction ID (idempotency key)."""
+    try:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, str(transaction_id)))
+    except Exception:
+        return str(uuid.uuid4())
+
+
+# ──────────────────────────────────────────────
+#  Transactional Procedures (migrations/002_session_procedures.sql)
+# ──────────────────────────────────────────────
+
+# Cleared for the life of the process once the database reports the
+# procedures missing, so an un-migrated database costs one failed RPC.
+_procedures_available = SESSION_PROCEDURES_ENABLED
+# Procedures from later migrations, found missing one by one
+_missing_procedures: Set[str] = set()
+
+
+def _is_missing_procedure(error: Exception) -> bool:
+    error_str = str(error).lower()
+    return (
+        "pgrst202" in error_str                       # PostgREST: function not in schema cache
+        or "42883" in error_str                       # Postgres: undefined_function
+        or "could not find the function" in error_str
+    )
+
+
+async def _call_procedure(name: str, params: Dict, own_migration: bool = False) -> Optional[Dict]:
+    """Run a session transition procedure in a single round trip.
+
+    Returns the procedure's result dict (same shape as the Python path), or
+    None if procedures are disabled/missing and the caller should fall back.
+    Other errors propagate. `own_migration`: the procedure ships in a later
+    migration, so its absence disables only that procedure.
+    """
+    global _procedures_available
+    if not _procedures_available or name in _missing_procedures or not db.supabase:
+        return None
+
+    def _rpc():
+        return db.supabase.rpc(name, params).execute()
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_rpc))
+    except Exception as e:
+        if _is_missing_procedure(e):
+            print(f"Session procedure {name} not installed; using step-by-step queries")
+            if own_migration:
+                _missing_procedures.add(name)
+            else:
+                _procedures_available = False
+            return None
+        raise
+
+    data = db._res_data(res)
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if not isinstance(data, dict):
+        raise ValueError(f"Unexpected {name} result: {data!r}")
+    return data
+
+
 # ──────────────────────────────────────────────
 #  Session CRUD
 # ──────────────────────────────────────────────
 
-async def create_session(machine_id: str, ttl_seconds: int = SESSION_TTL_SECONDS) -> Optional[Dict]:
+async def create_session(
+    machine_id: str, ttl_seconds: Optional[int] = None, token: Optional[str] = None
+) -> Optional[Dict]:
     """Create a new ACTIVE session for a machine.
+    TTL defaults to the machine's adaptive rotation interval (ttl_policy).
+    Pass `token` to materialize a rotating (derived) token instead of a random one.
     
     Returns: { id, session_token, machine_id, status, expires_at, created_at }
     Returns None on failure (e.g., unique constraint violation = session already exists).
@@ -56,7 +156,8 @@ async def create_session(machine_id: str, ttl_seconds: int = SESSION_TTL_SECONDS
     if not db.supabase:
         return None
 
-    token = _generate_session_token()
+    token = token or _new_session_token(machine_id)
+    ttl_seconds = ttl_seconds or ttl_policy.ttl_for(machine_id)
     expires_at = (_now() + timedelta(seconds=ttl_seconds)).isoformat()
 
     payload = {
@@ -73,7 +174,8 @@ async def create_session(machine_id: str, ttl_seconds: int = SESSION_TTL_SECONDS
         res = await asyncio.to_thread(lambda: db._retry_supabase_query(_insert))
         data = db._res_data(res)
         if isinstance(data, list) and data:
-            return data[0]
+            data = data[0]
+        expiry_scheduler.schedule(data)
         return data
     except Exception as e:
         error_str = str(e).lower()
@@ -86,6 +188,221 @@ async def create_session(machine_id: str, ttl_seconds: int = SESSION_TTL_SECONDS
         return None
 
 
+def rotating_session(machine_id: str, seq: int = 0) -> Dict:
+    """A derived-token session of the current window (totp mode). Not a database row."""
+    current = session_tokens.current_token(machine_id, seq=seq)
+    return {
+        "session_token": current["token"],
+        "machine_id": machine_id,
+        "status": "active",
+        "expires_at": current["expires_at"],
+        "rotating": True,
+    }
+
+
+async def unused_rotating_session(machine_id: str) -> Dict:
+    """The current window's first derived token that has no session row yet.
+
+    A token that was claimed keeps its (completed, cancelled or expired) row,
+    so showing it again would fail every scan until the window rolls over.
+    """
+    tokens = session_tokens.window_tokens(machine_id)
+    used = set()
+    if db.supabase:
+        def _query():
+            return (
+                db.supabase.table("sessions")
+                .select("session_token")
+                .in_("session_token", tokens)
+                .execute()
+            )
+
+        try:
+            res = await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+            used = {r["session_token"] for r in db._res_data(res) or []}
+        except Exception as e:
+            print(f"Rotating token lookup error for {machine_id}: {e}")
+    seq = next((i for i, t in enumerate(tokens) if t not in used), len(tokens) - 1)
+    return rotating_session(machine_id, seq)
+
+
+async def next_idle_session(machine_id: str) -> Optional[Dict]:
+    """Session to show after the previous one ended.
+
+    totp rotation mode: the window's next unused derived token (no write). Otherwise the
+    pre-issued successor is activated if its window is still mostly ahead
+    (expiry rollover), else a fresh session is created (after a purchase or
+    cancel). The result carries its own pre-issued successor under "next".
+    """
+    if session_tokens.enabled():
+        return await unused_rotating_session(machine_id)
+
+    session = None
+    pending = await get_pending_successor(machine_id)
+    if pending:
+        expires_at = _parse_ts(pending["expires_at"])
+        starts_at = _parse_ts(pending["starts_at"]) if pending.get("starts_at") else None
+        window = (expires_at - starts_at).total_seconds() if starts_at else SESSION_TTL_SECONDS
+        if (expires_at - _now()).total_seconds() > window / 2:
+            session = await _activate_pending(pending)
+        if not session:
+            await _discard_pending(machine_id)
+    if not session:
+        session = await create_session(machine_id)
+    if session:
+        session["next"] = await issue_successor(session)
+    return session
+
+
+# ──────────────────────────────────────────────
+#  Pre-issued Successors (migrations/003_pending_sessions.sql)
+# ──────────────────────────────────────────────
+
+async def issue_successor(session: Dict) -> Optional[Dict]:
+    """Pre-allocate the PENDING session that follows `session` at its expires_at.
+    The device gets it as "next" and swaps QR on its own at expiry."""
+    if not db.supabase or not session.get("expires_at"):
+        return None
+
+    machine_id = session.get("machine_id")
+    starts_at = _parse_ts(session["expires_at"])
+    ttl = ttl_policy.ttl_for(machine_id)
+    payload = {
+        "session_token": _new_session_token(machine_id),
+        "machine_id": machine_id,
+        "status": "pending",
+        "starts_at": starts_at.isoformat(),
+        "expires_at": (starts_at + timedelta(seconds=ttl)).isoformat(),
+    }
+
+    def _insert():
+        return db.supabase.table("sessions").insert(payload).execute()
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_insert))
+        data = db._res_data(res)
+        return data[0] if isinstance(data, list) and data else data
+    except Exception as e:
+        print(f"Successor session create error for {session.get('machine_id')}: {e}")
+        return None
+
+
+async def get_pending_successor(machine_id: str) -> Optional[Dict]:
+    if not db.supabase:
+        return None
+
+    def _query():
+        res = (
+            db.supabase.table("sessions")
+            .select("*")
+            .eq("machine_id", machine_id)
+            .eq("status", "pending")
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+        )
+        return res.data[0] if res.data else None
+
+    try:
+        return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    except Exception as e:
+        print(f"Pending session lookup error for {machine_id}: {e}")
+        return None
+
+
+async def _activate_pending(pending: Dict) -> Optional[Dict]:
+    """PENDING → ACTIVE. None if it was already taken or the machine has a live session."""
+    def _activate():
+        return (
+            db.supabase.table("sessions")
+            .update({"status": "active"})
+            .eq("id", pending["id"])
+            .eq("status", "pending")
+            .execute()
+        )
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_activate))
+    except Exception as e:
+        # Unique index: another ACTIVE session already exists for the machine
+        print(f"Successor activation error for {pending.get('machine_id')}: {e}")
+        return None
+    data = db._res_data(res)
+    row = data[0] if isinstance(data, list) and data else (data or None)
+    if row:
+        expiry_scheduler.schedule(row)
+    return row
+
+
+async def _discard_pending(machine_id: str):
+    """Expire unused pre-issued successors (stale window, device re-registered)."""
+    if not db.supabase:
+        return
+
+    def _expire():
+        return (
+            db.supabase.table("sessions")
+            .update({"status": "expired", "completed_at": _now().isoformat()})
+            .eq("machine_id", machine_id)
+            .eq("status", "pending")
+            .execute()
+        )
+
+    try:
+        await asyncio.to_thread(lambda: db._retry_supabase_query(_expire))
+    except Exception as e:
+        print(f"Pending session discard error for {machine_id}: {e}")
+
+
+async def activate_scanned_successor(session_token: str) -> bool:
+    """Lazily activate a PENDING successor that a user scanned after the
+    device swapped to it, but before the server processed the old session's expiry."""
+    pending = await get_session_by_token(session_token)
+    if not pending or pending.get("status") != "pending":
+        return False
+    if pending.get("starts_at") and _now() < _parse_ts(pending["starts_at"]):
+        return False
+
+    machine_id = pending.get("machine_id")
+    current = await get_active_session_for_machine(machine_id)
+    if current:
+        if current.get("status") != "active":
+            return False  # Predecessor was claimed; the device isn't showing this QR
+        try:
+            if not await expire_session(current["id"], machine_id, "active"):
+                return False
+        except Exception as e:
+            print(f"Predecessor expire error for {machine_id}: {e}")
+            return False
+    return await _activate_pending(pending) is not None
+
+
+async def _materialize_rotating_session(session_token: str, machine_id: str) -> Optional[Dict]:
+    """Write the session row for a scanned derived token, if it has none yet.
+
+    Returns None when the token already has a row or isn't a valid derived
+    token, { "error": "already_claimed" } when the machine has another live
+    session, else the new ACTIVE row.
+    """
+    if session_tokens.match_window(machine_id, session_token) is None:
+        return None
+    if await get_session_by_token(session_token):
+        return None
+    row = await create_session(machine_id, token=session_token)
+    if row:
+        await log_event(
+            machine_id=machine_id,
+            session_id=row.get("id"),
+            event_type="session_created",
+            payload={"trigger": "rotating_token_scan"},
+        )
+        return row
+    # Lost to a concurrent scan of the same token, or the machine is busy
+    if await get_session_by_token(session_token):
+        return None
+    return {"error": "already_claimed"}
+
+
 async def get_session_by_token(session_token: str) -> Optional[Dict]:
     """Look up a session by its token. Returns the full row or None."""
     if not db.supabase:
@@ -109,8 +426,31 @@ async def get_session_by_token(session_token: str) -> Optional[Dict]:
         return None
 
 
-async def get_active_session_for_machine(machine_id: str) -> Optional[Dict]:
-    """Get the current active/in_progress/dispensing session for a machine."""
+async def get_session_by_id(session_id: str) -> Optional[Dict]:
+    """Look up a session by its row id. Returns the full row or None."""
+    if not db.supabase or not session_id:
+        return None
+
+    def _query():
+        res = (
+            db.supabase.table("sessions")
+            .select("*")
+            .eq("id", session_id)
+            .execute()
+        )
+        if not res.data:
+            return None
+        return res.data[0]
+
+    try:
+        return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    except Exception as e:
+        print(f"Session lookup error for id {session_id}: {e}")
+        return None
+
+
+async def _get_machine_session(machine_id: str, statuses: List[str]) -> Optional[Dict]:
+    """Newest session for a machine in one of `statuses`."""
     if not db.supabase:
         return None
 
@@ -119,7 +459,7 @@ async def get_active_session_for_machine(machine_id: str) -> Optional[Dict]:
             db.supabase.table("sessions")
             .select("*")
             .eq("machine_id", machine_id)
-            .in_("status", ["active", "in_progress", "dispensing"])
+            .in_("status", statuses)
             .order("created_at", desc=True)
             .limit(1)
             .execute()
@@ -131,12 +471,34 @@ async def get_active_session_for_machine(machine_id: str) -> Optional[Dict]:
     try:
         return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
     except Exception as e:
-        print(f"Active session lookup error for {machine_id}: {e}")
+        print(f"Session lookup error for {machine_id} ({'/'.join(statuses)}): {e}")
         return None
 
 
-async def claim_session(session_token: str, client_id: str) -> Dict:
+async def get_active_session_for_machine(machine_id: str) -> Optional[Dict]:
+    """Get the current active/in_progress/dispensing session for a machine.
+    In pipelined mode a machine can have a dispensing session and a newer
+    active/in_progress one at once; this returns the newest."""
+    return await _get_machine_session(machine_id, ["active", "in_progress", "dispensing"])
+
+
+async def get_front_session(machine_id: str) -> Optional[Dict]:
+    """The customer-facing (active/in_progress) session for a machine."""
+    return await _get_machine_session(machine_id, ["active", "in_progress"])
+
+
+async def get_dispensing_session(machine_id: str) -> Optional[Dict]:
+    """The session whose sale the motor is running."""
+    return await _get_machine_session(machine_id, ["dispensing"])
+
+
+async def claim_session(
+    session_token: str, client_id: str, machine_id: Optional[str] = None
+) -> Dict:
     """Atomically claim an ACTIVE session → IN_PROGRESS.
+    In totp rotation mode, `machine_id` lets a scanned derived token be
+    validated and its session row written first. A scanned pre-issued
+    successor (PENDING) is activated on demand.
     
     Returns:
         Success: { "status": "claimed", "session": {...}, "machine_id": "..." }
@@ -146,8 +508,39 @@ async def claim_session(session_token: str, client_id: str) -> Dict:
     """
     if not db.supabase:
         return {"error": "database_unavailable"}
+    if signed_tokens.rejects(session_token, CLAIMABLE_TOKEN_AGE_SECONDS):
+        return {"error": "expired_or_invalid"}
+
+    if machine_id and session_tokens.enabled():
+        materialized = await _materialize_rotating_session(session_token, machine_id)
+        if materialized and materialized.get("error"):
+            return materialized
+
+    result = await _claim_once(session_token, client_id)
+    if result.get("error") in ("already_claimed", "expired_or_invalid"):
+        if await activate_scanned_successor(session_token):
+            result = await _claim_once(session_token, client_id)
+    if result.get("status") == "claimed":
+        ttl_policy.record_activity(result.get("machine_id"))
+    return result
+
+
+async def _claim_once(session_token: str, client_id: str) -> Dict:
+    try:
+        result = await _call_procedure("sv_claim_session", {
+            "p_session_token": session_token,
+            "p_client_id": client_id,
+            "p_claim_ttl_seconds": CLAIM_TTL_SECONDS,
+        })
+    except Exception as e:
+        print(f"Session claim error: {e}")
+        return {"error": "claim_failed"}
+    if result is not None:
+        if result.get("status") == "claimed":
+            expiry_scheduler.schedule(result.get("session"))
+        return result
 
-    # First, fetch the session to understand its current state
+    # Fallback: step-by-step. First, fetch the session to understand its current state
     session = await get_session_by_token(session_token)
     
     if not session:
@@ -206,6 +599,7 @@ async def claim_session(session_token: str, client_id: str) -> Dict:
             return {"error": "already_claimed"}
 
         claimed_session = data[0] if isinstance(data, list) else data
+        expiry_scheduler.schedule(claimed_session)
 
         # Update machine status to 'in_use'
         await db.update_machine_status(machine_id, "in_use")
@@ -229,14 +623,43 @@ async def claim_session(session_token: str, client_id: str) -> Dict:
         return {"error": "claim_failed"}
 
 
-async def get_session_status(session_token: str, client_id: Optional[str] = None) -> Dict:
+async def get_session_status(
+    session_token: str,
+    client_id: Optional[str] = None,
+    machine_id: Optional[str] = None,
+    session: Optional[Dict] = None,
+) -> Dict:
     """Get session status for frontend (resume on reload).
     
     Returns session info. If client_id provided, indicates whether this user owns the session.
+    A valid, not-yet-claimed derived token (totp mode, `machine_id` given) reports as active.
+    Forged or long-expired signed tokens are answered without a lookup.
+    Pass `session` when the caller already fetched the row to skip a lookup.
     """
-    session = await get_session_by_token(session_token)
+    if signed_tokens.rejects(session_token, LIVE_TOKEN_AGE_SECONDS):
+        return {"error": "session_not_found"}
+    if session is None:
+        session = await get_session_by_token(session_token)
+    return _status_view(session_token, session, client_id, machine_id)
+
+
+def _status_view(
+    session_token: str, session: Optional[Dict], client_id: Optional[str], machine_id: Optional[str]
+) -> Dict:
+    """get_session_status's answer for an already-fetched row (or None)."""
+    if not session and machine_id:
+        window = session_tokens.match_window(machine_id, session_token)
+        if window is not None:
+            return {
+                "session_token": session_token,
+                "machine_id": machine_id,
+                "status": "active",
+                "expires_at": session_tokens.current_token(machine_id)["expires_at"],
+                "created_at": None,
+            }
     if not session:
         return {"error": "session_not_found"}
+    ttl_policy.record_activity(session.get("machine_id"))  # A scan (page load)
 
     result = {
         "session_token": session.get("session_token"),
@@ -249,6 +672,12 @@ async def get_session_status(session_token: str, client_id: Optional[str] = None
     if client_id:
         result["is_owner"] = session.get("claimed_by") == client_id
 
+    # Pre-issued successor the device has swapped to: claimable (activated on claim)
+    if session.get("status") == "pending":
+        starts_at = session.get("starts_at")
+        if not starts_at or _now() >= _parse_ts(starts_at):
+            result["status"] = "active"
+
     # Check if expired by time (sweeper may not have caught it yet)
     if session.get("status") in ("active", "in_progress"):
         expires_at = session.get("expires_at")
@@ -259,13 +688,100 @@ async def get_session_status(session_token: str, client_id: Optional[str] = None
     return result
 
 
-async def cancel_session(session_token: str, client_id: str) -> Dict:
+def _public_machine(machine: Optional[Dict], lock: Optional[Dict], client_id: Optional[str]) -> Optional[Dict]:
+    """Same shape as database.get_public_status, from already-fetched rows."""
+    if not machine:
+        return None
+    expires_at = lock.get("expires_at") if lock else None
+    is_locked = bool(
+        lock and lock.get("status") == "locked" and expires_at and _now() < _parse_ts(expires_at)
+    )
+    return {
+        "machine_id": machine.get("machine_id"),
+        "location": machine.get("location"),
+        "status": machine.get("status"),
+        "current_stock": machine.get("current_stock"),
+        "display_code_expires_at": machine.get("display_code_expires_at"),
+        "locked": is_locked,
+        "locked_by": lock.get("locked_by") if is_locked and client_id == lock.get("locked_by") else None,
+        "expires_at": expires_at,
+        "server_time": _now().isoformat(),
+    }
+
+
+async def get_session_bootstrap(
+    machine_id: Optional[str], session_token: Optional[str] = None, client_id: Optional[str] = None
+) -> Dict:
+    """Everything the vending pages need on load: session state and
+    ownership, machine stock/status/lock, unit price and server time.
+    Without `machine_id` the machine is the session's own.
+
+    One round trip through sv_session_bootstrap
+    (migrations/006_session_bootstrap.sql); otherwise the session and
+    machine reads run concurrently (one after the other without `machine_id`).
+
+    Returns: { "session": <get_session_status shape> | None,
+               "machine": <public status shape> | None,
+               "unit_price_paise": int, "server_time": iso }
+    """
+    rejected = bool(session_token) and signed_tokens.rejects(session_token, LIVE_TOKEN_AGE_SECONDS)
+    lookup_token = session_token if session_token and not rejected else None
+
+    data = None
+    try:
+        data = await _call_procedure("sv_session_bootstrap", {
+            "p_machine_id": machine_id,
+            "p_session_token": lookup_token,
+        }, own_migration=True)
+    except Exception as e:
+        print(f"Bootstrap procedure error for {machine_id}: {e}")
+    if data is not None:
+        row = data.get("session")
+        machine = _public_machine(data.get("machine"), data.get("lock"), client_id)
+    else:
+        async def _none():
+            return None
+
+        async def _machine(mid):
+            if not mid or not db.supabase:
+                return None
+            status = await db.get_public_status(mid, client_id)
+            return None if status.get("status") == "no_machine_found" else status
+
+        if machine_id:
+            row, machine = await asyncio.gather(
+                get_session_by_token(lookup_token) if lookup_token else _none(),
+                _machine(machine_id),
+            )
+        else:
+            row = await get_session_by_token(lookup_token) if lookup_token else None
+            machine = await _machine(row.get("machine_id") if row else None)
+
+    session = None
+    if session_token:
+        session = (
+            {"error": "session_not_found"} if rejected
+            else _status_view(session_token, row, client_id, machine_id)
+        )
+    return {
+        "session": session,
+        "machine": machine,
+        "unit_price_paise": PRICE_PER_UNIT_PAISA,
+        "server_time": _now().isoformat(),
+    }
+
+
+async def cancel_session(
+    session_token: str, client_id: str, session: Optional[Dict] = None
+) -> Dict:
     """Explicitly cancel a session. Only the owner can cancel.
     Releases reserved stock if an order was created.
+    Pass `session` when the caller already fetched the row to skip a lookup.
     
     Returns: { "status": "cancelled" } or { "error": "..." }
     """
-    session = await get_session_by_token(session_token)
+    if session is None:
+        session = await get_session_by_token(session_token)
     if not session:
         return {"error": "session_not_found"}
 
@@ -296,6 +812,7 @@ async def cancel_session(session_token: str, client_id: str) -> Dict:
         data = db._res_data(res)
         if not data or (isinstance(data, list) and len(data) == 0):
             return {"error": "cancel_failed", "detail": "Session state changed"}
+        expiry_scheduler.cancel(session_id)
 
         # Release reserved stock if any orders exist for this session
         await _release_reserved_stock(session_id, machine_id)
@@ -361,8 +878,10 @@ async def create_order_record(
     client_id: str,
     quantity: int,
     amount: int,
+    speculative: bool = False,
 ) -> Optional[Dict]:
-    """Store the Razorpay order → session mapping for webhook reconciliation."""
+    """Store the Razorpay order → session mapping for webhook reconciliation.
+    `speculative`: pre-created at claim, not yet handed to the customer."""
     if not db.supabase:
         return None
 
@@ -376,6 +895,8 @@ async def create_order_record(
         # Stock is reserved at dispense trigger (post-payment), not order creation.
         "reserved_stock": False,
     }
+    if speculative:
+        payload["speculative"] = True
 
     def _insert():
         return db.supabase.table("orders").insert(payload).execute()
@@ -407,12 +928,268 @@ async def get_order_by_id(order_id: str) -> Optional[Dict]:
             return None
         return res.data[0]
 
-    try:
-        return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
-    except Exception as e:
-        print(f"Order lookup error for {order_id}: {e}")
+    try:
+        return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    except Exception as e:
+        print(f"Order lookup error for {order_id}: {e}")
+        return None
+
+
+async def adopt_speculative_order(session_id: str, quantity: int) -> Optional[Dict]:
+    """Hand the session's pre-created order for `quantity` to the customer.
+    One conditional update, so two workers can't both hand it out."""
+    if not db.supabase:
+        return None
+
+    def _adopt():
+        return (
+            db.supabase.table("orders")
+            .update({"speculative": False})
+            .eq("session_id", session_id)
+            .eq("quantity", quantity)
+            .eq("speculative", True)
+            .execute()
+        )
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_adopt))
+        rows = db._res_data(res)
+        if isinstance(rows, list):
+            return rows[0] if rows else None
+        return rows or None
+    except Exception as e:
+        print(f"Speculative order adopt error for session {session_id}: {e}")
+        return None
+
+
+async def discard_speculative_orders(session_id: str) -> int:
+    """Drop the session's unused pre-created orders. Their IDs never reached a
+    browser, so no payment can reference them; Razorpay lets them lapse."""
+    if not db.supabase or not session_id:
+        return 0
+
+    def _delete():
+        return (
+            db.supabase.table("orders")
+            .delete()
+            .eq("session_id", session_id)
+            .eq("speculative", True)
+            .execute()
+        )
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_delete))
+        rows = db._res_data(res)
+        return len(rows) if isinstance(rows, list) else int(bool(rows))
+    except Exception as e:
+        print(f"Speculative order discard error for session {session_id}: {e}")
+        return 0
+
+
+# ──────────────────────────────────────────────
+#  Webhook Events (migrations/008_webhook_events.sql)
+# ──────────────────────────────────────────────
+
+async def record_webhook_event(
+    event_id: str, event_type: str, order_id: Optional[str], payload: Dict
+) -> Optional[bool]:
+    """Persist a verified webhook event.
+    Returns True if new, False if event_id was already recorded, None on error."""
+    if not db.supabase:
+        return None
+
+    row = {
+        "event_id": event_id,
+        "event_type": event_type,
+        "order_id": order_id,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "received_at": _now().isoformat(),
+    }
+
+    def _insert():
+        return db.supabase.table("webhook_events").insert(row).execute()
+
+    try:
+        await asyncio.to_thread(lambda: db._retry_supabase_query(_insert))
+        return True
+    except Exception as e:
+        error_str = str(e).lower()
+        if "duplicate" in error_str or "unique" in error_str:
+            return False
+        print(f"Webhook event persist error for {event_id}: {e}")
+        return None
+
+
+async def claim_webhook_event(event_id: str, status: str = "pending", attempts: int = 0) -> bool:
+    """Take an event for processing (status → processing). Only one worker,
+    on any process, wins."""
+    if not db.supabase:
+        return False
+
+    def _claim():
+        return (
+            db.supabase.table("webhook_events")
+            .update({"status": "processing", "claimed_at": _now().isoformat(), "attempts": attempts + 1})
+            .eq("event_id", event_id)
+            .eq("status", status)
+            .eq("attempts", attempts)
+            .execute()
+        )
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_claim))
+        return bool(db._res_data(res))
+    except Exception as e:
+        print(f"Webhook event claim error for {event_id}: {e}")
+        return False
+
+
+async def finish_webhook_event(event_id: str, error: Optional[str] = None):
+    """Mark a claimed event processed (or failed, with the error)."""
+    if not db.supabase:
+        return
+
+    fields = {"status": "failed" if error else "processed", "processed_at": _now().isoformat()}
+    if error:
+        fields["error"] = error[:500]
+
+    def _update():
+        return db.supabase.table("webhook_events").update(fields).eq("event_id", event_id).execute()
+
+    try:
+        await asyncio.to_thread(lambda: db._retry_supabase_query(_update))
+    except Exception as e:
+        print(f"Webhook event update error for {event_id}: {e}")
+
+
+async def open_webhook_events(status: str, before_iso: str, limit: int = 100) -> List[Dict]:
+    """Events in `status` since before `before_iso` (pending: received_at,
+    processing: claimed_at), oldest first."""
+    if not db.supabase:
+        return []
+    column = "claimed_at" if status == "processing" else "received_at"
+
+    def _query():
+        res = (
+            db.supabase.table("webhook_events")
+            .select("*")
+            .eq("status", status)
+            .lt(column, before_iso)
+            .order(column)
+            .limit(limit)
+            .execute()
+        )
+        return res.data or []
+
+    try:
+        return await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    except Exception as e:
+        print(f"Webhook event scan error ({status}): {e}")
+        return []
+
+
+# ──────────────────────────────────────────────
+#  Payment Reconciliation (migrations/009_payment_reconciliation.sql)
+# ──────────────────────────────────────────────
+
+async def orders_after(
+    cursor_created_at: Optional[str], cursor_order_id: Optional[str], before_iso: str, limit: int
+) -> List[Dict]:
+    """Up to `limit` orders created before `before_iso`, strictly after the
+    (created_at, order_id) cursor, in that order."""
+    if not db.supabase:
+        return []
+
+    def _query(n):
+        q = db.supabase.table("orders").select("*").lt("created_at", before_iso)
+        if cursor_created_at:
+            q = q.gte("created_at", cursor_created_at)
+        return q.order("created_at").limit(n).execute().data or []
+
+    def _after_cursor(row):
+        if not cursor_created_at:
+            return True
+        key = (_parse_ts(row["created_at"]), row["order_id"])
+        return key > (_parse_ts(cursor_created_at), cursor_order_id or "")
+
+    # gte returns the cursor row again (and any created_at ties): over-fetch
+    n = limit + 1 if cursor_created_at else limit
+    while True:
+        rows = await asyncio.to_thread(lambda: db._retry_supabase_query(lambda: _query(n)))
+        fresh = [r for r in rows if _after_cursor(r)]
+        if len(fresh) >= limit or len(rows) < n:
+            fresh.sort(key=lambda r: (_parse_ts(r["created_at"]), r["order_id"]))
+            return fresh[:limit]
+        n *= 2
+
+
+async def existing_transaction_ids(transaction_ids: List[str]) -> Set[str]:
+    """The subset of transactions.id values that exist, in one query."""
+    if not db.supabase or not transaction_ids:
+        return set()
+
+    def _query():
+        res = db.supabase.table("transactions").select("id").in_("id", transaction_ids).execute()
+        return res.data or []
+
+    rows = await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    return {str(r["id"]) for r in rows}
+
+
+async def sessions_by_ids(session_ids: List[str]) -> Dict[str, Dict]:
+    """session id → row, in one query."""
+    ids = [i for i in set(session_ids) if i]
+    if not db.supabase or not ids:
+        return {}
+
+    def _query():
+        res = db.supabase.table("sessions").select("*").in_("id", ids).execute()
+        return res.data or []
+
+    rows = await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    return {str(r["id"]): r for r in rows}
+
+
+async def record_reconciliation(verdicts: List[Dict]):
+    """Upsert one row per order into payment_reconciliation."""
+    if not db.supabase or not verdicts:
+        return
+
+    def _upsert():
+        return db.supabase.table("payment_reconciliation").upsert(verdicts).execute()
+
+    await asyncio.to_thread(lambda: db._retry_supabase_query(_upsert))
+
+
+async def get_reconcile_checkpoint(job: str) -> Optional[Dict]:
+    if not db.supabase:
         return None
 
+    def _query():
+        res = db.supabase.table("reconciliation_checkpoints").select("*").eq("id", job).execute()
+        return res.data or []
+
+    rows = await asyncio.to_thread(lambda: db._retry_supabase_query(_query))
+    return rows[0] if rows else None
+
+
+async def save_reconcile_checkpoint(job: str, cursor_created_at: str, cursor_order_id: str):
+    if not db.supabase:
+        return
+    row = {
+        "id": job,
+        "cursor_created_at": cursor_created_at,
+        "cursor_order_id": cursor_order_id,
+        "updated_at": _now().isoformat(),
+    }
+
+    def _upsert():
+        return db.supabase.table("reconciliation_checkpoints").upsert(row).execute()
+
+    await asyncio.to_thread(lambda: db._retry_supabase_query(_upsert))
+
 
 # ──────────────────────────────────────────────
 #  Idempotency (replaces in-memory set)
@@ -576,9 +1353,62 @@ async def _release_reserved_stock(session_id: str, machine_id: str):
 #  Session Expiry Sweeper
 # ──────────────────────────────────────────────
 
-async def expire_stale_sessions() -> List[Dict]:
+async def expire_session(
+    session_id: str, machine_id: str, old_status: str, now_iso: Optional[str] = None
+) -> bool:
+    """Expire one session if it is still `old_status` and past its deadline.
+
+    Used by the expiry scheduler when a deadline fires and by the sweep below.
+    Returns False if the session moved on (claimed, renewed, already expired).
+    """
+    if not db.supabase:
+        return False
+
+    now_iso = now_iso or _now().isoformat()
+
+    def _expire():
+        return (
+            db.supabase.table("sessions")
+            .update({
+                "status": "expired",
+                "completed_at": now_iso,
+            })
+            .eq("id", session_id)
+            .eq("status", old_status)
+            .lt("expires_at", now_iso)
+            .execute()
+        )
+
+    res = await asyncio.to_thread(lambda: db._retry_supabase_query(_expire))
+    data = db._res_data(res)
+    if not data or (isinstance(data, list) and len(data) == 0):
+        return False  # Already expired by another worker, or state changed
+    expiry_scheduler.cancel(session_id)
+
+    # If was in_progress, release any reserved stock
+    if old_status == "in_progress":
+        await _release_reserved_stock(session_id, machine_id)
+
+    # Reset machine to idle
+    await db.update_machine_status(machine_id, "idle")
+
+    # Log event
+    await log_event(
+        machine_id=machine_id,
+        session_id=session_id,
+        event_type="session_expired",
+        payload={"old_status": old_status},
+    )
+    return True
+
+
+async def expire_stale_sessions(
+    owns: Optional[Callable[[str], bool]] = None,
+) -> List[Dict]:
     """Find and expire all sessions past their expires_at.
     
+    With `owns`, only machines for which owns(machine_id) is true are expired
+    (the worker's sweeper partition).
     Returns list of { machine_id, old_status, session_id } for each expired session.
     The caller should then create new sessions for these machines and notify ESP32s.
     """
@@ -608,42 +1438,11 @@ async def expire_stale_sessions() -> List[Dict]:
             machine_id = session["machine_id"]
             old_status = session["status"]
 
-            # Expire the session
-            def _make_expire(sid):
-                def _expire():
-                    return (
-                        db.supabase.table("sessions")
-                        .update({
-                            "status": "expired",
-                            "completed_at": now_iso,
-                        })
-                        .eq("id", sid)
-                        .in_("status", ["active", "in_progress"])
-                        .execute()
-                    )
-                return _expire
-
-            res = await asyncio.to_thread(
-                lambda sid=session_id: db._retry_supabase_query(_make_expire(sid))
-            )
-            data = db._res_data(res)
-            if not data or (isinstance(data, list) and len(data) == 0):
-                continue  # Already expired by another worker
-
-            # If was in_progress, release any reserved stock
-            if old_status == "in_progress":
-                await _release_reserved_stock(session_id, machine_id)
-
-            # Reset machine to idle
-            await db.update_machine_status(machine_id, "idle")
+            if owns and not owns(machine_id):
+                continue
 
-            # Log event
-            await log_event(
-                machine_id=machine_id,
-                session_id=session_id,
-                event_type="session_expired",
-                payload={"old_status": old_status},
-            )
+            if not await expire_session(session_id, machine_id, old_status, now_iso):
+                continue
 
             results.append({
                 "machine_id": machine_id,
@@ -658,18 +1457,34 @@ async def expire_stale_sessions() -> List[Dict]:
         return []
 
 
-async def expire_and_renew_sessions() -> List[Tuple[str, Dict]]:
+async def expire_and_renew_sessions(
+    renew: Optional[Callable[[str, str], Awaitable[Optional[Dict]]]] = None,
+    owns: Optional[Callable[[str], bool]] = None,
+    online: Optional[Callable[[str], bool]] = None,
+) -> List[Tuple[str, Dict]]:
     """Expire stale sessions AND create new ones for each machine.
     
+    `renew(machine_id, expired_session_id)` issues the replacement session;
+    defaults to a plain create_session (main.py routes it through the machine actor).
+    `owns` restricts the sweep to this worker's partition (see expire_stale_sessions).
+    `online` gates renewal: offline machines are expired once and get no new
+    session until they register again.
+
     Returns: List of (machine_id, new_session) tuples.
     The caller uses this to send new QR URLs to ESP32 devices.
     """
-    expired = await expire_stale_sessions()
+    expired = await expire_stale_sessions(owns=owns)
     renewed = []
 
     for item in expired:
         machine_id = item["machine_id"]
-        new_session = await create_session(machine_id)
+        if online and not online(machine_id):
+            metrics.incr("expiry_offline_skipped")
+            continue
+        if renew:
+            new_session = await renew(machine_id, item["session_id"])
+        else:
+            new_session = await next_idle_session(machine_id)
         if new_session:
             renewed.append((machine_id, new_session))
         else:
@@ -678,6 +1493,142 @@ async def expire_and_renew_sessions() -> List[Tuple[str, Dict]]:
     return renewed
 
 
+# ──────────────────────────────────────────────
+#  Dispensing Watchdog
+# ──────────────────────────────────────────────
+
+async def fail_dispense(
+    session_id: str, machine_id: str, now_iso: Optional[str] = None
+) -> Optional[Dict]:
+    """DISPENSING → FAILED once the motor timeout passed without a confirm.
+
+    Conditional like expire_session, so the expiry timer and the backstop sweep
+    can race safely. The payment stands: its transaction is marked
+    `dispense_timeout` for refund or review. The stock reserved at trigger stays
+    deducted (the motor may have run) and is flagged in the event for a count.
+
+    Returns { session_id, machine_id, transaction_id, quantity } or None if the
+    session moved on (confirmed, already failed).
+    """
+    if not db.supabase:
+        return None
+
+    now_iso = now_iso or _now().isoformat()
+
+    def _fail():
+        return (
+            db.supabase.table("sessions")
+            .update({"status": "failed", "completed_at": now_iso})
+            .eq("id", session_id)
+            .eq("status", "dispensing")
+            .lt("expires_at", now_iso)
+            .execute()
+        )
+
+    res = await asyncio.to_thread(lambda: db._retry_supabase_query(_fail))
+    rows = db._res_data(res)
+    if not rows:
+        return None
+    session = rows[0] if isinstance(rows, list) else rows
+    expiry_scheduler.cancel(session_id)
+
+    # Which sale was lost: pipelined sessions carry it, otherwise via the order
+    transaction_id = session.get("dispense_transaction_id")
+    quantity = session.get("dispense_quantity")
+
+    def _get_order():
+        res = (
+            db.supabase.table("orders")
+            .select("order_id, quantity")
+            .eq("session_id", session_id)
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+        )
+        return res.data[0] if res.data else None
+
+    if not transaction_id:
+        try:
+            order = await asyncio.to_thread(lambda: db._retry_supabase_query(_get_order))
+        except Exception as e:
+            print(f"Dispense timeout order lookup error for {session_id}: {e}")
+            order = None
+        if order:
+            transaction_id = order.get("order_id")
+            quantity = quantity or order.get("quantity")
+
+    if transaction_id:
+        tx_uuid = _transaction_uuid(transaction_id)
+
+        def _flag_tx():
+            return (
+                db.supabase.table("transactions")
+                .update({"payment_status": "dispense_timeout", "completed_at": now_iso})
+                .eq("id", tx_uuid)
+                .eq("payment_status", "paid")
+                .execute()
+            )
+
+        try:
+            await asyncio.to_thread(lambda: db._retry_supabase_query(_flag_tx))
+        except Exception as e:
+            print(f"Dispense timeout transaction update error for {transaction_id}: {e}")
+
+    await db.update_machine_status(machine_id, "idle")
+    metrics.incr("dispense_timeouts", machine_id=machine_id)
+    await log_event(
+        machine_id=machine_id,
+        session_id=session_id,
+        event_type="dispense_timeout",
+        payload={
+            "transaction_id": transaction_id,
+            "quantity": quantity,
+            "stock_unverified": quantity,
+        },
+    )
+    return {
+        "session_id": session_id,
+        "machine_id": machine_id,
+        "transaction_id": transaction_id,
+        "quantity": quantity,
+    }
+
+
+async def fail_stale_dispenses(
+    owns: Optional[Callable[[str], bool]] = None,
+) -> List[Dict]:
+    """Backstop sweep for the dispensing watchdog (timers on another worker or lost
+    in a restart). Returns fail_dispense() results for this worker's machines."""
+    if not db.supabase:
+        return []
+
+    now_iso = _now().isoformat()
+
+    def _find_stuck():
+        res = (
+            db.supabase.table("sessions")
+            .select("id, machine_id")
+            .eq("status", "dispensing")
+            .lt("expires_at", now_iso)
+            .execute()
+        )
+        return res.data if res.data else []
+
+    try:
+        stuck = await asyncio.to_thread(lambda: db._retry_supabase_query(_find_stuck))
+        failed = []
+        for session in stuck:
+            if owns and not owns(session["machine_id"]):
+                continue
+            result = await fail_dispense(session["id"], session["machine_id"], now_iso)
+            if result:
+                failed.append(result)
+        return failed
+    except Exception as e:
+        print(f"Dispensing watchdog sweep error: {e}")
+        return []
+
+
 # ──────────────────────────────────────────────
 #  Dispense Flow
 # ──────────────────────────────────────────────
@@ -697,12 +1648,40 @@ async def trigger_dispense_session(
         Success: { "status": "ok", "session": {...}, "machine_id": "..." }
         Error: { "error": "..." }
     """
+    tx_uuid = _transaction_uuid(transaction_id)
+
+    # The procedures implement the one-live-session flow; pipelined mode
+    # (queue behind a busy motor) runs the step-by-step path below.
+    try:
+        result = None if SESSION_PIPELINE_ENABLED else await _call_procedure("sv_trigger_dispense", {
+            "p_session_token": session_token,
+            "p_client_id": client_id,
+            "p_quantity": int(quantity),
+            "p_tx_id": tx_uuid,
+            "p_transaction_id": str(transaction_id),
+            "p_amount": int(amount),
+            "p_order_id": order_id,
+            "p_motor_timeout_seconds": MOTOR_TIMEOUT_SECONDS,
+        })
+    except Exception as e:
+        print(f"Dispense procedure error: {e}")
+        return {"error": "transaction_failed"}
+    if result is not None:
+        if result.get("status") == "ok":
+            # Dispensing watchdog: fires at the motor timeout unless confirmed
+            expiry_scheduler.schedule({
+                **(result.get("session") or {}),
+                "status": "dispensing",
+                "expires_at": (_now() + timedelta(seconds=MOTOR_TIMEOUT_SECONDS)).isoformat(),
+            })
+        return result
+
     session = await get_session_by_token(session_token)
     if not session:
         return {"error": "session_not_found"}
 
     status = session.get("status")
-    if status in ("dispensing", "completed"):
+    if status in ("queued", "dispensing", "completed"):
         # Race condition safety: the webhook already triggered dispense.
         # Returning this exact error acts as a "SUCCESS" signal to frontend.
         return {"error": "already_processed", "status": "duplicate"}
@@ -761,12 +1740,6 @@ async def trigger_dispense_session(
             }
 
     # DB-level idempotency check: does a transaction already exist for this session?
-    import uuid
-    try:
-        tx_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, str(transaction_id)))
-    except Exception:
-        tx_uuid = str(uuid.uuid4())
-
     def _check_existing_tx():
         res = (
             db.supabase.table("transactions")
@@ -819,9 +1792,13 @@ async def trigger_dispense_session(
         print(f"Transaction insert error: {e}")
         return {"error": "transaction_failed"}
 
+    if SESSION_PIPELINE_ENABLED:
+        return await _queue_dispense(session, client_id, transaction_id, quantity)
+
     # Transition session to DISPENSING
     dispense_expires = (_now() + timedelta(seconds=MOTOR_TIMEOUT_SECONDS)).isoformat()
     await update_session_status(session_id, "dispensing", {"expires_at": dispense_expires})
+    expiry_scheduler.schedule({**session, "status": "dispensing", "expires_at": dispense_expires})
 
     # Update machine status
     await db.update_machine_status(machine_id, "dispensing")
@@ -843,30 +1820,112 @@ async def trigger_dispense_session(
     }
 
 
-async def complete_session(
-    machine_id: str, transaction_id: str, dispensed: int
+async def _queue_dispense(
+    session: Dict, client_id: str, transaction_id: str, quantity: int
 ) -> Dict:
-    """Complete a dispensing session: mark transaction done, complete session,
-    create new session, handle low stock alert.
-    
-    Returns: { "status": "completed", "new_session": {...}, "low_stock": bool }
+    """Pipelined mode: park a paid sale as QUEUED, then start the motor if it is free.
+
+    Stock and the transaction are already committed, in payment order. The
+    result carries "dispense": the session the motor should run now (this one,
+    or None if it waits behind the current dispense).
     """
-    session = await get_active_session_for_machine(machine_id)
-    if not session:
-        return {"error": "no_active_session"}
+    session_id = session.get("id")
+    machine_id = session.get("machine_id")
 
-    if session.get("status") != "dispensing":
-        return {"error": "not_dispensing", "detail": f"Session is {session.get('status')}"}
+    await update_session_status(session_id, "queued", {
+        "queued_at": _now().isoformat(),
+        "dispense_transaction_id": str(transaction_id),
+        "dispense_quantity": int(quantity),
+    })
+    expiry_scheduler.cancel(session_id)
 
-    session_id = session.get("id")
+    await log_event(
+        machine_id=machine_id,
+        session_id=session_id,
+        event_type="dispense_triggered",
+        client_id=client_id,
+        payload={"transaction_id": transaction_id, "quantity": quantity, "queued": True},
+    )
+
+    started = await start_next_dispense(machine_id)
+    return {
+        "status": "ok",
+        "session": session,
+        "machine_id": machine_id,
+        "transaction_id": transaction_id,
+        "queued": not started or str(started.get("id")) != str(session_id),
+        "dispense": started,
+    }
+
+
+async def start_next_dispense(machine_id: str) -> Optional[Dict]:
+    """Move the machine's oldest QUEUED sale to DISPENSING if the motor is free.
+
+    The dispensing unique index makes this safe to call from both the trigger
+    and the completion path. Returns the promoted session (the caller sends its
+    dispense command), or None if the motor is busy, the queue is empty, or
+    another caller promoted it first.
+    """
+    if not db.supabase:
+        return None
+
+    def _oldest():
+        res = (
+            db.supabase.table("sessions")
+            .select("*")
+            .eq("machine_id", machine_id)
+            .eq("status", "queued")
+            .order("queued_at")
+            .limit(1)
+            .execute()
+        )
+        return res.data[0] if res.data else None
 
-    # Update transaction
-    import uuid
     try:
-        tx_uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, str(transaction_id)))
-    except Exception:
-        tx_uuid = str(uuid.uuid4())
+        head = await asyncio.to_thread(lambda: db._retry_supabase_query(_oldest))
+    except Exception as e:
+        print(f"Dispense queue lookup error for {machine_id}: {e}")
+        return None
+    if not head:
+        return None
+
+    dispense_expires = (_now() + timedelta(seconds=MOTOR_TIMEOUT_SECONDS)).isoformat()
+
+    def _promote():
+        return (
+            db.supabase.table("sessions")
+            .update({"status": "dispensing", "expires_at": dispense_expires})
+            .eq("id", head["id"])
+            .eq("status", "queued")
+            .execute()
+        )
+
+    try:
+        res = await asyncio.to_thread(lambda: db._retry_supabase_query(_promote))
+    except Exception as e:
+        if "duplicate" not in str(e).lower() and "unique" not in str(e).lower():
+            print(f"Dispense promote error for {machine_id}: {e}")
+        return None  # Motor busy: the running dispense promotes it on completion
+    rows = db._res_data(res)
+    if not rows:
+        return None  # Promoted by a concurrent caller
+    started = rows[0] if isinstance(rows, list) else rows
+    expiry_scheduler.schedule(started)
+
+    await db.update_machine_status(machine_id, "dispensing")
+    await log_event(
+        machine_id=machine_id,
+        session_id=started.get("id"),
+        event_type="dispense_started",
+        payload={
+            "transaction_id": started.get("dispense_transaction_id"),
+            "quantity": started.get("dispense_quantity"),
+        },
+    )
+    return started
+
 
+async def _complete_transaction(tx_uuid: str, dispensed: int):
     def _update_tx():
         return (
             db.supabase.table("transactions")
@@ -884,8 +1943,60 @@ async def complete_session(
     except Exception as e:
         print(f"Transaction update error: {e}")
 
+
+async def complete_session(
+    machine_id: str, transaction_id: str, dispensed: int
+) -> Dict:
+    """Complete a dispensing session: mark transaction done, complete session,
+    create new session, handle low stock alert.
+    
+    Returns: { "status": "completed", "new_session": {...}, "low_stock": bool }
+    The step-by-step path also reports the completed "session_id".
+    In pipelined mode also "dispense": the next queued sale now on the motor (or None).
+    """
+    tx_uuid = _transaction_uuid(transaction_id)
+
+    try:
+        result = None if SESSION_PIPELINE_ENABLED else await _call_procedure("sv_complete_session", {
+            "p_machine_id": machine_id,
+            "p_tx_id": tx_uuid,
+            "p_transaction_id": str(transaction_id),
+            "p_dispensed": int(dispensed),
+            # NULL: totp rotation mode, the device shows a derived token next
+            "p_new_token": None if session_tokens.enabled() else _new_session_token(machine_id),
+            "p_session_ttl_seconds": ttl_policy.ttl_for(machine_id),
+        })
+    except Exception as e:
+        print(f"Complete procedure error for {machine_id}: {e}")
+        return {"error": "complete_failed"}
+    if result is not None:
+        if result.get("status") == "completed":
+            if session_tokens.enabled():
+                result["new_session"] = await unused_rotating_session(machine_id)
+            elif result.get("new_session"):
+                # The pre-purchase successor is stale; pre-issue one for the new session
+                await _discard_pending(machine_id)
+                result["new_session"]["next"] = await issue_successor(result["new_session"])
+        expiry_scheduler.schedule(result.get("new_session"))
+        return result
+
+    if SESSION_PIPELINE_ENABLED:
+        session = await get_dispensing_session(machine_id)
+    else:
+        session = await get_active_session_for_machine(machine_id)
+    if not session:
+        return {"error": "no_active_session"}
+
+    if session.get("status") != "dispensing":
+        return {"error": "not_dispensing", "detail": f"Session is {session.get('status')}"}
+
+    session_id = session.get("id")
+
+    await _complete_transaction(tx_uuid, dispensed)
+
     # Complete the session
     await update_session_status(session_id, "completed")
+    expiry_scheduler.cancel(session_id)
 
     # Check low stock
     low_stock = False
@@ -910,14 +2021,19 @@ async def complete_session(
     except Exception:
         pass
 
-    # Reset machine to idle
-    if remaining <= 0:
-        await db.update_machine_status(machine_id, "Unavailable")
-    else:
-        await db.update_machine_status(machine_id, "idle")
+    # Pipelined: the motor takes the next paid sale (status set to dispensing)
+    started = await start_next_dispense(machine_id) if SESSION_PIPELINE_ENABLED else None
+
+    # Reset machine to idle (unless the motor just took the next sale)
+    if not started:
+        await db.update_machine_status(machine_id, "Unavailable" if remaining <= 0 else "idle")
 
-    # Create new session for this machine
-    new_session = await create_session(machine_id)
+    # Create new session for this machine (pipelined: keep the one already on screen)
+    front = await get_front_session(machine_id) if SESSION_PIPELINE_ENABLED else None
+    if front:
+        new_session = front if front.get("status") == "active" else None
+    else:
+        new_session = await next_idle_session(machine_id)
 
     # Log event
     await log_event(
@@ -931,12 +2047,116 @@ async def complete_session(
         },
     )
 
-    return {
+    result = {
         "status": "completed",
+        "session_id": session_id,
         "new_session": new_session,
         "low_stock": low_stock,
         "remaining_stock": remaining,
     }
+    if SESSION_PIPELINE_ENABLED:
+        result["dispense"] = started
+    return result
+
+
+async def confirm_batch(machine_id: str, items: List[Dict]) -> Dict:
+    """Apply a device's replayed confirmations ({transaction_id, dispensed}), in order.
+
+    Returns { "status": "ok", "results": [{transaction_id, status | error,
+    session_id}], "completed", "new_session", "low_stock", "remaining_stock" }.
+    Transactions already completed come back as "duplicate". Ones unknown or
+    belonging to another machine come back as "tx_not_found". The machine's
+    dispensing session is completed by the first pending item; later items
+    only mark their transaction. In pipelined mode also "dispense", as in
+    complete_session.
+    """
+    entries = [
+        {
+            "tx_id": _transaction_uuid(item["transaction_id"]),
+            "transaction_id": str(item["transaction_id"]),
+            "dispensed": int(item.get("dispensed") or 0),
+        }
+        for item in items
+    ]
+
+    try:
+        result = None if SESSION_PIPELINE_ENABLED else await _call_procedure("sv_confirm_batch", {
+            "p_machine_id": machine_id,
+            "p_items": entries,
+            "p_new_token": None if session_tokens.enabled() else _new_session_token(machine_id),
+            "p_session_ttl_seconds": ttl_policy.ttl_for(machine_id),
+        }, own_migration=True)
+    except Exception as e:
+        print(f"Confirm batch procedure error for {machine_id}: {e}")
+        return {"error": "confirm_failed"}
+    if result is not None:
+        for r in result.get("results") or []:
+            if r.get("session_id"):
+                expiry_scheduler.cancel(str(r["session_id"]))
+        if result.get("completed"):
+            if session_tokens.enabled():
+                result["new_session"] = await unused_rotating_session(machine_id)
+            elif result.get("new_session"):
+                await _discard_pending(machine_id)
+                result["new_session"]["next"] = await issue_successor(result["new_session"])
+        expiry_scheduler.schedule(result.get("new_session"))
+        return result
+
+    # Step by step: one read for every transaction, then complete_session per item
+    def _txs():
+        res = (
+            db.supabase.table("transactions")
+            .select("id, machine_id, payment_status")
+            .in_("id", [e["tx_id"] for e in entries])
+            .execute()
+        )
+        return res.data or []
+
+    try:
+        rows = await asyncio.to_thread(lambda: db._retry_supabase_query(_txs))
+    except Exception as e:
+        print(f"Confirm batch lookup error for {machine_id}: {e}")
+        return {"error": "confirm_failed"}
+    txs = {str(r["id"]): r for r in rows}
+
+    results: List[Dict] = []
+    last: Optional[Dict] = None
+    for e in entries:
+        tx = txs.get(e["tx_id"])
+        if not tx or tx.get("machine_id") != machine_id:
+            results.append({"transaction_id": e["transaction_id"], "error": "tx_not_found"})
+            continue
+        if tx.get("payment_status") == "completed":
+            results.append({"transaction_id": e["transaction_id"], "status": "duplicate"})
+            continue
+        done = await complete_session(machine_id, e["transaction_id"], e["dispensed"])
+        if done.get("error") in ("no_active_session", "not_dispensing"):
+            # The dispensing session was already completed by an earlier item
+            await _complete_transaction(e["tx_id"], e["dispensed"])
+            done = {"status": "completed"}
+        elif done.get("error"):
+            results.append({"transaction_id": e["transaction_id"], "error": done["error"]})
+            continue
+        else:
+            last = done
+        tx["payment_status"] = "completed"
+        results.append({
+            "transaction_id": e["transaction_id"],
+            "status": "completed",
+            "session_id": done.get("session_id"),
+        })
+
+    result = {
+        "status": "ok",
+        "results": results,
+        "completed": sum(1 for r in results if r.get("status") == "completed"),
+        "new_session": (last or {}).get("new_session"),
+        "low_stock": bool((last or {}).get("low_stock")),
+        "remaining_stock": (last or {}).get("remaining_stock"),
+    }
+    if SESSION_PIPELINE_ENABLED:
+        result["dispense"] = (last or {}).get("dispense")
+    return result
 
 
 # ──────────────────────────────────────────────
@@ -947,10 +2167,10 @@ async def register_machine_session(machine_id: str, api_key: str) -> Dict:
     """Called when ESP32 registers via WebSocket.
     1. Upsert machine record
     2. Expire any stale session for this machine
-    3. Create a fresh active session
+    3. Create a fresh active session (totp mode: derive it, no row)
     4. Return session info for QR generation
     
-    Returns: { "session_token": "...", "url": "...", "expires_at": "..." }
+    Returns: { "session_token": "...", "url": "...", "expires_at": "...", "session": {...} }
     """
     from config import FRONTEND_URL
 
@@ -978,14 +2198,16 @@ async def register_machine_session(machine_id: str, api_key: str) -> Dict:
 
         try:
             await asyncio.to_thread(lambda: db._retry_supabase_query(_force_expire))
+            expiry_scheduler.cancel(existing_id)
             # Release stock if it was in_progress with orders
             if old_status == "in_progress":
                 await _release_reserved_stock(existing_id, machine_id)
         except Exception as e:
             print(f"Force-expire existing session error: {e}")
+    await _discard_pending(machine_id)
 
     # 3. Create new active session
-    new_session = await create_session(machine_id)
+    new_session = await next_idle_session(machine_id)
     if not new_session:
         return {"error": "session_creation_failed"}
 
@@ -993,18 +2215,20 @@ async def register_machine_session(machine_id: str, api_key: str) -> Dict:
     base_url = FRONTEND_URL or "https://smartvend.onrender.com"
     url = f"{base_url}/vend/{machine_id}/{token}"
 
-    # 4. Log event
-    await log_event(
-        machine_id=machine_id,
-        session_id=new_session.get("id"),
-        event_type="session_created",
-        payload={"trigger": "esp32_register"},
-    )
+    # 4. Log event (derived-token sessions are logged when materialized on claim)
+    if new_session.get("id"):
+        await log_event(
+            machine_id=machine_id,
+            session_id=new_session.get("id"),
+            event_type="session_created",
+            payload={"trigger": "esp32_register"},
+        )
 
     return {
         "session_token": token,
         "url": url,
         "expires_at": new_session.get("expires_at"),
+        "session": new_session,
     }
 
 
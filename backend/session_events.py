@@ -0,0 +1,158 @@
+"""
+SmartVend v3.0 — Session Event Stream
+=====================================
+Pushes session transitions to browsers over Server-Sent Events
+(GET /api/session/events).
+
+The vending page used to learn about dispensing, expiry and completion by
+polling, and every poll was a database read. main.py now publishes each
+transition it already performs as a small delta:
+
+    { "session_id", "machine_id", "status", "at", ...extras }
+
+Statuses are claimed → in_progress, queued, dispensing, completed, expired,
+cancelled and failed. Each worker fans events out to its own subscribers and
+relays them through Redis (channel `session:events`) to the others. Relayed
+messages carry the origin worker's ID, so a worker drops its own echo, the
+same as `ws:commands`.
+
+The procedure path of sv_complete_session does not report which session it
+completed. Such events carry no session_id and reach this machine's
+subscribers whose session is currently in one of `from_statuses`.
+"""
+
+import asyncio
+import contextlib
+import json
+from typing import AsyncIterator, Dict, Iterable, Optional, Set
+
+import clock
+import metrics
+import presence
+
+CHANNEL = "session:events"
+KEEPALIVE_SECONDS = 15
+TERMINAL_STATUSES = ("completed", "expired", "cancelled", "failed")
+# Per-subscriber buffer; a client this far behind only needs the latest state
+_QUEUE_SIZE = 16
+
+
+class _Subscriber:
+    __slots__ = ("session_id", "machine_id", "status", "queue")
+
+    def __init__(self, session_id: str, machine_id: str, status: Optional[str]):
+        self.session_id = session_id
+        self.machine_id = machine_id
+        self.status = status
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=_QUEUE_SIZE)
+
+
+# machine_id → subscribers on this worker
+_subscribers: Dict[str, Set[_Subscriber]] = {}
+_redis = None
+
+
+def attach(redis_client):
+    """Relay events through `redis_client` (None: this worker only)."""
+    global _redis
+    _redis = redis_client
+
+
+def subscribe(session_id: str, machine_id: str, status: Optional[str] = None) -> _Subscriber:
+    sub = _Subscriber(session_id, machine_id, status)
+    _subscribers.setdefault(machine_id, set()).add(sub)
+    metrics.incr("session_event_subscriptions")
+    return sub
+
+
+def unsubscribe(sub: _Subscriber):
+    subs = _subscribers.get(sub.machine_id)
+    if subs is not None:
+        subs.discard(sub)
+        if not subs:
+            _subscribers.pop(sub.machine_id, None)
+
+
+def subscriber_count() -> int:
+    return sum(len(s) for s in _subscribers.values())
+
+
+def deliver(event: Dict) -> int:
+    """Hand `event` to this worker's matching subscribers. Returns how many."""
+    session_id = event.get("session_id")
+    from_statuses = event.get("from_statuses")
+    delivered = 0
+    for sub in list(_subscribers.get(event.get("machine_id"), ())):
+        if session_id:
+            if sub.session_id != session_id:
+                continue
+        elif not from_statuses or sub.status not in from_statuses:
+            continue
+        sub.status = event.get("status")
+        if sub.queue.full():
+            with contextlib.suppress(asyncio.QueueEmpty):
+                sub.queue.get_nowait()
+        sub.queue.put_nowait(event)
+        delivered += 1
+    return delivered
+
+
+async def publish(
+    machine_id: Optional[str],
+    status: str,
+    session_id: Optional[str] = None,
+    from_statuses: Optional[Iterable[str]] = None,
+    **extra,
+):
+    """Push a session transition to its browsers on every worker. Best-effort."""
+    if not machine_id or (not session_id and not from_statuses):
+        return
+    event = {
+        "session_id": session_id,
+        "machine_id": machine_id,
+        "status": status,
+        "at": clock.now().isoformat(),
+        **{k: v for k, v in extra.items() if v is not None},
+    }
+    if from_statuses:
+        event["from_statuses"] = list(from_statuses)
+    deliver(event)
+    metrics.incr("session_events_published", status=status)
+
+    if _redis:
+        try:
+            await _redis.publish(CHANNEL, json.dumps({**event, "origin": presence.ORIGIN_ID}))
+        except Exception as e:
+            print(f"Session event publish failed: {e}")
+
+
+def deliver_remote(message: Dict):
+    """Redis listener entry point: deliver another worker's event."""
+    if message.get("origin") == presence.ORIGIN_ID:
+        return
+    event = {k: v for k, v in message.items() if k != "origin"}
+    deliver(event)
+
+
+def _frame(event: Dict) -> str:
+    body = {k: v for k, v in event.items() if k != "from_statuses"}
+    return f"event: status\ndata: {json.dumps(body, default=str)}\n\n"
+
+
+async def stream(sub: _Subscriber, initial: Dict) -> AsyncIterator[str]:
+    """SSE frames: the current state, then each delta, until a terminal status."""
+    try:
+        yield "retry: 3000\n\n" + _frame(initial)
+        if initial.get("status") in TERMINAL_STATUSES:
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(sub.queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _frame(event)
+            if event.get("status") in TERMINAL_STATUSES:
+                return
+    finally:
+        unsubscribe(sub)
@@ -0,0 +1,114 @@
+"""
+SmartVend v3.0 — Rotating Session Tokens
+========================================
+Stateless, time-derived QR tokens (SESSION_ROTATION_MODE=totp).
+
+In the default "db" mode, every QR rotation is a session row: the old one is
+expired, a new one inserted, the machine row and events updated, and the new
+token pushed over the WebSocket, even for machines nobody scans.
+
+In "totp" mode the token for a machine is derived from a per-machine secret
+and the current time window, much like TOTP:
+
+    secret = HMAC-SHA256(SESSION_TOKEN_SECRET, "sv-rotation:" + machine_id)
+    digest = HMAC-SHA256(secret, machine_id + ":" + str(window) [+ ":" + str(seq)])
+    token  = "".join(BASE62[b % 62] for b in digest[:length])
+    window = floor(unix_time / SESSION_TTL_SECONDS)
+
+The ESP32 gets its secret once at an authenticated register and renders the
+seq-0 code of each window locally. A claimed code has a session row, so after
+a purchase or cancel the backend pushes the window's next unused seq (at most
+SEQS_PER_WINDOW); the device shows it until the window rolls over. The backend
+checks a scanned token against the current and previous window, and only
+writes a session row when someone claims it.
+"""
+
+import hashlib
+import hmac
+import string
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import clock
+from config import SESSION_ROTATION_MODE, SESSION_TOKEN_SECRET, SESSION_TTL_SECONDS
+
+# Longer than the 4-char random tokens: derived tokens repeat across
+# machines and windows, so keep collisions negligible.
+ROTATING_TOKEN_LENGTH = 6
+# Windows accepted behind the current one (scan just before a rotation, clock skew)
+ACCEPT_PREVIOUS_WINDOWS = 1
+# Codes per window: one per purchase or cancel within it
+SEQS_PER_WINDOW = 16
+
+_BASE62 = string.ascii_letters + string.digits
+
+
+def enabled() -> bool:
+    return SESSION_ROTATION_MODE == "totp" and bool(SESSION_TOKEN_SECRET)
+
+
+def machine_secret(machine_id: str) -> bytes:
+    return hmac.new(
+        SESSION_TOKEN_SECRET.encode("utf-8"),
+        f"sv-rotation:{machine_id}".encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
+
+
+def window_at(ts: float, window_seconds: int = SESSION_TTL_SECONDS) -> int:
+    return int(ts // window_seconds)
+
+
+def derive_token(
+    secret: bytes, machine_id: str, window: int, length: int = ROTATING_TOKEN_LENGTH, seq: int = 0
+) -> str:
+    message = f"{machine_id}:{window}" if seq == 0 else f"{machine_id}:{window}:{seq}"
+    digest = hmac.new(secret, message.encode("utf-8"), hashlib.sha256).digest()
+    return "".join(_BASE62[b % len(_BASE62)] for b in digest[:length])
+
+
+def current_token(machine_id: str, now: Optional[float] = None, seq: int = 0) -> Dict:
+    """Token `seq` of the current window: { token, window, seq, expires_at }."""
+    now = clock.time() if now is None else now
+    window = window_at(now)
+    expires_at = datetime.fromtimestamp((window + 1) * SESSION_TTL_SECONDS, tz=timezone.utc)
+    return {
+        "token": derive_token(machine_secret(machine_id), machine_id, window, seq=seq),
+        "window": window,
+        "seq": seq,
+        "expires_at": expires_at.isoformat(),
+    }
+
+
+def window_tokens(machine_id: str, now: Optional[float] = None) -> List[str]:
+    """Every token of the current window, in seq order."""
+    now = clock.time() if now is None else now
+    secret = machine_secret(machine_id)
+    window = window_at(now)
+    return [derive_token(secret, machine_id, window, seq=seq) for seq in range(SEQS_PER_WINDOW)]
+
+
+def match_window(machine_id: str, token: str, now: Optional[float] = None) -> Optional[int]:
+    """Window in which `token` is valid for machine_id, or None."""
+    if not enabled() or not token or len(token) != ROTATING_TOKEN_LENGTH:
+        return None
+    now = clock.time() if now is None else now
+    secret = machine_secret(machine_id)
+    window = window_at(now)
+    for w in range(window, window - ACCEPT_PREVIOUS_WINDOWS - 1, -1):
+        for seq in range(SEQS_PER_WINDOW):
+            if hmac.compare_digest(derive_token(secret, machine_id, w, seq=seq), token):
+                return w
+    return None
+
+
+def rotation_params(machine_id: str, url_prefix: str) -> Dict:
+    """What the ESP32 needs to render codes locally (authenticated register reply only)."""
+    return {
+        "mode": "totp",
+        "secret": machine_secret(machine_id).hex(),
+        "window": SESSION_TTL_SECONDS,
+        "length": ROTATING_TOKEN_LENGTH,
+        "server_time": int(clock.time()),
+        "url_prefix": url_prefix,
+    }
@@ -0,0 +1,145 @@
+"""
+SmartVend v3.0 — Signed Session Tokens
+======================================
+Self-verifying QR tokens (SESSION_TOKEN_FORMAT=signed).
+
+The default 4-char random token carries no information, so `/s/{token}`,
+claim and status must all ask the database whether it exists, including for
+typos, stale screenshots and scanners walking the keyspace. A signed token
+carries the machine slot, its issue minute and a short MAC:
+
+    payload = slot(2) | minute(2) | nonce(2)        big-endian
+    slot    = first 2 bytes of md5(machine_id)
+    minute  = floor(unix_time / 60) mod 2^16
+    mac     = HMAC-SHA256(SESSION_TOKEN_SECRET, "sv-token:" + payload)[:3]
+    token   = base62(payload + mac), fixed 13 chars
+
+Forged tokens and tokens issued longer ago than any session can live are
+rejected in memory. Each worker remembers slot → machine_id for the machines
+it issues or looks up tokens for, so `/s/` can usually redirect without a
+lookup. 13 chars still leaves a short `/s/` URL in a low QR version.
+"""
+
+import hashlib
+import hmac
+import secrets
+import string
+from typing import Dict, Optional, Set
+
+import clock
+import metrics
+import session_tokens
+from config import SESSION_TOKEN_FORMAT, SESSION_TOKEN_SECRET
+
+TOKEN_LENGTH = 13
+_PAYLOAD_BYTES = 6
+_MAC_BYTES = 3
+_MINUTES_MOD = 1 << 16
+# Tokens stamped up to this many minutes ahead of us still pass (clock skew)
+_FUTURE_SKEW_MINUTES = 1
+
+_BASE62 = string.ascii_letters + string.digits
+_BASE62_INDEX = {c: i for i, c in enumerate(_BASE62)}
+_MAX_VALUE = 1 << (8 * (_PAYLOAD_BYTES + _MAC_BYTES))
+
+# slot → machine ids seen by this worker (more than one only on a hash collision)
+_slots: Dict[int, Set[str]] = {}
+
+
+def enabled() -> bool:
+    return SESSION_TOKEN_FORMAT == "signed" and bool(SESSION_TOKEN_SECRET)
+
+
+def machine_slot(machine_id: str) -> int:
+    return int.from_bytes(hashlib.md5(machine_id.encode("utf-8")).digest()[:2], "big")
+
+
+def _mac(payload: bytes) -> bytes:
+    return hmac.new(
+        SESSION_TOKEN_SECRET.encode("utf-8"), b"sv-token:" + payload, hashlib.sha256
+    ).digest()[:_MAC_BYTES]
+
+
+def _encode(raw: bytes) -> str:
+    value = int.from_bytes(raw, "big")
+    chars = []
+    for _ in range(TOKEN_LENGTH):
+        value, rem = divmod(value, len(_BASE62))
+        chars.append(_BASE62[rem])
+    return "".join(reversed(chars))
+
+
+def _decode(token: str) -> Optional[bytes]:
+    value = 0
+    for c in token:
+        digit = _BASE62_INDEX.get(c)
+        if digit is None:
+            return None
+        value = value * len(_BASE62) + digit
+    if value >= _MAX_VALUE:
+        return None
+    return value.to_bytes(_PAYLOAD_BYTES + _MAC_BYTES, "big")
+
+
+def remember(machine_id: Optional[str]):
+    if machine_id:
+        _slots.setdefault(machine_slot(machine_id), set()).add(machine_id)
+
+
+def issue(machine_id: str, now: Optional[float] = None) -> str:
+    now = clock.time() if now is None else now
+    minute = int(now // 60) % _MINUTES_MOD
+    payload = (
+        machine_slot(machine_id).to_bytes(2, "big")
+        + minute.to_bytes(2, "big")
+        + secrets.token_bytes(2)
+    )
+    remember(machine_id)
+    return _encode(payload + _mac(payload))
+
+
+def verify(token: str, max_age_seconds: int, now: Optional[float] = None) -> Optional[Dict]:
+    """{ slot, age_seconds } if `token` is genuine and young enough, else None."""
+    if not token or len(token) != TOKEN_LENGTH:
+        return None
+    raw = _decode(token)
+    if raw is None:
+        return None
+    payload, mac = raw[:_PAYLOAD_BYTES], raw[_PAYLOAD_BYTES:]
+    if not hmac.compare_digest(_mac(payload), mac):
+        return None
+    now = clock.time() if now is None else now
+    minute = int.from_bytes(payload[2:4], "big")
+    # Signed distance on the 16-bit minute ring (wraps every ~45 days)
+    age = (int(now // 60) - minute + _MINUTES_MOD // 2) % _MINUTES_MOD - _MINUTES_MOD // 2
+    if age < -_FUTURE_SKEW_MINUTES or (age - 1) * 60 > max_age_seconds:
+        return None
+    return {"slot": int.from_bytes(payload[:2], "big"), "age_seconds": max(0, age) * 60}
+
+
+def rejects(token: str, max_age_seconds: int) -> bool:
+    """True if `token` cannot be a live session token, decided without I/O.
+
+    With signed tokens on, only signed tokens (and derived rotating tokens,
+    when that mode is on too) can exist. Random short tokens still in flight
+    when the format is switched on are rejected.
+    """
+    if not enabled():
+        return False
+    if session_tokens.enabled() and token and len(token) == session_tokens.ROTATING_TOKEN_LENGTH:
+        return False
+    if verify(token, max_age_seconds) is not None:
+        return False
+    metrics.incr("tokens_rejected_in_memory")
+    return True
+
+
+def machine_for(token: str) -> Optional[str]:
+    """machine_id for a verified token, if this worker knows its slot unambiguously."""
+    raw = _decode(token) if token and len(token) == TOKEN_LENGTH else None
+    if raw is None:
+        return None
+    machines = _slots.get(int.from_bytes(raw[:2], "big"))
+    if machines and len(machines) == 1:
+        return next(iter(machines))
+    return None
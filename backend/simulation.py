@@ -0,0 +1,527 @@
+"""
+SmartVend v3.0 — Lifecycle Simulation
+=====================================
+Runs days of QR rotation, claim, expiry and dispense for a simulated fleet
+in seconds, on virtual time (clock.VirtualClock) against an in-memory store.
+
+The real `session_db` code runs unchanged. `database.supabase` is swapped for
+`InMemorySupabase`, which implements the subset of the PostgREST query builder
+that session_db uses, enforces the sessions unique indexes, and counts every
+operation per table. Deadlines are processed the way main.py's expiry timer
+does (expire / fail, then renew). Customers arrive per machine as a Poisson
+process.
+
+    python simulation.py --machines 20 --days 2 --arrivals-per-hour 6
+
+The report gives lifecycle counts and database operations, total and per
+machine-day, which is the number that rotation changes (TTL policy, totp,
+presence gating) are meant to move.
+"""
+
+import argparse
+import asyncio
+import copy
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+import clock
+import database as db
+import session_db
+from config import SESSION_PIPELINE_ENABLED
+
+# Seconds the motor runs per unit (matches the ESP32's BASE_RUN_TIME)
+MOTOR_SECONDS_PER_UNIT = 4
+
+
+# ──────────────────────────────────────────────
+#  In-memory PostgREST stand-in
+# ──────────────────────────────────────────────
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+def _unique_groups() -> List[tuple]:
+    # Mirrors migrations 001 / 004 (pipelined mode splits the live index)
+    if SESSION_PIPELINE_ENABLED:
+        return [("active", "in_progress"), ("dispensing",)]
+    return [("active", "in_progress", "dispensing")]
+
+
+_PRIMARY_KEYS = {
+    "machines": "machine_id",
+    "orders": "order_id",
+    "payment_reconciliation": "order_id",
+    "webhook_events": "event_id",
+}
+# eq / in_ filters on these columns are answered from a hash index
+_INDEXED = ("id", "session_token", "machine_id", "order_id", "session_id", "status", "event_id")
+_LIVE = ("active", "in_progress", "dispensing")
+
+
+class _Query:
+    def __init__(self, store: "InMemorySupabase", table: str):
+        self.store = store
+        self.table = table
+        self.op = "select"
+        self.payload: Any = None
+        self.filters: List[Callable[[Dict], bool]] = []
+        self.keys: List[tuple] = []  # (col, values) usable with the index
+        self.order_by: Optional[tuple] = None
+        self.limit_n: Optional[int] = None
+        self.single_row = False
+
+    # ── Operations ──
+
+    def select(self, *args, **kwargs):
+        self.op = "select"
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.op, self.payload = "upsert", payload
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    # ── Filters / modifiers ──
+
+    def eq(self, col, value):
+        self.filters.append(lambda r: r.get(col) == value)
+        if col in _INDEXED:
+            self.keys.append((col, [value]))
+        return self
+
+    def neq(self, col, value):
+        self.filters.append(lambda r: r.get(col) != value)
+        return self
+
+    def in_(self, col, values):
+        values = list(values)
+        self.filters.append(lambda r: r.get(col) in values)
+        if col in _INDEXED:
+            self.keys.append((col, values))
+        return self
+
+    def lt(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) < value)
+        return self
+
+    def lte(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) <= value)
+        return self
+
+    def gt(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) > value)
+        return self
+
+    def gte(self, col, value):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) >= value)
+        return self
+
+    def order(self, col, desc=False):
+        self.order_by = (col, desc)
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    def execute(self):
+        return self.store._execute(self)
+
+
+class InMemorySupabase:
+    """Enough of the supabase client for session_db and the database helpers it calls."""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict]] = {}
+        self.ops: Counter = Counter()
+        # (table, col) → value → {row key: row}; rows keyed by insertion order
+        self._index: Dict[tuple, Dict[Any, Dict[int, Dict]]] = {}
+        self._keys: Dict[int, int] = {}
+        self._row_seq = itertools.count()
+        self._lock = threading.Lock()  # Queries run in asyncio.to_thread workers
+
+    def table(self, name: str) -> _Query:
+        return _Query(self, name)
+
+    def rpc(self, name, params):
+        store = self
+
+        class _Call:
+            def execute(self_inner):
+                store.ops[f"rpc.{name}"] += 1
+                raise Exception(f"PGRST202: Could not find the function public.{name}")
+
+        return _Call()
+
+    def rows(self, table: str) -> List[Dict]:
+        """Direct (uncounted) read access for the simulation driver."""
+        return self.tables.setdefault(table, [])
+
+    def live_sessions(self, machine_id: Optional[str] = None) -> List[Dict]:
+        """Uncounted: sessions in active/in_progress/dispensing."""
+        rows = self._lookup("sessions", [("status", list(_LIVE))])
+        if machine_id is not None:
+            rows = [r for r in rows if r.get("machine_id") == machine_id]
+        return rows
+
+    def add_row(self, table: str, row: Dict):
+        """Uncounted insert for seeding."""
+        self.rows(table).append(row)
+        self._add_to_index(table, row)
+
+    # ── Indexes ──
+
+    def _add_to_index(self, table: str, row: Dict):
+        key = self._keys.setdefault(id(row), next(self._row_seq))
+        for col in _INDEXED:
+            if col in row:
+                self._index.setdefault((table, col), {}).setdefault(row[col], {})[key] = row
+
+    def _drop_from_index(self, table: str, row: Dict, cols=_INDEXED):
+        key = self._keys.get(id(row))
+        for col in cols:
+            if col in row:
+                self._index.get((table, col), {}).get(row[col], {}).pop(key, None)
+
+    def _lookup(self, table: str, keys: List[tuple]) -> List[Dict]:
+        if not keys:
+            return list(self.rows(table))
+        best = None
+        for col, values in keys:
+            buckets = self._index.get((table, col), {})
+            found = {}
+            for v in values:
+                found.update(buckets.get(v, {}))
+            if best is None or len(found) < len(best):
+                best = found
+        return [best[k] for k in sorted(best)]
+
+    # ── Execution ──
+
+    def _execute(self, q: _Query) -> _Result:
+        with self._lock:
+            self.ops[f"{q.table}.{q.op}"] += 1
+            rows = self.rows(q.table)
+            if q.op in ("insert", "upsert"):
+                return _Result(self._insert(q.table, q.payload, upsert=q.op == "upsert"))
+
+            matched = [r for r in self._lookup(q.table, q.keys) if all(f(r) for f in q.filters)]
+            if q.op == "update":
+                return _Result(self._update(q.table, matched, q.payload))
+            if q.op == "delete":
+                for r in matched:
+                    rows.remove(r)
+                    self._drop_from_index(q.table, r)
+                return _Result([dict(r) for r in matched])
+
+            if q.order_by:
+                col, desc = q.order_by
+                matched.sort(key=lambda r: (r.get(col) is None, r.get(col) or ""), reverse=desc)
+            if q.limit_n is not None:
+                matched = matched[: q.limit_n]
+            data = [dict(r) for r in matched]
+            if q.single_row:
+                return _Result(data[0] if data else None)
+            return _Result(data)
+
+    def _insert(self, table: str, payload, upsert: bool) -> List[Dict]:
+        rows = self.rows(table)
+        inserted = []
+        for item in payload if isinstance(payload, list) else [payload]:
+            row = copy.deepcopy(item)
+            pk = _PRIMARY_KEYS.get(table, "id")
+            if pk == "id":
+                row.setdefault("id", str(uuid.uuid4()))
+            row.setdefault("created_at", clock.now().isoformat())
+            existing = next(iter(self._index.get((table, pk), {}).get(row.get(pk), {}).values()), None)
+            if existing is not None:
+                if not upsert:
+                    raise Exception(f'duplicate key value violates unique constraint "{table}_pkey"')
+                self._update(table, [existing], row)
+                inserted.append(dict(existing))
+                continue
+            self._check_unique(table, row, ignore=None)
+            rows.append(row)
+            self._add_to_index(table, row)
+            inserted.append(dict(row))
+        return inserted
+
+    def _update(self, table: str, matched: List[Dict], payload: Dict) -> List[Dict]:
+        for r in matched:
+            self._check_unique(table, {**r, **payload}, ignore=r)
+        changed = [c for c in _INDEXED if c in payload]
+        for r in matched:
+            self._drop_from_index(table, r, changed)
+            r.update(copy.deepcopy(payload))
+            self._add_to_index(table, r)
+        return [dict(r) for r in matched]
+
+    def _check_unique(self, table: str, row: Dict, ignore: Optional[Dict]):
+        if table != "sessions":
+            return
+        for other in self._lookup("sessions", [("session_token", [row.get("session_token")])]):
+            if other is not ignore:
+                raise Exception('duplicate key value violates unique constraint "sessions_session_token_key"')
+        for group in _unique_groups():
+            if row.get("status") not in group:
+                continue
+            for other in self._lookup("sessions", [("status", list(group))]):
+                if other is not ignore and other.get("machine_id") == row.get("machine_id"):
+                    raise Exception('duplicate key value violates unique constraint "idx_sessions_live_machine"')
+
+
+class InMemoryGateway:
+    """Local stand-in for the Razorpay payment lookups reconciliation.py makes."""
+
+    def __init__(self):
+        self.payments: Dict[str, List[Dict]] = {}
+        self.failing: set = set()
+        self.calls = 0
+
+    def pay(self, order_id: str, amount: int, status: str = "captured") -> Dict:
+        payment = {"id": f"pay_{uuid.uuid4().hex[:14]}", "order_id": order_id,
+                   "amount": amount, "status": status}
+        self.payments.setdefault(order_id, []).append(payment)
+        return payment
+
+    async def order_payments(self, order_id: str) -> List[Dict]:
+        self.calls += 1
+        if order_id in self.failing:
+            raise Exception(f"gateway timeout for {order_id}")
+        return [dict(p) for p in self.payments.get(order_id, [])]
+
+
+# ──────────────────────────────────────────────
+#  Simulation driver
+# ──────────────────────────────────────────────
+
+class Simulation:
+    """Discrete-event fleet simulation on virtual time."""
+
+    def __init__(
+        self,
+        machines: int = 10,
+        days: float = 1.0,
+        arrivals_per_hour: float = 6.0,
+        pay_ratio: float = 0.8,
+        confirm_ratio: float = 0.99,
+        stock: int = 10_000,
+        seed: int = 1,
+    ):
+        self.machine_ids = [f"SIM{i:03d}" for i in range(machines)]
+        self.duration = days * 86400
+        self.arrival_rate = arrivals_per_hour / 3600
+        self.pay_ratio = pay_ratio
+        self.confirm_ratio = confirm_ratio
+        self.stock = stock
+        self.rng = random.Random(seed)
+        self.clock = clock.VirtualClock(start=1_700_000_000.0)
+        self.store = InMemorySupabase()
+        self.stats: Counter = Counter()
+        self._events: List[tuple] = []
+        self._seq = itertools.count()
+
+    def _push(self, at: float, kind: str, machine_id: str, **data):
+        heapq.heappush(self._events, (at, next(self._seq), kind, machine_id, data))
+
+    def _next_deadline(self) -> Optional[float]:
+        deadlines = [
+            session_db._parse_ts(s["expires_at"]).timestamp()
+            for s in self.store.live_sessions()
+            if s.get("expires_at")
+        ]
+        return min(deadlines) if deadlines else None
+
+    async def run(self) -> Dict:
+        previous = clock.use(self.clock)
+        saved = (db.supabase, db.pool, session_db._procedures_available)
+        db.supabase, db.pool = self.store, True
+        started_wall = time.perf_counter()
+        try:
+            await self._run()
+        finally:
+            clock.use(previous)
+            db.supabase, db.pool, session_db._procedures_available = saved
+        return self.report(time.perf_counter() - started_wall)
+
+    async def _run(self):
+        start = self.clock.time()
+        end = start + self.duration
+        for machine_id in self.machine_ids:
+            self.store.add_row("machines", {
+                "machine_id": machine_id, "status": "idle", "current_stock": self.stock,
+            })
+            await session_db.next_idle_session(machine_id)
+            self._push(start + self.rng.expovariate(self.arrival_rate), "arrival", machine_id)
+
+        while True:
+            deadline = self._next_deadline()
+            event_at = self._events[0][0] if self._events else None
+            # Deadlines are strict (expires_at < now): process just after them
+            due = deadline + 0.001 if deadline is not None else None
+            if due is not None and (event_at is None or due <= event_at):
+                if due > end:
+                    break
+                await self.clock.advance(due - self.clock.time())
+                await self._process_deadlines()
+                continue
+            if event_at is None or event_at > end:
+                break
+            at, _, kind, machine_id, data = heapq.heappop(self._events)
+            await self.clock.advance(at - self.clock.time())
+            await getattr(self, f"_on_{kind}")(machine_id, **data)
+
+    async def _process_deadlines(self):
+        now = self.clock.time()
+        due = [
+            s for s in self.store.live_sessions()
+            if session_db._parse_ts(s["expires_at"]).timestamp() < now
+        ]
+        for s in due:
+            machine_id, status = s["machine_id"], s["status"]
+            if status == "dispensing":
+                if await session_db.fail_dispense(s["id"], machine_id):
+                    self.stats["dispense_timeouts"] += 1
+                    await self._start_next(machine_id)
+            elif await session_db.expire_session(s["id"], machine_id, status):
+                self.stats["expired_" + status] += 1
+            else:
+                continue
+            if not await session_db.get_front_session(machine_id):
+                if await session_db.next_idle_session(machine_id):
+                    self.stats["rotations"] += 1
+
+    async def _start_next(self, machine_id: str):
+        started = await session_db.start_next_dispense(machine_id) if SESSION_PIPELINE_ENABLED else None
+        if started:
+            self._schedule_confirm(machine_id, started["dispense_transaction_id"], started["dispense_quantity"])
+
+    def _schedule_confirm(self, machine_id: str, transaction_id: str, quantity: int):
+        if self.rng.random() < self.confirm_ratio:
+            self._push(
+                self.clock.time() + quantity * MOTOR_SECONDS_PER_UNIT + 1, "confirm", machine_id,
+                transaction_id=transaction_id, quantity=quantity,
+            )
+
+    # ── Customer events ──
+
+    async def _on_arrival(self, machine_id: str):
+        self._push(self.clock.time() + self.rng.expovariate(self.arrival_rate), "arrival", machine_id)
+        self.stats["arrivals"] += 1
+
+        shown = next(
+            (s for s in self.store.live_sessions(machine_id) if s.get("status") == "active"),
+            None,
+        )
+        if not shown:
+            self.stats["lost_busy"] += 1
+            return
+
+        client_id = f"c{next(self._seq)}"
+        await session_db.get_session_status(shown["session_token"], client_id, machine_id)
+        result = await session_db.claim_session(shown["session_token"], client_id, machine_id)
+        if result.get("status") != "claimed":
+            self.stats["lost_claim"] += 1
+            return
+        self.stats["claims"] += 1
+
+        if self.rng.random() < self.pay_ratio:
+            quantity = self.rng.randint(1, 3)
+            self._push(
+                self.clock.time() + self.rng.uniform(20, 120), "pay", machine_id,
+                token=shown["session_token"], client_id=client_id, quantity=quantity,
+            )
+        else:
+            self.stats["abandoned"] += 1  # Claim TTL expires it
+
+    async def _on_pay(self, machine_id: str, token: str, client_id: str, quantity: int):
+        transaction_id = f"order_{next(self._seq)}"
+        result = await session_db.trigger_dispense_session(
+            token, client_id, quantity, transaction_id, quantity * 100
+        )
+        if result.get("status") != "ok":
+            self.stats["pay_failed"] += 1
+            return
+        self.stats["sales"] += 1
+        if "dispense" in result:
+            started = result.get("dispense")
+            if started:
+                self._schedule_confirm(machine_id, started["dispense_transaction_id"], started["dispense_quantity"])
+            if not await session_db.get_front_session(machine_id):
+                await session_db.next_idle_session(machine_id)
+        else:
+            self._schedule_confirm(machine_id, transaction_id, quantity)
+
+    async def _on_confirm(self, machine_id: str, transaction_id: str, quantity: int):
+        result = await session_db.complete_session(machine_id, transaction_id, quantity)
+        if result.get("error"):
+            self.stats["confirm_failed"] += 1
+            return
+        self.stats["dispensed"] += 1
+        started = result.get("dispense")
+        if started:
+            self._schedule_confirm(machine_id, started["dispense_transaction_id"], started["dispense_quantity"])
+
+    # ── Report ──
+
+    def report(self, wall_seconds: float) -> Dict:
+        ops = dict(sorted(self.store.ops.items()))
+        total = sum(ops.values())
+        machine_days = len(self.machine_ids) * self.duration / 86400
+        return {
+            "machines": len(self.machine_ids),
+            "virtual_days": self.duration / 86400,
+            "wall_seconds": round(wall_seconds, 2),
+            "sessions_created": len(self.store.rows("sessions")),
+            **dict(sorted(self.stats.items())),
+            "db_ops_total": total,
+            "db_ops_per_machine_day": round(total / machine_days, 1) if machine_days else 0,
+            "db_ops": ops,
+        }
+
+
+def run(**kwargs) -> Dict:
+    return asyncio.run(Simulation(**kwargs).run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SmartVend session lifecycle simulation")
+    parser.add_argument("--machines", type=int, default=10)
+    parser.add_argument("--days", type=float, default=1.0)
+    parser.add_argument("--arrivals-per-hour", type=float, default=6.0)
+    parser.add_argument("--pay-ratio", type=float, default=0.8)
+    parser.add_argument("--confirm-ratio", type=float, default=0.99)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(run(
+        machines=args.machines,
+        days=args.days,
+        arrivals_per_hour=args.arrivals_per_hour,
+        pay_ratio=args.pay_ratio,
+        confirm_ratio=args.confirm_ratio,
+        seed=args.seed,
+    ), indent=2))
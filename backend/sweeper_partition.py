@@ -0,0 +1,120 @@
+"""
+SmartVend v3.0 — Sweeper Partitioning
+=====================================
+Splits the session expiry sweep across uvicorn workers.
+
+Every worker runs the reconciliation sweep from `lifespan`. Without
+partitioning, N workers expire the same sessions N times and race each other
+on renewal. Each worker now holds a lease in a Redis sorted set
+(member → lease expiry) and renews it every SWEEPER_LEASE_SECONDS / 3.
+Expired leases are pruned on every heartbeat, so a dead worker drops out
+within one lease. Machines map to live workers through a consistent-hash
+ring, so a join or leave only moves ~1/N of the machines.
+
+Without Redis, or while the heartbeat is failing, `owns()` returns True and
+the worker sweeps everything as before. That is safe because expiry is a
+conditional update.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+import time
+from typing import Iterable, List, Optional
+
+import metrics
+from config import SWEEPER_LEASE_SECONDS
+
+MEMBERS_KEY = "sweeper:members"
+# Unique across hosts (pids alone are not)
+MEMBER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_VNODES = 64
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes."""
+
+    def __init__(self, members: Iterable[str], vnodes: int = _VNODES):
+        self.members = tuple(sorted(set(members)))
+        points = sorted(
+            (_hash(f"{member}#{i}"), member)
+            for member in self.members
+            for i in range(vnodes)
+        )
+        self._points: List[int] = [p for p, _ in points]
+        self._owners: List[str] = [m for _, m in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+# ──────────────────────────────────────────────
+#  Membership (one per worker process)
+# ──────────────────────────────────────────────
+
+_ring: Optional[HashRing] = None
+
+
+def owns(machine_id: str) -> bool:
+    """Whether this worker sweeps machine_id."""
+    ring = _ring
+    if ring is None or MEMBER_ID not in ring.members:
+        return True
+    return ring.owner(machine_id) == MEMBER_ID
+
+
+def members() -> tuple:
+    return _ring.members if _ring else ()
+
+
+async def heartbeat(redis) -> HashRing:
+    """Renew this worker's lease, prune dead ones, rebuild the ring if membership changed."""
+    global _ring
+    now = time.time()
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zadd(MEMBERS_KEY, {MEMBER_ID: now + SWEEPER_LEASE_SECONDS})
+        pipe.zremrangebyscore(MEMBERS_KEY, "-inf", now)
+        pipe.zrange(MEMBERS_KEY, 0, -1)
+        _, _, live = await pipe.execute()
+
+    live = tuple(sorted(live))
+    if _ring is None or _ring.members != live:
+        _ring = HashRing(live)
+        metrics.incr("sweeper_rebalances")
+        print(f"🔀 Sweeper partition: {len(live)} worker(s) {list(live)}")
+    return _ring
+
+
+async def run_membership(redis):
+    """Heartbeat loop; on Redis errors, fall back to sweeping everything."""
+    global _ring
+    interval = max(1.0, SWEEPER_LEASE_SECONDS / 3)
+    while True:
+        try:
+            await heartbeat(redis)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if _ring is not None:
+                print(f"Sweeper membership error (sweeping all machines): {e}")
+            _ring = None
+        await asyncio.sleep(interval)
+
+
+async def leave(redis):
+    """Drop this worker's lease so the others take over immediately."""
+    global _ring
+    _ring = None
+    try:
+        await redis.zrem(MEMBERS_KEY, MEMBER_ID)
+    except Exception:
+        pass
@@ -0,0 +1,5 @@
+import os
+
+# main.py hashes ADMIN_PASSWORD at import time; config is imported by the
+# first test module that touches the backend, so set it before collection.
+os.environ.setdefault("ADMIN_PASSWORD", "test-admin-password")
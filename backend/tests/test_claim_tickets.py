@@ -0,0 +1,44 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import pytest
+
+import claim_tickets
+
+
+@pytest.fixture(autouse=True)
+def tickets_on(monkeypatch):
+    monkeypatch.setattr(claim_tickets, "CLAIM_TICKETS_ENABLED", True)
+    monkeypatch.setattr(claim_tickets, "SESSION_TOKEN_SECRET", "test-secret")
+
+
+SESSION = {
+    "id": "11111111-1111-1111-1111-111111111111",
+    "machine_id": "M001",
+    "session_token": "Ab3d",
+    "status": "in_progress",
+    "claimed_by": "c1",
+    "expires_at": "2023-11-14T22:18:20+00:00",  # 1_700_000_300
+}
+
+
+def test_ticket_proves_ownership_until_claim_expiry():
+    ticket = claim_tickets.issue(SESSION, "c1")
+
+    claims = claim_tickets.verify(ticket, "Ab3d", "c1", now=1_700_000_000)
+    assert claims["session_id"] == SESSION["id"] and claims["machine_id"] == "M001"
+    session = claim_tickets.as_session(claims, "Ab3d", "c1")
+    assert session["status"] == "in_progress" and session["claimed_by"] == "c1"
+
+    assert claim_tickets.verify(ticket, "Ab3d", "c1", now=1_700_000_300) is None   # expired
+    assert claim_tickets.verify(ticket, "Ab3d", "c2", now=1_700_000_000) is None   # other client
+    assert claim_tickets.verify(ticket, "Zz9z", "c1", now=1_700_000_000) is None   # other session
+
+
+def test_tampered_or_garbage_ticket_rejected():
+    version, payload, mac = claim_tickets.issue(SESSION, "c1").split(".")
+    other = claim_tickets.issue({**SESSION, "machine_id": "M002"}, "c1").split(".")[1]
+
+    assert claim_tickets.verify(f"{version}.{other}.{mac}", "Ab3d", "c1", now=1_700_000_000) is None
+    assert claim_tickets.verify("not-a-ticket", "Ab3d", "c1", now=1_700_000_000) is None
+    assert claim_tickets.verify(None, "Ab3d", "c1", now=1_700_000_000) is None
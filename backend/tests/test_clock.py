@@ -0,0 +1,39 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import clock
+import simulation
+
+
+def test_virtual_clock_wakes_sleepers_in_deadline_order():
+    async def scenario():
+        vc = clock.VirtualClock(start=1000.0)
+        woke = []
+
+        async def sleeper(name, seconds):
+            await vc.sleep(seconds)
+            woke.append((name, vc.time()))
+
+        tasks = [asyncio.create_task(sleeper("b", 20)), asyncio.create_task(sleeper("a", 5))]
+        await vc.advance(10)
+        first = list(woke)
+        await vc.advance(3600)
+        await asyncio.gather(*tasks)
+        return first, woke, vc.time()
+
+    first, woke, now = asyncio.run(scenario())
+    assert first == [("a", 1005.0)]
+    assert woke == [("a", 1005.0), ("b", 1020.0)]
+    assert now == 1000.0 + 10 + 3600
+
+
+def test_simulation_runs_lifecycle_on_virtual_time():
+    report = simulation.run(machines=2, days=0.05, arrivals_per_hour=30, seed=7)
+
+    assert clock.clock.__class__ is clock.SystemClock  # Restored afterwards
+    assert report["rotations"] > 0
+    assert report["sales"] > 0 and report["dispensed"] > 0
+    assert report["db_ops"]["sessions.insert"] == report["sessions_created"]
+    assert report["db_ops_total"] == sum(report["db_ops"].values())
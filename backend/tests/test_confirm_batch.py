@@ -0,0 +1,50 @@
+import asyncio
+from datetime import timedelta
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import clock
+import session_db
+from simulation import InMemorySupabase
+
+
+def test_replayed_confirmations_complete_once_and_report_per_item(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+    tx = session_db._transaction_uuid
+    store.table("machines").insert({"machine_id": "M001", "current_stock": 10, "status": "dispensing"}).execute()
+    store.table("sessions").insert({
+        "id": "s1", "machine_id": "M001", "session_token": "tok1", "status": "dispensing",
+        "expires_at": (clock.now() + timedelta(seconds=60)).isoformat(),
+    }).execute()
+    store.table("transactions").insert([
+        {"id": tx("order_a"), "machine_id": "M001", "payment_status": "paid"},
+        {"id": tx("order_b"), "machine_id": "M001", "payment_status": "paid"},
+        {"id": tx("order_c"), "machine_id": "M001", "payment_status": "completed"},
+        {"id": tx("order_x"), "machine_id": "M002", "payment_status": "paid"},
+    ]).execute()
+
+    result = asyncio.run(session_db.confirm_batch("M001", [
+        {"transaction_id": "order_a", "dispensed": 2},
+        {"transaction_id": "order_b", "dispensed": 1},
+        {"transaction_id": "order_c", "dispensed": 1},
+        {"transaction_id": "order_x", "dispensed": 1},
+        {"transaction_id": "order_a", "dispensed": 2},  # replayed twice
+    ]))
+
+    assert [(r["transaction_id"], r.get("status") or r.get("error")) for r in result["results"]] == [
+        ("order_a", "completed"),
+        ("order_b", "completed"),
+        ("order_c", "duplicate"),
+        ("order_x", "tx_not_found"),
+        ("order_a", "duplicate"),
+    ]
+    assert result["results"][0]["session_id"] == "s1" and result["results"][1]["session_id"] is None
+    assert result["completed"] == 2
+    assert result["new_session"]["status"] == "active"
+
+    txs = {r["id"]: r for r in store.rows("transactions")}
+    assert txs[tx("order_a")]["dispensed"] == 2 and txs[tx("order_b")]["payment_status"] == "completed"
+    assert txs[tx("order_x")]["payment_status"] == "paid"
+    assert {s["id"]: s["status"] for s in store.rows("sessions")}["s1"] == "completed"
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import database as db
+import main as main_module
+import metrics
+import session_db
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeSupabase:
+    """Records (table, update payload) and answers reads/updates from `rows` by table."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.updates = []
+        self._table = None
+        self._update = None
+
+    def table(self, name):
+        self._table, self._update = name, None
+        return self
+
+    def update(self, data):
+        self._update = data
+        return self
+
+    def select(self, *args):
+        return self
+
+    def eq(self, *args):
+        return self
+
+    def lt(self, *args):
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    def execute(self):
+        if self._update is not None:
+            self.updates.append((self._table, self._update))
+        return _Result(self.rows.get(self._table, []))
+
+
+def test_fail_dispense_flags_transaction_and_counts_per_machine(monkeypatch):
+    fake = FakeSupabase({
+        "sessions": [{"id": "s1", "machine_id": "M001", "status": "failed"}],
+        "orders": [{"order_id": "order_1", "quantity": 2}],
+        "transactions": [{"id": "tx"}],
+    })
+    events = []
+
+    async def fake_machine_status(machine_id, status):
+        events.append(("machine", status))
+
+    async def fake_log_event(**kwargs):
+        events.append((kwargs["event_type"], kwargs["payload"]))
+
+    monkeypatch.setattr(db, "supabase", fake)
+    monkeypatch.setattr(db, "update_machine_status", fake_machine_status)
+    monkeypatch.setattr(session_db, "log_event", fake_log_event)
+    before = metrics.get("dispense_timeouts", machine_id="M001")
+
+    failed = asyncio.run(session_db.fail_dispense("s1", "M001"))
+
+    assert failed == {"session_id": "s1", "machine_id": "M001", "transaction_id": "order_1", "quantity": 2}
+    assert ("sessions", fake.updates[0][1]) == fake.updates[0] and fake.updates[0][1]["status"] == "failed"
+    assert ("transactions", {"payment_status": "dispense_timeout", "completed_at": fake.updates[1][1]["completed_at"]}) == fake.updates[1]
+    assert ("machine", "idle") in events
+    assert ("dispense_timeout", {"transaction_id": "order_1", "quantity": 2, "stock_unverified": 2}) in events
+    assert metrics.get("dispense_timeouts", machine_id="M001") == before + 1
+
+
+def test_motor_timeout_fails_session_and_pushes_next_qr(monkeypatch):
+    calls = {"expire": 0, "renew": [], "pushed": 0}
+
+    async def fake_fail(session_id, machine_id, now_iso=None):
+        return {"session_id": session_id, "machine_id": machine_id, "transaction_id": "order_1", "quantity": 1}
+
+    async def fake_expire(*args, **kwargs):
+        calls["expire"] += 1
+        return True
+
+    async def fake_renew(machine_id, expired_session_id=None):
+        calls["renew"].append(expired_session_id)
+        return {"session_token": "next"}
+
+    async def fake_push(machine_id, session):
+        calls["pushed"] += 1
+
+    monkeypatch.setattr(session_db, "fail_dispense", fake_fail)
+    monkeypatch.setattr(session_db, "expire_session", fake_expire)
+    monkeypatch.setattr(main_module.machine_actor, "renew", fake_renew)
+    monkeypatch.setattr(main_module, "_push_new_session", fake_push)
+    monkeypatch.setattr(main_module, "_machine_online", lambda machine_id: True)
+
+    asyncio.run(main_module._on_session_due("s1", "M001", "dispensing"))
+
+    assert calls == {"expire": 0, "renew": ["s1"], "pushed": 1}
@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import metrics
+from expiry_scheduler import ExpiryScheduler
+
+
+def _session(session_id, status, in_seconds):
+    expires = datetime.now(timezone.utc) + timedelta(seconds=in_seconds)
+    return {
+        "id": session_id,
+        "machine_id": "M001",
+        "status": status,
+        "expires_at": expires.isoformat(),
+    }
+
+
+def test_fires_in_deadline_order_and_honours_reschedule_and_cancel():
+    metrics.reset()
+    fired = []
+
+    async def on_fire(session_id, machine_id, status):
+        fired.append((session_id, status))
+
+    async def scenario():
+        sched = ExpiryScheduler()
+        sched.start(on_fire)
+        sched.schedule(_session("a", "active", 0.08))
+        sched.schedule(_session("b", "active", 0.02))
+        sched.schedule(_session("c", "active", 0.03))
+        # Claimed: deadline moves out past the test window
+        sched.schedule(_session("c", "in_progress", 60))
+        sched.schedule(_session("d", "active", 0.01))
+        sched.cancel("d")
+        await asyncio.sleep(0.15)
+        pending = sched.pending()
+        await sched.stop()
+        return pending
+
+    pending = asyncio.run(scenario())
+    assert fired == [("b", "active"), ("a", "active")]
+    assert pending == 1
+    summary = metrics.snapshot()["summaries"]["expiry_fire_lag_seconds"]
+    assert summary["count"] == 2
+    assert summary["max"] < 0.05
+
+
+def test_non_expiring_status_unschedules():
+    async def scenario():
+        sched = ExpiryScheduler()
+        sched.start(lambda *a: asyncio.sleep(0))
+        sched.schedule(_session("a", "active", 30))
+        sched.schedule(_session("a", "completed", 30))
+        pending = sched.pending()
+        await sched.stop()
+        return pending
+
+    assert asyncio.run(scenario()) == 0
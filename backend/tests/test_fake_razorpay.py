@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import razorpay
+from fastapi.testclient import TestClient
+
+from fake_razorpay import FakeRazorpay, create_app
+from services import payment_service
+
+
+def test_payment_and_webhook_signatures_verify_like_razorpay():
+    delivered = []
+
+    async def send(url, body, headers):
+        delivered.append((url, body, headers))
+        return 200
+
+    gateway = FakeRazorpay(
+        "rzp_test_load", "s3cret", webhook_secret="wh_s3cret",
+        webhook_url="http://backend/api/razorpay-webhook", webhook_duplicate_rate=1.0, send=send,
+    )
+
+    async def run():
+        order = gateway.create_order(200)
+        proof = gateway.pay(order["id"])
+        await gateway.drain()
+        return order, proof
+
+    order, proof = asyncio.run(run())
+    client = razorpay.Client(auth=("rzp_test_load", "s3cret"))
+    assert client.utility.verify_payment_signature(proof)
+
+    assert len(delivered) == 2  # duplicate delivery, same event ID
+    (_, body, headers), (_, _, again) = delivered
+    assert headers["X-Razorpay-Event-Id"] == again["X-Razorpay-Event-Id"]
+    assert payment_service.verify_webhook_signature(body, headers["X-Razorpay-Signature"], "wh_s3cret")
+    entity = json.loads(body)["payload"]["payment"]["entity"]
+    assert entity["order_id"] == order["id"] and entity["status"] == "captured"
+
+
+def test_api_requires_key_pair_and_lists_order_payments():
+    gateway = FakeRazorpay("rzp_test_load", "s3cret", payment_fail_rate=1.0)
+    http = TestClient(create_app(gateway))
+
+    assert http.post("/v1/orders", json={"amount": 100}).status_code == 401
+    order = http.post("/v1/orders", json={"amount": 100}, auth=("rzp_test_load", "s3cret")).json()
+    assert order["status"] == "created"
+
+    assert http.post(f"/test/orders/{order['id']}/pay", json={}).status_code == 400
+    payments = http.get(f"/v1/orders/{order['id']}/payments", auth=("rzp_test_load", "s3cret")).json()
+    assert [p["status"] for p in payments["items"]] == ["failed"]
@@ -0,0 +1,70 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from starlette.responses import StreamingResponse
+
+from idempotency import IdempotencyStore, fingerprint
+
+
+def _call(counter, status=200, delay=0.01):
+    async def call():
+        counter.append(1)
+        await asyncio.sleep(delay)
+
+        async def body():
+            yield b'{"status":"claimed",'
+            yield f'"n":{len(counter)}}}'.encode()
+
+        return StreamingResponse(body(), status_code=status, media_type="application/json")
+    return call
+
+
+async def _body(response):
+    return response.status_code, response.body, dict(response.headers)
+
+
+def test_concurrent_duplicates_run_once_and_replay_bytes():
+    store = IdempotencyStore(ttl_seconds=60, wait_seconds=1)
+    calls = []
+    fp = fingerprint(b'{"session_token":"abcd"}')
+
+    async def run():
+        responses = await asyncio.gather(*(
+            store.handle("/api/session/claim:k1", fp, _call(calls)) for _ in range(3)
+        ))
+        later = await store.handle("/api/session/claim:k1", fp, _call(calls))
+        return [await _body(r) for r in [*responses, later]]
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert {r[1] for r in results} == {b'{"status":"claimed","n":1}'}
+    assert "idempotent-replayed" not in results[0][2]
+    assert all(r[2].get("idempotent-replayed") == "true" for r in results[1:])
+
+
+def test_key_reuse_with_different_body_is_rejected():
+    store = IdempotencyStore(ttl_seconds=60, wait_seconds=1)
+    calls = []
+
+    async def run():
+        await store.handle("/create-order:k2", fingerprint(b"qty=1"), _call(calls))
+        return await store.handle("/create-order:k2", fingerprint(b"qty=2"), _call(calls))
+
+    response = asyncio.run(run())
+    assert response.status_code == 422 and len(calls) == 1
+
+
+def test_server_errors_are_not_replayed():
+    store = IdempotencyStore(ttl_seconds=60, wait_seconds=1)
+    calls = []
+    fp = fingerprint(b"{}")
+
+    async def run():
+        first = await store.handle("/api/session/trigger-dispense:k3", fp, _call(calls, status=503))
+        second = await store.handle("/api/session/trigger-dispense:k3", fp, _call(calls))
+        return first.status_code, second.status_code
+
+    assert asyncio.run(run()) == (503, 200)
+    assert len(calls) == 2
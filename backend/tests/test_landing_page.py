@@ -0,0 +1,35 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import landing_page
+
+
+def _state(**session):
+    return {
+        "session": {"machine_id": "M001", "session_token": "Ab3d", **session},
+        "machine": {"machine_id": "M001", "location": "Block <A>", "current_stock": 7},
+        "unit_price_paise": 500,
+        "client_id": "c1",
+        "claim": None,
+    }
+
+
+def test_claimed_session_forwards_with_state_in_fragment():
+    state = _state(status="in_progress", is_owner=True)
+    state["claim"] = {"status": "claimed", "name": "Asha"}
+    page = landing_page.render(state, "Ab3d", "https://app.example")
+
+    prefix = "https://app.example/vend/M001/Ab3d#sv="
+    assert prefix in page
+    encoded = page.split(prefix, 1)[1].split("'", 1)[0]
+    assert landing_page.decode_state(encoded) == state
+    # Inlined values are escaped
+    assert "Block &lt;A&gt;" in page and "₹5 each" in page
+
+
+def test_unclaimed_session_asks_for_name_and_taken_session_stops():
+    page = landing_page.render(_state(status="active"), "Ab3d", "https://app.example")
+    assert "name='name'" in page and "#sv=" not in page
+
+    page = landing_page.render(_state(status="in_progress", is_owner=False), "Ab3d", "https://app.example")
+    assert "in use by another customer" in page and "#sv=" not in page
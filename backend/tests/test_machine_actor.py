@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import machine_actor
+import session_db
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    calls = {"get_active": 0, "create": 0, "running": 0, "max_running": 0}
+
+    async def track():
+        calls["running"] += 1
+        calls["max_running"] = max(calls["max_running"], calls["running"])
+        await asyncio.sleep(0.01)
+        calls["running"] -= 1
+
+    async def fake_get_active(machine_id):
+        calls["get_active"] += 1
+        await track()
+        return None
+
+    async def fake_create(machine_id, ttl_seconds=60):
+        calls["create"] += 1
+        await track()
+        expires = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        return {
+            "id": f"s{calls['create']}",
+            "session_token": f"t{calls['create']}",
+            "machine_id": machine_id,
+            "status": "active",
+            "expires_at": expires.isoformat(),
+        }
+
+    monkeypatch.setattr(session_db, "get_active_session_for_machine", fake_get_active)
+    monkeypatch.setattr(session_db, "create_session", fake_create)
+    yield calls
+    asyncio.run(machine_actor.shutdown())
+
+
+def test_concurrent_fetch_display_creates_one_session(fake_db):
+    async def scenario():
+        results = await asyncio.gather(*[machine_actor.ensure_session("M001") for _ in range(5)])
+        # Served from the actor's cache: no further DB work
+        again = await machine_actor.ensure_session("M001")
+        await machine_actor.shutdown()
+        return results, again
+
+    results, again = asyncio.run(scenario())
+    assert {r["session_token"] for r in results} == {"t1"}
+    assert again["session_token"] == "t1"
+    assert fake_db["create"] == 1
+    assert fake_db["get_active"] == 1
+
+
+def test_operations_for_one_machine_are_serialized(fake_db):
+    async def scenario():
+        await asyncio.gather(
+            machine_actor.ensure_session("M002"),
+            machine_actor.renew("M002", expired_session_id="s0"),
+            machine_actor.renew("M002", expired_session_id="s0"),
+        )
+        await machine_actor.shutdown()
+
+    asyncio.run(scenario())
+    assert fake_db["max_running"] == 1
+    # renew found the live session ensure_session created instead of inserting again
+    assert fake_db["create"] == 1
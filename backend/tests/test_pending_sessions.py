@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import main as main_module
+import session_db
+
+
+def _iso(seconds_from_now):
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now)).isoformat()
+
+
+@pytest.fixture
+def fake_sessions(monkeypatch):
+    state = {"pending": None, "activated": [], "discarded": 0, "created": 0}
+
+    async def fake_get_pending(machine_id):
+        return state["pending"]
+
+    async def fake_activate(pending):
+        state["activated"].append(pending["id"])
+        return {**pending, "status": "active"}
+
+    async def fake_discard(machine_id):
+        state["discarded"] += 1
+
+    async def fake_create(machine_id, ttl_seconds=60, token=None):
+        state["created"] += 1
+        return {"id": "fresh", "session_token": "fresh", "machine_id": machine_id,
+                "status": "active", "expires_at": _iso(60)}
+
+    async def fake_issue(session):
+        return {"id": "succ", "session_token": "succ", "status": "pending",
+                "starts_at": session["expires_at"], "expires_at": _iso(120)}
+
+    monkeypatch.setattr(session_db, "get_pending_successor", fake_get_pending)
+    monkeypatch.setattr(session_db, "_activate_pending", fake_activate)
+    monkeypatch.setattr(session_db, "_discard_pending", fake_discard)
+    monkeypatch.setattr(session_db, "create_session", fake_create)
+    monkeypatch.setattr(session_db, "issue_successor", fake_issue)
+    return state
+
+
+def test_expiry_rollover_activates_pre_issued_successor(fake_sessions):
+    fake_sessions["pending"] = {"id": "p1", "session_token": "p1", "machine_id": "M001",
+                                "status": "pending", "starts_at": _iso(-1), "expires_at": _iso(59)}
+
+    session = asyncio.run(session_db.next_idle_session("M001"))
+
+    assert session["id"] == "p1" and session["status"] == "active"
+    assert session["next"]["session_token"] == "succ"
+    assert fake_sessions["created"] == 0 and fake_sessions["discarded"] == 0
+
+
+def test_stale_successor_is_discarded_after_a_purchase(fake_sessions):
+    # Successor window already mostly elapsed (machine was in use)
+    fake_sessions["pending"] = {"id": "p1", "session_token": "p1", "machine_id": "M001",
+                                "status": "pending", "starts_at": _iso(-100), "expires_at": _iso(-40)}
+
+    session = asyncio.run(session_db.next_idle_session("M001"))
+
+    assert session["id"] == "fresh"
+    assert fake_sessions["activated"] == []
+    assert fake_sessions["discarded"] == 1
+
+
+def test_session_frame_carries_successor():
+    session = {"session_token": "abcd", "expires_at": _iso(30),
+               "next": {"session_token": "efgh", "expires_at": _iso(90)}}
+
+    frame = main_module._session_frame("new_session", "M001", session)
+
+    assert frame["url"].endswith("/vend/M001/abcd")
+    assert frame["next"]["url"].endswith("/vend/M001/efgh")
+    assert 28_000 < frame["next"]["in_ms"] <= 30_000
+    assert "rotation" not in frame
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import database as db
+import main as main_module
+import session_db
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeSessionsTable:
+    """Chainable stand-in for supabase.table("sessions"); `on_update` decides the update outcome."""
+
+    def __init__(self, queued, on_update):
+        self.queued = queued
+        self.on_update = on_update
+        self._update = None
+
+    def table(self, name):
+        assert name == "sessions"
+        self._update = None
+        return self
+
+    def select(self, *args):
+        return self
+
+    def update(self, data):
+        self._update = data
+        return self
+
+    def eq(self, *args):
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    def execute(self):
+        if self._update is not None:
+            return _Result(self.on_update(self._update))
+        return _Result(self.queued)
+
+
+@pytest.fixture
+def quiet_db(monkeypatch):
+    statuses = []
+
+    async def fake_machine_status(machine_id, status):
+        statuses.append(status)
+
+    async def fake_log_event(**kwargs):
+        return None
+
+    monkeypatch.setattr(db, "update_machine_status", fake_machine_status)
+    monkeypatch.setattr(session_db, "log_event", fake_log_event)
+    return statuses
+
+
+def test_start_next_dispense_promotes_oldest_queued_sale(monkeypatch, quiet_db):
+    head = {"id": "s2", "status": "queued", "dispense_transaction_id": "order_2", "dispense_quantity": 1}
+    monkeypatch.setattr(db, "supabase", FakeSessionsTable(
+        [head], lambda data: [{**head, **data}]
+    ))
+
+    started = asyncio.run(session_db.start_next_dispense("M001"))
+
+    assert started["id"] == "s2"
+    assert started["status"] == "dispensing"
+    assert quiet_db == ["dispensing"]
+
+
+def test_start_next_dispense_waits_while_motor_is_busy(monkeypatch, quiet_db):
+    def busy(data):
+        raise Exception('duplicate key value violates unique constraint "idx_sessions_motor_machine"')
+
+    monkeypatch.setattr(db, "supabase", FakeSessionsTable([{"id": "s3", "status": "queued"}], busy))
+
+    assert asyncio.run(session_db.start_next_dispense("M001")) is None
+    assert quiet_db == []
+
+
+def test_queued_sale_puts_next_qr_up_without_dispensing(monkeypatch):
+    sent, pushed = [], []
+
+    async def fake_send(machine_id, payload, store_pending=True):
+        sent.append(payload)
+
+    async def fake_renew(machine_id, expired_session_id=None):
+        return {"session_token": "next"}
+
+    async def fake_push(machine_id, session):
+        pushed.append(session["session_token"])
+
+    monkeypatch.setattr(main_module, "_send_to_machine", fake_send)
+    monkeypatch.setattr(main_module.machine_actor, "renew", fake_renew)
+    monkeypatch.setattr(main_module, "_push_new_session", fake_push)
+
+    queued = {"status": "ok", "queued": True, "dispense": None}
+    assert asyncio.run(main_module._dispatch_dispense("M001", queued, "order_2", 1)) is False
+    assert sent == [] and pushed == ["next"]
+
+    started = {"status": "ok", "queued": False, "dispense": {
+        "id": "s2", "dispense_transaction_id": "order_2", "dispense_quantity": 1,
+    }}
+    assert asyncio.run(main_module._dispatch_dispense("M001", started, "order_2", 1)) is True
+    assert sent[0]["transaction_id"] == "order_2" and sent[0]["duration"] == 1
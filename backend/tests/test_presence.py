@@ -0,0 +1,62 @@
+import uuid
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from presence import PresenceTable
+
+
+@pytest.fixture
+def table():
+    t = PresenceTable(f"sv_test_{uuid.uuid4().hex[:12]}", 64)
+    yield t
+    t.close(unlink=True)
+
+
+def test_connect_lookup_disconnect(table):
+    assert table.lookup("M001") is None
+
+    slot = table.mark_connected("M001", worker_id=111)
+    rec = table.lookup("M001")
+    assert rec["slot"] == slot
+    assert rec["worker_id"] == 111
+    assert rec["online"] is True
+    assert table.machine_at(slot) == "M001"
+
+    table.mark_disconnected("M001", worker_id=111)
+    rec = table.lookup("M001")
+    assert rec["online"] is False
+    # Slot stays interned after disconnect
+    assert rec["slot"] == slot
+
+
+def test_other_worker_sees_same_record(table):
+    other = PresenceTable(table.name, 64)
+    try:
+        table.mark_connected("M002", worker_id=222)
+        rec = other.lookup("M002")
+        assert rec["worker_id"] == 222
+        assert rec["online"] is True
+    finally:
+        other.close()
+
+
+def test_stale_disconnect_does_not_clear_new_owner(table):
+    table.mark_connected("M003", worker_id=1)
+    # Device reconnected to worker 2 before worker 1 noticed the drop
+    table.mark_connected("M003", worker_id=2)
+    table.mark_disconnected("M003", worker_id=1)
+    assert table.lookup("M003")["worker_id"] == 2
+
+
+def test_colliding_ids_get_distinct_slots():
+    t = PresenceTable(f"sv_test_{uuid.uuid4().hex[:12]}", 4)
+    try:
+        slots = {t.mark_connected(f"M{i}", worker_id=1) for i in range(4)}
+        assert slots == {0, 1, 2, 3}
+        # Table full: new machines are not interned
+        assert t.mark_connected("M-extra", worker_id=1) is None
+    finally:
+        t.close(unlink=True)
@@ -0,0 +1,72 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import main as main_module
+import metrics
+import session_db
+
+
+def test_sweep_expires_offline_machines_without_renewing(monkeypatch):
+    async def fake_expire_stale(owns=None):
+        return [
+            {"session_id": "s1", "machine_id": "online-1"},
+            {"session_id": "s2", "machine_id": "offline-1"},
+        ]
+
+    renewed_for = []
+
+    async def fake_renew(machine_id, session_id):
+        renewed_for.append(machine_id)
+        return {"session_token": "next", "machine_id": machine_id}
+
+    monkeypatch.setattr(session_db, "expire_stale_sessions", fake_expire_stale)
+    before = metrics.snapshot()["counters"].get("expiry_offline_skipped", 0)
+
+    renewed = asyncio.run(session_db.expire_and_renew_sessions(
+        renew=fake_renew, online=lambda machine_id: machine_id.startswith("online")
+    ))
+
+    assert renewed_for == ["online-1"]
+    assert [m for m, _ in renewed] == ["online-1"]
+    assert metrics.snapshot()["counters"]["expiry_offline_skipped"] == before + 1
+
+
+def test_expiry_timer_does_not_renew_offline_machine(monkeypatch):
+    calls = {"renew": 0, "pushed": 0}
+
+    async def fake_expire(session_id, machine_id, old_status, now_iso=None):
+        return True
+
+    async def fake_renew(machine_id, session_id):
+        calls["renew"] += 1
+        return {"session_token": "next"}
+
+    async def fake_push(machine_id, session):
+        calls["pushed"] += 1
+
+    monkeypatch.setattr(session_db, "expire_session", fake_expire)
+    monkeypatch.setattr(main_module.machine_actor, "renew", fake_renew)
+    monkeypatch.setattr(main_module, "_push_new_session", fake_push)
+    monkeypatch.setattr(main_module, "_machine_online", lambda machine_id: False)
+
+    asyncio.run(main_module._on_session_due("s1", "M001", "active"))
+    assert calls == {"renew": 0, "pushed": 0}
+
+    monkeypatch.setattr(main_module, "_machine_online", lambda machine_id: True)
+    asyncio.run(main_module._on_session_due("s1", "M001", "active"))
+    assert calls == {"renew": 1, "pushed": 1}
+
+
+def test_machine_without_local_presence_counts_online_when_other_hosts_can_hold_it(monkeypatch):
+    class NoPresence:
+        def lookup(self, machine_id):
+            return None
+
+    monkeypatch.setattr(main_module.presence, "table", NoPresence())
+    monkeypatch.setattr(main_module, "redis_client", None)
+    assert not main_module._machine_online("M404")
+
+    monkeypatch.setattr(main_module, "redis_client", object())
+    assert main_module._machine_online("M404")
@@ -0,0 +1,78 @@
+import asyncio
+from datetime import timedelta
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import clock
+import reconciliation
+import session_db
+from simulation import InMemoryGateway, InMemorySupabase
+
+
+def _seed(store):
+    old = clock.now() - timedelta(hours=2)
+    live_until = (clock.now() + timedelta(minutes=5)).isoformat()
+    store.table("sessions").insert([
+        {"id": "s_live", "machine_id": "M001", "session_token": "t1", "status": "in_progress",
+         "expires_at": live_until},
+        {"id": "s_gone", "machine_id": "M002", "session_token": "t2", "status": "expired",
+         "expires_at": old.isoformat()},
+    ]).execute()
+    orders = [
+        ("order_done", "s_gone"),      # has a transaction
+        ("order_pending", "s_live"),   # paid, session still claimed
+        ("order_refund", "s_gone"),    # paid, session expired
+        ("order_abandoned", "s_gone"), # never paid
+        ("order_new", "s_live"),       # inside the grace period
+    ]
+    for i, (order_id, session_id) in enumerate(orders):
+        created = old + timedelta(seconds=i) if order_id != "order_new" else clock.now()
+        store.table("orders").insert({
+            "order_id": order_id, "session_id": session_id, "machine_id": "M001",
+            "amount": 100, "quantity": 1, "created_at": created.isoformat(),
+        }).execute()
+    store.table("transactions").insert({"id": session_db._transaction_uuid("order_done")}).execute()
+
+
+def test_orphans_classified_in_batches_and_run_resumes(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+    _seed(store)
+    gateway = InMemoryGateway()
+    for order_id in ("order_done", "order_pending", "order_refund"):
+        gateway.pay(order_id, 100)
+    gateway.pay("order_abandoned", 100, status="failed")
+
+    async def run():
+        first = await reconciliation.run(gateway, batch_size=2, max_batches=1, grace_seconds=600)
+        rest = await reconciliation.run(gateway, batch_size=2, grace_seconds=600)
+        again = await reconciliation.run(gateway, batch_size=2, grace_seconds=600)
+        return first, rest, again
+
+    first, rest, again = asyncio.run(run())
+    assert first["scanned"] == 2 and first["cursor"]["order_id"] == "order_pending"
+    assert rest["scanned"] == 2 and again["scanned"] == 0
+    verdicts = {r["order_id"]: r["classification"] for r in store.rows("payment_reconciliation")}
+    assert verdicts == {
+        "order_pending": "dispense_pending",
+        "order_refund": "refund_needed",
+        "order_abandoned": "abandoned",
+    }
+    assert gateway.calls == 3  # order_done had a transaction, order_new is too young
+
+
+def test_gateway_failure_checkpoints_before_the_failed_order(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+    _seed(store)
+    gateway = InMemoryGateway()
+    gateway.failing.add("order_refund")
+
+    summary = asyncio.run(reconciliation.run(gateway, batch_size=10, grace_seconds=600))
+    assert summary["error"] and summary["cursor"]["order_id"] == "order_pending"
+
+    gateway.failing.clear()
+    resumed = asyncio.run(reconciliation.run(gateway, batch_size=10, grace_seconds=600))
+    assert resumed["error"] is None and resumed["scanned"] == 2
+    assert len(store.rows("payment_reconciliation")) == 3
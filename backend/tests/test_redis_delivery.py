@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import main as main_module
+import metrics
+import presence
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, message):
+        self.published.append(json.loads(message))
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(main_module, "redis_client", r)
+    monkeypatch.setattr(main_module, "connected_machines", {})
+    monkeypatch.setattr(main_module, "pending_http_commands", {})
+    metrics.reset()
+    return r
+
+
+def test_local_machine_is_not_published(redis):
+    ws = FakeWebSocket()
+    main_module.connected_machines["M001"] = ws
+
+    asyncio.run(main_module._send_to_machine("M001", {"type": "command", "action": "dispense"}))
+
+    assert ws.sent == [{"type": "command", "action": "dispense"}]
+    assert redis.published == []
+
+
+def test_remote_machine_is_published_and_echo_dropped(redis):
+    asyncio.run(main_module._send_to_machine("M002", {"type": "ping"}))
+    assert len(redis.published) == 1
+    msg = redis.published[0]
+    assert msg["origin"] == presence.ORIGIN_ID
+
+    # The publishing worker receives its own message back: dropped, never re-sent
+    ws = FakeWebSocket()
+    main_module.connected_machines["M002"] = ws
+    asyncio.run(main_module._forward_redis_message(msg))
+    assert ws.sent == []
+    assert metrics.get("redis_echo_dropped") == 1
+
+    # Another instance's message is forwarded, even if its PID matches ours
+    asyncio.run(main_module._forward_redis_message({**msg, "origin": presence.WORKER_ID, "msg_id": "x"}))
+    assert ws.sent == [{"type": "ping"}]
+    assert metrics.get("ws_duplicate_deliveries") == 0
@@ -0,0 +1,56 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import session_db
+
+
+def test_bootstrap_uses_one_procedure_call(monkeypatch):
+    calls = []
+
+    async def fake_call_procedure(name, params, own_migration=False):
+        calls.append((name, params, own_migration))
+        return {
+            "session": {
+                "session_token": "Ab3d", "machine_id": "M001", "status": "in_progress",
+                "claimed_by": "c1", "expires_at": "2999-01-01T00:00:00+00:00",
+            },
+            "machine": {"machine_id": "M001", "location": "Lobby", "status": "idle", "current_stock": 4},
+            "lock": None,
+        }
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("no separate lookups expected")
+
+    monkeypatch.setattr(session_db, "_call_procedure", fake_call_procedure)
+    monkeypatch.setattr(session_db, "get_session_by_token", fail)
+    monkeypatch.setattr(session_db.db, "get_public_status", fail)
+
+    boot = asyncio.run(session_db.get_session_bootstrap("M001", "Ab3d", "c1"))
+
+    assert [c[0] for c in calls] == ["sv_session_bootstrap"] and calls[0][2] is True
+    assert boot["session"]["status"] == "in_progress" and boot["session"]["is_owner"] is True
+    assert boot["machine"]["current_stock"] == 4 and boot["machine"]["locked"] is False
+    assert boot["unit_price_paise"] == session_db.PRICE_PER_UNIT_PAISA
+
+
+def test_bootstrap_falls_back_to_concurrent_reads(monkeypatch):
+    async def no_procedure(name, params, own_migration=False):
+        return None
+
+    async def fake_get_session_by_token(token):
+        return None
+
+    async def fake_public_status(machine_id, client_id=None):
+        return {"machine_id": machine_id, "status": "idle", "current_stock": 2, "locked": False}
+
+    monkeypatch.setattr(session_db, "_call_procedure", no_procedure)
+    monkeypatch.setattr(session_db, "get_session_by_token", fake_get_session_by_token)
+    monkeypatch.setattr(session_db.db, "get_public_status", fake_public_status)
+    monkeypatch.setattr(session_db.db, "supabase", object())
+
+    boot = asyncio.run(session_db.get_session_bootstrap("M001", "Zz9z"))
+
+    assert boot["session"] == {"error": "session_not_found"}
+    assert boot["machine"]["current_stock"] == 2
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import presence
+import session_events
+
+
+def _events(frames):
+    return [json.loads(f.split("data: ", 1)[1]) for f in frames if "data: " in f]
+
+
+def test_stream_sends_current_state_then_deltas_until_terminal(monkeypatch):
+    monkeypatch.setattr(session_events, "_subscribers", {})
+    monkeypatch.setattr(session_events, "_redis", None)
+
+    async def run():
+        sub = session_events.subscribe("s1", "M001", "in_progress")
+        other = session_events.subscribe("s2", "M002", "dispensing")
+        frames = []
+
+        async def consume():
+            async for frame in session_events.stream(sub, {"status": "in_progress"}):
+                frames.append(frame)
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0)
+        await session_events.publish("M001", "dispensing", session_id="s1")
+        await session_events.publish("M001", "expired", session_id="s9")  # another session
+        # Procedure-path completion: matched by the subscriber's current status
+        await session_events.publish("M001", "completed", from_statuses=("dispensing",), dispensed=2)
+        await asyncio.wait_for(task, 1)
+        return frames, other
+
+    frames, other = asyncio.run(run())
+    assert [e["status"] for e in _events(frames)] == ["in_progress", "dispensing", "completed"]
+    assert _events(frames)[-1]["dispensed"] == 2
+    assert other.queue.empty()
+    assert session_events.subscriber_count() == 1  # finished stream unsubscribed
+
+
+def test_remote_events_delivered_and_own_echo_dropped(monkeypatch):
+    monkeypatch.setattr(session_events, "_subscribers", {})
+
+    async def run():
+        sub = session_events.subscribe("s1", "M001", "in_progress")
+        event = {"session_id": "s1", "machine_id": "M001", "status": "expired"}
+        session_events.deliver_remote({**event, "origin": presence.ORIGIN_ID})
+        assert sub.queue.empty()
+        session_events.deliver_remote({**event, "origin": "other-host:1"})
+        return sub.queue.get_nowait()
+
+    assert asyncio.run(run())["status"] == "expired"
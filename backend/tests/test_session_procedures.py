@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import database as db
+import session_db
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeRpcClient:
+    """Just enough of the supabase client for session_db.rpc()."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def rpc(self, name, params):
+        self.calls.append((name, params))
+        response = self.responses[name]
+
+        class _Call:
+            def execute(self_inner):
+                if isinstance(response, Exception):
+                    raise response
+                return _Result(response)
+
+        return _Call()
+
+    def table(self, name):
+        raise AssertionError(f"unexpected step-by-step query on {name}")
+
+
+@pytest.fixture(autouse=True)
+def procedures_enabled(monkeypatch):
+    monkeypatch.setattr(session_db, "_procedures_available", True)
+
+
+def test_trigger_dispense_is_one_round_trip(monkeypatch):
+    fake = FakeRpcClient({
+        "sv_trigger_dispense": {"error": "insufficient_stock", "available": 1},
+    })
+    monkeypatch.setattr(db, "supabase", fake)
+
+    result = asyncio.run(session_db.trigger_dispense_session(
+        "abcd", "client-1", 2, "pay_123", 200, order_id="order_1"
+    ))
+
+    assert result == {"error": "insufficient_stock", "available": 1}
+    assert len(fake.calls) == 1
+    name, params = fake.calls[0]
+    assert name == "sv_trigger_dispense"
+    assert params["p_tx_id"] == session_db._transaction_uuid("pay_123")
+    assert params["p_order_id"] == "order_1"
+
+
+def test_missing_procedure_falls_back_and_is_remembered(monkeypatch):
+    fake = FakeRpcClient({
+        "sv_claim_session": Exception("PGRST202: Could not find the function public.sv_claim_session"),
+    })
+    monkeypatch.setattr(db, "supabase", fake)
+
+    async def fake_get_session(token):
+        return None
+
+    monkeypatch.setattr(session_db, "get_session_by_token", fake_get_session)
+
+    first = asyncio.run(session_db.claim_session("abcd", "client-1"))
+    second = asyncio.run(session_db.claim_session("abcd", "client-1"))
+
+    assert first == second == {"error": "session_not_found"}
+    assert len(fake.calls) == 1
+    assert session_db._procedures_available is False
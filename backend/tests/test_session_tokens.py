@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import session_db
+import session_tokens
+
+
+@pytest.fixture(autouse=True)
+def totp_mode(monkeypatch):
+    monkeypatch.setattr(session_tokens, "SESSION_ROTATION_MODE", "totp")
+    monkeypatch.setattr(session_tokens, "SESSION_TOKEN_SECRET", "test-secret")
+    monkeypatch.setattr(session_tokens, "SESSION_TTL_SECONDS", 60)
+
+
+def test_token_valid_for_current_and_previous_window_only():
+    now = 1_700_000_030.0
+    window = session_tokens.window_at(now)
+    secret = session_tokens.machine_secret("M001")
+    token = session_tokens.derive_token(secret, "M001", window)
+
+    assert len(token) == session_tokens.ROTATING_TOKEN_LENGTH
+    assert token == session_tokens.current_token("M001", now)["token"]
+    assert session_tokens.match_window("M001", token, now) == window
+    assert session_tokens.match_window("M001", token, now + 60) == window
+    assert session_tokens.match_window("M001", token, now + 120) is None
+    # Bound to the machine
+    assert session_tokens.match_window("M002", token, now) is None
+
+
+def test_claim_materializes_row_only_for_valid_derived_token(monkeypatch):
+    rows = {}
+    created = []
+
+    async def fake_get_session_by_token(token):
+        return rows.get(token)
+
+    async def fake_create_session(machine_id, ttl_seconds=60, token=None):
+        created.append(token)
+        row = {"id": "s1", "session_token": token, "machine_id": machine_id, "status": "active"}
+        rows[token] = row
+        return row
+
+    async def fake_log_event(**kwargs):
+        pass
+
+    monkeypatch.setattr(session_db, "get_session_by_token", fake_get_session_by_token)
+    monkeypatch.setattr(session_db, "create_session", fake_create_session)
+    monkeypatch.setattr(session_db, "log_event", fake_log_event)
+
+    token = session_tokens.current_token("M001")["token"]
+
+    row = asyncio.run(session_db._materialize_rotating_session(token, "M001"))
+    assert row["session_token"] == token
+    # Re-scan of a token that already has a row: the normal claim path handles it
+    assert asyncio.run(session_db._materialize_rotating_session(token, "M001")) is None
+    # Forged token: nothing written
+    assert asyncio.run(session_db._materialize_rotating_session("AAAAAA", "M001")) is None
+    assert created == [token]
+
+
+def test_machine_busy_reports_already_claimed(monkeypatch):
+    async def fake_get_session_by_token(token):
+        return None
+
+    async def fake_create_session(machine_id, ttl_seconds=60, token=None):
+        return None  # Partial unique index: another live session
+
+    monkeypatch.setattr(session_db, "get_session_by_token", fake_get_session_by_token)
+    monkeypatch.setattr(session_db, "create_session", fake_create_session)
+
+    token = session_tokens.current_token("M001")["token"]
+    result = asyncio.run(session_db._materialize_rotating_session(token, "M001"))
+    assert result == {"error": "already_claimed"}
+
+
+def test_next_idle_session_skips_tokens_used_earlier_in_the_window(monkeypatch):
+    from simulation import InMemorySupabase
+
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+    first = session_tokens.current_token("M001")["token"]
+    store.table("sessions").insert({
+        "id": "s1", "session_token": first, "machine_id": "M001", "status": "completed",
+    }).execute()
+
+    session = asyncio.run(session_db.next_idle_session("M001"))
+
+    assert session["rotating"] and session["session_token"] != first
+    assert session["session_token"] == session_tokens.current_token("M001", seq=1)["token"]
+    assert session_tokens.match_window("M001", session["session_token"]) is not None
+
+
+def test_rotation_secret_only_in_frames_for_verified_sockets():
+    import main as main_module
+
+    session = session_db.rotating_session("M001")
+    assert "rotation" not in main_module._session_frame("session", "M001", session)
+    frame = main_module._session_frame("session", "M001", session, rotation=True)
+    assert frame["rotation"]["secret"] == session_tokens.machine_secret("M001").hex()
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import session_db
+import signed_tokens
+
+
+@pytest.fixture(autouse=True)
+def signed_format(monkeypatch):
+    monkeypatch.setattr(signed_tokens, "SESSION_TOKEN_FORMAT", "signed")
+    monkeypatch.setattr(signed_tokens, "SESSION_TOKEN_SECRET", "test-secret")
+    monkeypatch.setattr(signed_tokens, "_slots", {})
+
+
+def test_token_verifies_until_too_old_and_resolves_machine():
+    now = 1_700_000_030.0
+    token = signed_tokens.issue("M001", now)
+
+    assert len(token) == signed_tokens.TOKEN_LENGTH
+    assert signed_tokens.verify(token, 600, now)["slot"] == signed_tokens.machine_slot("M001")
+    assert signed_tokens.verify(token, 600, now + 600) is not None
+    assert signed_tokens.verify(token, 600, now + 900) is None
+    assert signed_tokens.machine_for(token) == "M001"
+
+    # Any single-character change breaks the MAC
+    i = 5
+    forged = token[:i] + ("a" if token[i] != "a" else "b") + token[i + 1:]
+    assert signed_tokens.verify(forged, 600, now) is None
+    assert signed_tokens.verify("Ab3d", 600, now) is None
+
+
+def test_bogus_tokens_rejected_without_database(monkeypatch):
+    lookups = []
+
+    async def fake_get_session_by_token(token):
+        lookups.append(token)
+        return {"session_token": token, "machine_id": "M001", "status": "active"}
+
+    monkeypatch.setattr(session_db.db, "supabase", object())
+    monkeypatch.setattr(session_db, "get_session_by_token", fake_get_session_by_token)
+
+    assert asyncio.run(session_db.claim_session("Ab3d", "c1")) == {"error": "expired_or_invalid"}
+    assert asyncio.run(session_db.get_session_status("A" * 13)) == {"error": "session_not_found"}
+    assert lookups == []
+
+    token = signed_tokens.issue("M001")
+    assert asyncio.run(session_db.get_session_status(token))["status"] == "active"
+    assert lookups == [token]
@@ -0,0 +1,28 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import session_db
+from simulation import InMemorySupabase
+
+
+def test_speculative_order_adopted_once_and_leftovers_discarded(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+
+    async def run():
+        await session_db.create_order_record("order_spec1", "s1", "M001", "c1", 1, 100, speculative=True)
+        await session_db.create_order_record("order_spec2", "s1", "M001", "c1", 2, 200, speculative=True)
+        await session_db.create_order_record("order_paid", "s1", "M001", "c1", 3, 300)
+
+        assert await session_db.adopt_speculative_order("s1", 3) is None  # not speculative
+        adopted = await session_db.adopt_speculative_order("s1", 1)
+        again = await session_db.adopt_speculative_order("s1", 1)
+        discarded = await session_db.discard_speculative_orders("s1")
+        return adopted, again, discarded
+
+    adopted, again, discarded = asyncio.run(run())
+    assert adopted["order_id"] == "order_spec1" and again is None
+    assert discarded == 1
+    assert sorted(o["order_id"] for o in store.rows("orders")) == ["order_paid", "order_spec1"]
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import sweeper_partition
+from sweeper_partition import HashRing
+
+
+class FakeRedis:
+    """Sorted-set subset of redis.asyncio used by sweeper_partition."""
+
+    def __init__(self):
+        self.zsets = {}
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def _zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def _zremrangebyscore(self, key, lo, hi):
+        z = self.zsets.get(key, {})
+        for member in [m for m, score in z.items() if score <= hi]:
+            del z[member]
+
+    def _zrange(self, key, start, stop):
+        return sorted(self.zsets.get(key, {}), key=lambda m: self.zsets[key][m])
+
+    async def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+
+class _Pipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args: self.ops.append((name, args))
+
+    async def execute(self):
+        return [getattr(self.redis, f"_{name}")(*args) for name, args in self.ops]
+
+
+def test_ring_moves_only_a_fraction_of_machines_on_join():
+    machines = [f"M{i:04d}" for i in range(2000)]
+    before = HashRing(["w1", "w2", "w3"])
+    after = HashRing(["w1", "w2", "w3", "w4"])
+
+    moved = [m for m in machines if before.owner(m) != after.owner(m)]
+    assert all(after.owner(m) == "w4" for m in moved)
+    assert 0.15 < len(moved) / len(machines) < 0.35
+
+
+def test_heartbeat_prunes_dead_leases_and_partitions(monkeypatch):
+    redis = FakeRedis()
+    redis.zsets[sweeper_partition.MEMBERS_KEY] = {
+        "other:1": time.time() + 60,
+        "dead:2": time.time() - 1,
+    }
+    monkeypatch.setattr(sweeper_partition, "_ring", None)
+
+    ring = asyncio.run(sweeper_partition.heartbeat(redis))
+    assert ring.members == tuple(sorted(["other:1", sweeper_partition.MEMBER_ID]))
+
+    machines = [f"M{i:03d}" for i in range(200)]
+    mine = [m for m in machines if sweeper_partition.owns(m)]
+    assert 0 < len(mine) < len(machines)
+    assert all(ring.owner(m) == "other:1" for m in machines if m not in mine)
+
+    # Leaving hands everything back to the remaining worker; this worker
+    # falls back to sweeping all machines until it rejoins
+    asyncio.run(sweeper_partition.leave(redis))
+    assert sweeper_partition.MEMBER_ID not in redis.zsets[sweeper_partition.MEMBERS_KEY]
+    assert all(sweeper_partition.owns(m) for m in machines)
@@ -0,0 +1,34 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from ttl_policy import TtlPolicy
+
+DAY = 86400
+T0 = 1_700_000_000 - (1_700_000_000 % DAY)  # Midnight UTC
+
+
+def test_idle_machine_gets_max_and_busy_machine_gets_min():
+    policy = TtlPolicy(base=60, min_ttl=30, max_ttl=300, enabled=True)
+    now = T0 + 12 * 3600
+
+    for i in range(120):  # Two scans a minute for the last hour
+        policy.record("busy", now - 3600 + i * 30)
+
+    assert policy.ttl_for("idle", now) == 300
+    assert policy.ttl_for("busy", now) == 30
+    assert 30 < policy.ttl_for("busy", now + 3 * 3600) <= 300  # Cools off once traffic stops
+
+
+def test_usual_rush_hour_tightens_ttl_before_first_scan():
+    policy = TtlPolicy(base=60, min_ttl=30, max_ttl=300, enabled=True)
+    for day in range(7):  # 30 scans between 18:00 and 19:00 every evening
+        for i in range(30):
+            policy.record("m1", T0 + day * DAY + 18 * 3600 + i * 120)
+
+    today = T0 + 7 * DAY
+    assert policy.ttl_for("m1", today + 18 * 3600 + 60) < policy.ttl_for("m1", today + 3 * 3600)
+
+
+def test_disabled_policy_uses_base_ttl():
+    policy = TtlPolicy(base=60, min_ttl=30, max_ttl=300, enabled=False)
+    assert policy.ttl_for("m1", T0) == 60
@@ -0,0 +1,77 @@
+import asyncio
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import clock
+import metrics
+import session_db
+from simulation import InMemorySupabase
+from webhook_queue import WebhookQueue
+
+
+def _event(order_id):
+    return {"event": "payment.captured", "payload": {"payment": {"entity": {"order_id": order_id}}}}
+
+
+async def _persist(queue, event_id, order_id):
+    recorded = await session_db.record_webhook_event(event_id, "payment.captured", order_id, _event(order_id))
+    if recorded:
+        queue.submit({
+            "event_id": event_id, "order_id": order_id, "payload": _event(order_id),
+            "status": "pending", "attempts": 0, "received_at": clock.now().isoformat(),
+        })
+    return recorded
+
+
+def test_duplicate_event_ids_are_processed_once(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+    metrics.reset()
+    handled = []
+
+    async def handler(event):
+        order_id = event["payload"]["payment"]["entity"]["order_id"]
+        await asyncio.sleep(0)
+        handled.append(order_id)
+
+    async def run():
+        queue = WebhookQueue()
+        queue.start(handler, workers=2, queue_size=10, recovery_seconds=0)
+        results = [
+            await _persist(queue, "evt_1", "order_a"),
+            await _persist(queue, "evt_1", "order_a"),  # Razorpay redelivery
+            await _persist(queue, "evt_2", "order_b"),
+            await _persist(queue, "evt_3", "order_a"),
+        ]
+        await queue.drain()
+        await queue.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert results == [True, False, True, True]
+    assert sorted(handled) == ["order_a", "order_a", "order_b"]
+    assert {r["event_id"]: r["status"] for r in store.rows("webhook_events")} == {
+        "evt_1": "processed", "evt_2": "processed", "evt_3": "processed",
+    }
+    assert metrics.get("webhook_events", outcome="processed") == 3
+
+
+def test_failed_handler_marks_event_failed(monkeypatch):
+    store = InMemorySupabase()
+    monkeypatch.setattr(session_db.db, "supabase", store)
+
+    async def handler(event):
+        raise RuntimeError("razorpay down")
+
+    async def run():
+        queue = WebhookQueue()
+        queue.start(handler, workers=1, queue_size=10, recovery_seconds=0)
+        await _persist(queue, "evt_9", "order_z")
+        await queue.drain()
+        await queue.stop()
+
+    asyncio.run(run())
+    row = store.rows("webhook_events")[0]
+    assert row["status"] == "failed" and row["attempts"] == 1
+    assert "razorpay down" in row["error"]
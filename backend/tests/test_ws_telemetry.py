@@ -0,0 +1,66 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+import database as db
+import main as main_module
+import session_db
+from main import app
+
+
+@pytest.fixture
+def last_seen_calls(monkeypatch):
+    calls = []
+
+    async def fake_register_machine_session(machine_id, api_key):
+        return {"session_token": "abcd", "url": "https://x/vend/M001/abcd", "expires_at": "z"}
+
+    async def fake_set_machine_last_seen(machine_id):
+        calls.append(machine_id)
+
+    async def fake_update_machine_status(machine_id, status):
+        return None
+
+    monkeypatch.setattr(db, "pool", True)
+    monkeypatch.setattr(session_db, "register_machine_session", fake_register_machine_session)
+    monkeypatch.setattr(db, "set_machine_last_seen", fake_set_machine_last_seen)
+    monkeypatch.setattr(db, "update_machine_status", fake_update_machine_status)
+    return calls
+
+
+def _ingested(monkeypatch):
+    seen = []
+    original = main_module._ingest_telemetry
+
+    async def spy(payload):
+        seen.append(payload)
+        await original(payload)
+
+    monkeypatch.setattr(main_module, "_ingest_telemetry", spy)
+    return seen
+
+
+def test_ws_telemetry_frame_is_validated_and_ingested(monkeypatch, last_seen_calls):
+    seen = _ingested(monkeypatch)
+    client = TestClient(app)
+    with client.websocket_connect("/ws") as ws:
+        ws.send_text(json.dumps({"type": "register", "machine_id": "M001", "api_key": "k"}))
+        assert json.loads(ws.receive_text())["type"] == "session"
+
+        ws.send_text(json.dumps({"type": "telemetry", "rssi": -61, "battery": 87.5}))
+        # Out-of-range rssi fails TelemetryPayload validation and is dropped
+        ws.send_text(json.dumps({"type": "telemetry", "rssi": 20}))
+        # Piggybacked on pong
+        ws.send_text(json.dumps({"type": "pong", "telemetry": {"status": "idle"}}))
+        # device_id naming another machine is rejected
+        ws.send_text(json.dumps({"type": "telemetry", "device_id": "M999"}))
+        ws.close()
+
+    assert [p.rssi for p in seen] == [-61, None]
+    assert all(p.device_id == "M001" for p in seen)
+    assert seen[1].status == "idle"
+    assert last_seen_calls == ["M001", "M001"]
@@ -0,0 +1,131 @@
+"""
+SmartVend v3.0 — Adaptive Session TTL
+=====================================
+Per-machine QR rotation interval from recent activity and time of day.
+
+A single global TTL rotates every machine's QR every 60s, whether it sells
+200 units an hour or none at 3 a.m. This module tracks scans and claims per
+machine and scales the TTL inversely with the square root of the activity
+rate:
+
+    ttl = SESSION_TTL_SECONDS * sqrt(REFERENCE_RATE_PER_HOUR / rate)
+
+It is clamped to [SESSION_TTL_MIN_SECONDS, SESSION_TTL_MAX_SECONDS], and a
+machine with no activity gets the maximum. `rate` is the higher of the
+last-hour rate and the machine's usual rate for this hour of the day, which
+is learned over about a week. A machine about to enter its evening rush
+therefore tightens before the first scan arrives.
+
+Activity is tracked per worker process. Each worker sees a sample of the
+traffic, which is enough to rank machines as busy or idle.
+"""
+
+import math
+from typing import Dict, List, Optional
+
+import clock
+import metrics
+from config import (
+    SESSION_TTL_ADAPTIVE,
+    SESSION_TTL_MAX_SECONDS,
+    SESSION_TTL_MIN_SECONDS,
+    SESSION_TTL_SECONDS,
+)
+
+RECENT_HALF_LIFE_SECONDS = 3600          # recent activity fades over ~an hour
+PROFILE_HALF_LIFE_SECONDS = 7 * 86400    # hour-of-day profile fades over ~a week
+REFERENCE_RATE_PER_HOUR = 12.0           # activity at which SESSION_TTL_SECONDS applies
+
+_LN2 = math.log(2)
+# Fraction of an hour-of-day bucket left after one day of decay
+_PROFILE_DAILY_DECAY = 0.5 ** (86400 / PROFILE_HALF_LIFE_SECONDS)
+
+
+def _decay(value: float, since: float, now: float, half_life: float) -> float:
+    if not value:
+        return 0.0
+    return value * 0.5 ** (max(0.0, now - since) / half_life)
+
+
+def _hour_of_day(ts: float) -> int:
+    return int(ts // 3600) % 24  # UTC; only needs to be consistent
+
+
+class _Activity:
+    __slots__ = ("recent", "recent_at", "profile", "profile_at")
+
+    def __init__(self):
+        self.recent = 0.0
+        self.recent_at = 0.0
+        self.profile: List[float] = [0.0] * 24
+        self.profile_at: List[float] = [0.0] * 24
+
+
+class TtlPolicy:
+    """Decayed activity counters per machine → rotation TTL."""
+
+    def __init__(
+        self,
+        base: int = SESSION_TTL_SECONDS,
+        min_ttl: int = SESSION_TTL_MIN_SECONDS,
+        max_ttl: int = SESSION_TTL_MAX_SECONDS,
+        enabled: bool = SESSION_TTL_ADAPTIVE,
+    ):
+        self.base = base
+        self.min_ttl = min(min_ttl, base)
+        self.max_ttl = max(max_ttl, base)
+        self.enabled = enabled
+        self._machines: Dict[str, _Activity] = {}
+
+    def record(self, machine_id: str, now: Optional[float] = None):
+        """Count a scan or claim for machine_id."""
+        now = clock.time() if now is None else now
+        a = self._machines.get(machine_id)
+        if a is None:
+            a = self._machines[machine_id] = _Activity()
+        a.recent = _decay(a.recent, a.recent_at, now, RECENT_HALF_LIFE_SECONDS) + 1
+        a.recent_at = now
+        h = _hour_of_day(now)
+        a.profile[h] = _decay(a.profile[h], a.profile_at[h], now, PROFILE_HALF_LIFE_SECONDS) + 1
+        a.profile_at[h] = now
+
+    def rate_per_hour(self, machine_id: str, now: Optional[float] = None) -> float:
+        a = self._machines.get(machine_id)
+        if a is None:
+            return 0.0
+        now = clock.time() if now is None else now
+        # A decayed counter settles at rate × half_life / ln 2
+        recent = _decay(a.recent, a.recent_at, now, RECENT_HALF_LIFE_SECONDS)
+        recent_rate = recent * _LN2 / RECENT_HALF_LIFE_SECONDS * 3600
+        # One hour-long bucket per day, decayed daily: settles at rate / (1 - daily decay)
+        h = _hour_of_day(now)
+        usual = _decay(a.profile[h], a.profile_at[h], now, PROFILE_HALF_LIFE_SECONDS)
+        usual_rate = usual * (1 - _PROFILE_DAILY_DECAY)
+        return max(recent_rate, usual_rate)
+
+    def ttl_for(self, machine_id: str, now: Optional[float] = None) -> int:
+        if not self.enabled:
+            return self.base
+        rate = self.rate_per_hour(machine_id, now)
+        if rate <= 0:
+            return self.max_ttl
+        ttl = self.base * math.sqrt(REFERENCE_RATE_PER_HOUR / rate)
+        return int(min(self.max_ttl, max(self.min_ttl, ttl)))
+
+
+# ──────────────────────────────────────────────
+#  Module-level policy (one per worker process)
+# ──────────────────────────────────────────────
+
+policy = TtlPolicy()
+
+
+def record_activity(machine_id: Optional[str]):
+    if machine_id:
+        policy.record(machine_id)
+
+
+def ttl_for(machine_id: str) -> int:
+    ttl = policy.ttl_for(machine_id)
+    metrics.observe("session_ttl_seconds", ttl)
+    return ttl
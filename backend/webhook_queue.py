@@ -0,0 +1,177 @@
+"""
+SmartVend v3.0 — Webhook Event Queue
+====================================
+Processes persisted Razorpay webhook events off the request path.
+
+`/api/razorpay-webhook` used to reconcile a payment inline (order lookup,
+session lookup, trigger-dispense, command delivery) before answering, so a
+slow database made Razorpay time out and redeliver into the same work. The
+endpoint now verifies the signature, inserts the raw event into
+`webhook_events` (primary key: event_id, so a redelivery is a no-op) and
+answers 200. It then hands the event to this queue.
+
+Each of WEBHOOK_WORKERS workers owns a bounded FIFO. Events are routed by
+crc32(order_id), so the events of one order are handled one at a time, in
+arrival order, while different orders proceed in parallel. A worker claims
+the row (pending → processing) before handling it, so only one worker in the
+fleet handles each event. When the queue is full, or the worker restarts, the
+row stays pending. A recovery loop re-enqueues rows left pending or stuck in
+processing for longer than WEBHOOK_RECOVERY_SECONDS.
+"""
+
+import asyncio
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import clock
+import metrics
+import session_db
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+# Give up on an event after this many claims (it is marked failed)
+MAX_ATTEMPTS = 5
+
+
+def _parse_ts(value) -> float:
+    ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+class WebhookQueue:
+    """Per-order FIFO worker pool over the webhook_events table."""
+
+    def __init__(self):
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._recovery_task: Optional[asyncio.Task] = None
+        self._handler: Optional[Handler] = None
+        # event_ids sitting in a queue or being handled on this worker
+        self._inflight: Set[str] = set()
+        self._recovery_seconds = 30
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self, handler: Handler, workers: int = 4, queue_size: int = 1000,
+              recovery_seconds: int = 30):
+        """Start `workers` workers calling `handler(event)` for each claimed event."""
+        self._handler = handler
+        self._recovery_seconds = recovery_seconds
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._tasks = [asyncio.create_task(self._work(q)) for q in self._queues]
+        if recovery_seconds > 0:
+            self._recovery_task = asyncio.create_task(self._recover())
+
+    async def stop(self):
+        tasks = [t for t in [*self._tasks, self._recovery_task] if t and not t.done()]
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except BaseException:
+                pass
+        self._tasks = []
+        self._queues = []
+        self._recovery_task = None
+        self._inflight.clear()
+
+    async def drain(self):
+        """Wait until every queued event has been handled (tests, shutdown)."""
+        for q in self._queues:
+            await q.join()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    # ── Feeding ──
+
+    def submit(self, row: Dict) -> bool:
+        """Queue a persisted event row. False if not queued (the recovery
+        loop will pick the row up later)."""
+        if not self._queues:
+            return False
+        event_id = row["event_id"]
+        if event_id in self._inflight:
+            return True
+        q = self._queues[zlib.crc32((row.get("order_id") or event_id).encode("utf-8")) % len(self._queues)]
+        try:
+            q.put_nowait(row)
+        except asyncio.QueueFull:
+            metrics.incr("webhook_queue_full")
+            return False
+        self._inflight.add(event_id)
+        return True
+
+    # ── Workers ──
+
+    async def _work(self, q: asyncio.Queue):
+        while True:
+            row = await q.get()
+            try:
+                await self._handle(row)
+            except Exception as e:
+                print(f"❌ Webhook worker error for {row.get('event_id')}: {e}")
+            finally:
+                self._inflight.discard(row["event_id"])
+                q.task_done()
+
+    async def _handle(self, row: Dict):
+        event_id = row["event_id"]
+        status = row.get("status") or "pending"
+        attempts = row.get("attempts") or 0
+        if row.get("received_at"):
+            metrics.observe("webhook_queue_lag_seconds", max(0.0, clock.time() - _parse_ts(row["received_at"])))
+
+        if attempts >= MAX_ATTEMPTS:
+            if await session_db.claim_webhook_event(event_id, status, attempts):
+                await session_db.finish_webhook_event(event_id, error="too many attempts")
+                metrics.incr("webhook_events", outcome="abandoned")
+            return
+
+        if not await session_db.claim_webhook_event(event_id, status, attempts):
+            # Another worker (here or on another process) took it first
+            metrics.incr("webhook_events", outcome="claimed_elsewhere")
+            return
+
+        try:
+            await self._handler(row.get("payload") or {})
+        except Exception as e:
+            print(f"❌ WEBHOOK: event {event_id} failed: {e}")
+            await session_db.finish_webhook_event(event_id, error=str(e))
+            metrics.incr("webhook_events", outcome="failed")
+            return
+        await session_db.finish_webhook_event(event_id)
+        metrics.incr("webhook_events", outcome="processed")
+
+    async def _recover(self):
+        while True:
+            await clock.sleep(self._recovery_seconds)
+            try:
+                await self.recover_once()
+            except Exception as e:
+                print(f"Webhook recovery error: {e}")
+
+    async def recover_once(self) -> int:
+        """Re-enqueue rows left pending or processing too long. Returns how many."""
+        cutoff = (clock.now() - timedelta(seconds=self._recovery_seconds)).isoformat()
+        queued = 0
+        for status in ("pending", "processing"):
+            for row in await session_db.open_webhook_events(status, cutoff):
+                if row["event_id"] not in self._inflight and self.submit(row):
+                    queued += 1
+        if queued:
+            metrics.incr("webhook_events_recovered", queued)
+        return queued
+
+
+# ──────────────────────────────────────────────
+#  Module-level queue (one per worker process)
+# ──────────────────────────────────────────────
+
+queue = WebhookQueue()
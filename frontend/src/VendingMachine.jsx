@@ -10,6 +10,7 @@ const RAZORPAY_KEY_ID = import.meta.env.VITE_RAZORPAY_KEY_ID;
 export default function VendingMachine({ machine, onBack }) {
   const [availablePads, setAvailablePads] = useState(machine.current_stock);
   const [selectedPads, setSelectedPads] = useState(1);
+  const [pricePerUnit, setPricePerUnit] = useState(PRICE_PER_UNIT);
   const [accessCodeInput, setAccessCodeInput] = useState("");
   const [locked, setLocked] = useState(false);
   const [lockedUntil, setLockedUntil] = useState(null);
@@ -158,15 +159,19 @@ export default function VendingMachine({ machine, onBack }) {
   }, [showPopup]);
 
   // on mount, check whether this client already holds a lock for this machine
+  // (bootstrap: machine status, lock, stock and price in one request)
   useEffect(() => {
     let mounted = true;
     (async () => {
       try {
         const res = await fetch(
-          `${BACKEND_URL}/api/machine/${machine.machine_id}/public-status?client_id=${encodeURIComponent(clientId)}`,
+          `${BACKEND_URL}/api/session/bootstrap?machine_id=${encodeURIComponent(machine.machine_id)}&client_id=${encodeURIComponent(clientId)}`,
         );
         if (!mounted || !res.ok) return;
-        const s = await res.json();
+        const boot = await res.json();
+        const s = boot.machine;
+        if (typeof s.current_stock === "number") setAvailablePads(s.current_stock);
+        if (boot.unit_price_paise) setPricePerUnit(boot.unit_price_paise / 100);
 
         // Check if machine is offline
         if (s.status === 'offline' || s.status === 'Unavailable') {
@@ -545,7 +550,7 @@ export default function VendingMachine({ machine, onBack }) {
           <div className="flex justify-between items-center mb-6">
             <p className="text-lg text-gray-600">Total Price:</p>
             <p className="text-2xl font-bold text-purple-700">
-              ₹{selectedPads * PRICE_PER_UNIT}
+              ₹{selectedPads * pricePerUnit}
             </p>
           </div>
           <div className="flex flex-col space-y-4">
@@ -11,10 +11,14 @@
  *   5. Show success → feedback → redirect
  *
  * Handles:
- *   - Auto-resume on reload (GET /api/session/status)
+ *   - Auto-resume on reload (GET /api/session/bootstrap: session, stock, price)
  *   - Expired QR → show "scan new QR" message
  *   - Already claimed → show error
  *   - Session cancel on leave (POST /api/session/cancel)
+ *   - Expiry / completion / dispense failure pushed live (SSE /api/session/events)
+ *   - Arriving from the /s/{token} landing page: session, stock and price
+ *     (and the claim, if done there) come in the URL fragment (#sv=...), so
+ *     the page starts without any API calls
  */
 
 import { useState, useEffect, useRef, useCallback } from "react";
@@ -27,6 +31,21 @@ const BACKEND_URL = import.meta.env.VITE_BACKEND_URL;
 const PRICE_PER_UNIT = Number(import.meta.env.VITE_PRICE_PER_UNIT || 1);
 const RAZORPAY_KEY_ID = import.meta.env.VITE_RAZORPAY_KEY_ID;
 
+// State inlined by the backend's /s/{token} landing page (#sv=<base64url JSON>)
+function readLandingState() {
+  try {
+    const match = window.location.hash.match(/(?:^#|&)sv=([^&]+)/);
+    if (!match) return null;
+    const b64 = match[1].replace(/-/g, "+").replace(/_/g, "/");
+    const bytes = Uint8Array.from(atob(b64), (c) => c.charCodeAt(0));
+    const state = JSON.parse(new TextDecoder().decode(bytes));
+    window.history.replaceState(null, "", window.location.pathname + window.location.search);
+    return state;
+  } catch {
+    return null;
+  }
+}
+
 // Session phases for rendering
 const PHASE = {
   LOADING: "loading",
@@ -47,10 +66,17 @@ export default function VendingSession() {
   const [phase, setPhase] = useState(PHASE.LOADING);
   const [errorMessage, setErrorMessage] = useState("");
   const [machine, setMachine] = useState(null);
+  const [landing] = useState(readLandingState);
+  const [pricePerUnit, setPricePerUnit] = useState(PRICE_PER_UNIT);
 
   // User identity (persisted in localStorage)
   const [clientId] = useState(() => {
     try {
+      // The landing page may have claimed under its own client id; adopt it
+      if (landing?.client_id) {
+        localStorage.setItem("sv_client_id", landing.client_id);
+        return landing.client_id;
+      }
       let id = localStorage.getItem("sv_client_id");
       if (!id) {
         id = crypto.randomUUID ? crypto.randomUUID() : "client-" + Date.now();
@@ -62,7 +88,10 @@ export default function VendingSession() {
     }
   });
   const [userName, setUserName] = useState(() => {
-    try { return localStorage.getItem("sv_user_name") || ""; } catch { return ""; }
+    try {
+      if (landing?.claim?.name) localStorage.setItem("sv_user_name", landing.claim.name);
+      return localStorage.getItem("sv_user_name") || "";
+    } catch { return ""; }
   });
 
   // Product selection
@@ -85,6 +114,18 @@ export default function VendingSession() {
   // Name entry state
   const [nameSubmitted, setNameSubmitted] = useState(false);
 
+  // Signed claim ticket: lets create-order / cancel skip the ownership lookup
+  const ticketKey = `sv_ticket:${sessionToken}`;
+  const ticketRef = useRef(null);
+  if (ticketRef.current === null) {
+    try {
+      ticketRef.current = landing?.claim?.ticket || sessionStorage.getItem(ticketKey) || "";
+      if (landing?.claim?.ticket) sessionStorage.setItem(ticketKey, landing.claim.ticket);
+    } catch {
+      ticketRef.current = "";
+    }
+  }
+
   // ── Helpers ──
 
   const formatSeconds = (s) => {
@@ -135,10 +176,15 @@ export default function VendingSession() {
     try {
       const res = await fetch(`${BACKEND_URL}/api/session/claim`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: {
+          "Content-Type": "application/json",
+          // Same key on every retry of this claim: the backend replays its first answer
+          "Idempotency-Key": `claim:${sessionToken}:${clientId}`,
+        },
         body: JSON.stringify({
           session_token: sessionToken,
           client_id: clientId,
+          machine_id: machineId,
           name: claimName,
         }),
       });
@@ -161,6 +207,10 @@ export default function VendingSession() {
 
       // Success or already_claimed by same user
       localStorage.setItem("sv_user_name", claimName);
+      if (data.ticket) {
+        ticketRef.current = data.ticket;
+        try { sessionStorage.setItem(ticketKey, data.ticket); } catch { /* private mode */ }
+      }
       startCountdown(data.expires_at);
       setPhase(PHASE.CLAIMED);
       setNameSubmitted(true);
@@ -170,43 +220,50 @@ export default function VendingSession() {
       setPhase(PHASE.ERROR);
       setErrorMessage(err.message || "Failed to claim session.");
     }
-  }, [userName, sessionToken, clientId, startCountdown]);
+  }, [userName, sessionToken, clientId, machineId, startCountdown, ticketKey]);
 
   // ── Step 1: Check session status on load (resume on reload) ──
   useEffect(() => {
     let mounted = true;
 
-    async function init() {
-      try {
-        // First, get machine info
-        const machinesRes = await fetch(`${BACKEND_URL}/api/machines`);
-        if (machinesRes.ok) {
-          const machines = await machinesRes.json();
-          const m = machines.find(x => x.machine_id === machineId);
-          if (m && mounted) {
-            setMachine(m);
-            setAvailablePads(m.current_stock || 0);
-          }
+    async function loadStatus() {
+      if (landing?.session) {
+        if (landing.machine) {
+          setMachine(landing.machine);
+          setAvailablePads(landing.machine.current_stock || 0);
         }
+        if (landing.unit_price_paise) setPricePerUnit(landing.unit_price_paise / 100);
+        return landing.session;
+      }
 
-        // Check session status (handles resume on reload)
-        const statusRes = await fetch(
-          `${BACKEND_URL}/api/session/status?session_token=${encodeURIComponent(sessionToken)}&client_id=${encodeURIComponent(clientId)}`
-        );
+      // Session, ownership, stock and price in one request
+      const res = await fetch(
+        `${BACKEND_URL}/api/session/bootstrap?machine_id=${encodeURIComponent(machineId)}&session_token=${encodeURIComponent(sessionToken)}&client_id=${encodeURIComponent(clientId)}`
+      );
+      if (res.status === 404) return null;
+      if (!res.ok) throw new Error("Failed to check session status");
+      const boot = await res.json();
+      if (boot.machine && mounted) {
+        setMachine(boot.machine);
+        setAvailablePads(boot.machine.current_stock || 0);
+      }
+      if (boot.unit_price_paise) setPricePerUnit(boot.unit_price_paise / 100);
+      if (!boot.session || boot.session.error) return null;
+      return boot.session;
+    }
+
+    async function init() {
+      try {
+        const status = await loadStatus();
 
         if (!mounted) return;
 
-        if (!statusRes.ok) {
-          if (statusRes.status === 404) {
-            setPhase(PHASE.EXPIRED);
-            setErrorMessage("This QR code is no longer valid. Please scan the new QR on the machine.");
-            return;
-          }
-          throw new Error("Failed to check session status");
+        if (!status) {
+          setPhase(PHASE.EXPIRED);
+          setErrorMessage("This QR code is no longer valid. Please scan the new QR on the machine.");
+          return;
         }
 
-        const status = await statusRes.json();
-
         // Handle different statuses
         if (status.status === "expired" || status.expired_by_time) {
           setPhase(PHASE.EXPIRED);
@@ -219,8 +276,15 @@ export default function VendingSession() {
           return;
         }
 
-        if (status.status === "dispensing") {
-          // Resuming during dispense
+        if (status.status === "failed") {
+          // Dispense watchdog: the machine never confirmed this sale
+          setPhase(PHASE.ERROR);
+          setErrorMessage("The machine did not confirm your dispense. Your payment is flagged for review.");
+          return;
+        }
+
+        if (status.status === "dispensing" || status.status === "queued") {
+          // Resuming during dispense (queued: paid, waiting for the motor)
           setPhase(PHASE.DISPENSING);
           setIsDispensing(true);
           return;
@@ -271,7 +335,32 @@ export default function VendingSession() {
 
     init();
     return () => { mounted = false; };
-  }, [machineId, sessionToken, clientId, startCountdown, claimSession]);
+  }, [machineId, sessionToken, clientId, startCountdown, claimSession, landing]);
+
+  // ── Live session updates (SSE: /api/session/events) instead of polling ──
+  const live = phase === PHASE.CLAIMED || phase === PHASE.PAYING || phase === PHASE.DISPENSING;
+  useEffect(() => {
+    if (!live || typeof EventSource === "undefined") return;
+    const es = new EventSource(
+      `${BACKEND_URL}/api/session/events?session_token=${encodeURIComponent(sessionToken)}&client_id=${encodeURIComponent(clientId)}`
+    );
+    es.addEventListener("status", (e) => {
+      let event;
+      try { event = JSON.parse(e.data); } catch { return; }
+      const current = phaseRef.current;
+      if (event.status === "expired" && current === PHASE.CLAIMED) {
+        setPhase(PHASE.EXPIRED);
+        setErrorMessage("Your session expired. Please scan the new QR on the machine.");
+      } else if (event.status === "completed" && current === PHASE.DISPENSING) {
+        setIsDispensing(false);
+        setPhase(PHASE.COMPLETED);
+      } else if (event.status === "failed") {
+        setPhase(PHASE.ERROR);
+        setErrorMessage("The machine did not confirm your dispense. Your payment is flagged for review.");
+      }
+    });
+    return () => es.close();
+  }, [live, sessionToken, clientId]);
 
   // ── Step 3: Create order + Pay ──
   async function handlePayment() {
@@ -286,12 +375,16 @@ export default function VendingSession() {
       // Create order with session validation
       const orderRes = await fetch(`${BACKEND_URL}/create-order`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": `order:${sessionToken}:${clientId}:${selectedPads}`,
+        },
         body: JSON.stringify({
           quantity: selectedPads,
           machine_id: machineId,
           session_token: sessionToken,
           client_id: clientId,
+          ticket: ticketRef.current || undefined,
         }),
       });
 
@@ -320,7 +413,10 @@ export default function VendingSession() {
             // Backend verifies Razorpay signature before allowing dispense.
             const dispenseRes = await fetch(`${BACKEND_URL}/api/session/trigger-dispense`, {
               method: "POST",
-              headers: { "Content-Type": "application/json" },
+              headers: {
+                "Content-Type": "application/json",
+                "Idempotency-Key": `dispense:${response.razorpay_payment_id}`,
+              },
               body: JSON.stringify({
                 session_token: sessionToken,
                 client_id: clientId,
@@ -391,7 +487,7 @@ export default function VendingSession() {
         navigator.sendBeacon?.(
           `${BACKEND_URL}/api/session/cancel`,
           new Blob(
-            [JSON.stringify({ session_token: sessionToken, client_id: clientId })],
+            [JSON.stringify({ session_token: sessionToken, client_id: clientId, ticket: ticketRef.current || undefined })],
             { type: "application/json" }
           )
         );
@@ -623,7 +719,7 @@ export default function VendingSession() {
                   await fetch(`${BACKEND_URL}/api/session/cancel`, {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
-                    body: JSON.stringify({ session_token: sessionToken, client_id: clientId }),
+                    body: JSON.stringify({ session_token: sessionToken, client_id: clientId, ticket: ticketRef.current || undefined }),
                   });
                 } catch (err) {
                   console.debug("Session cancel on leave failed:", err);
@@ -676,7 +772,7 @@ export default function VendingSession() {
             <div className="flex justify-between items-center mb-6">
               <p className="text-lg text-gray-600">Total Price:</p>
               <p className="text-2xl font-bold text-purple-700">
-                ₹{selectedPads * PRICE_PER_UNIT}
+                ₹{selectedPads * pricePerUnit}
               </p>
             </div>
             <button
@@ -694,7 +790,7 @@ export default function VendingSession() {
                   <svg xmlns="http://www.w3.org/2000/svg" className="h-5 w-5" viewBox="0 0 20 20" fill="currentColor">
                     <path fillRule="evenodd" d="M5 9V7a5 5 0 0110 0v2a2 2 0 012 2v5a2 2 0 01-2 2H5a2 2 0 01-2-2v-5a2 2 0 012-2zm8-2v2H7V7a3 3 0 016 0z" clipRule="evenodd" />
                   </svg>
-                  <span>Pay ₹{selectedPads * PRICE_PER_UNIT}</span>
+                  <span>Pay ₹{selectedPads * pricePerUnit}</span>
                 </>
               )}
             </button>
@@ -0,0 +1,242 @@
+-- 002_session_procedures.sql
+-- Transactional session transitions, each callable in one round trip
+-- (session_db.py calls them via supabase.rpc()).
+--
+-- Every function returns the same JSON shape as its Python fallback in
+-- session_db.py: { "error": "<code>", ... } or { "status": "<code>", ... },
+-- so main.py's error → HTTP status mapping is unchanged.
+
+-- Audit helper (mirrors session_db.log_event)
+CREATE OR REPLACE FUNCTION sv_log_event(
+  p_machine_id TEXT,
+  p_session_id UUID,
+  p_event_type TEXT,
+  p_client_id TEXT,
+  p_payload JSONB
+) RETURNS VOID LANGUAGE sql AS $$
+  INSERT INTO events (machine_id, session_id, event_type, client_id, payload)
+  VALUES (p_machine_id, p_session_id, p_event_type, p_client_id, p_payload);
+$$;
+
+
+-- ACTIVE → IN_PROGRESS
+CREATE OR REPLACE FUNCTION sv_claim_session(
+  p_session_token TEXT,
+  p_client_id TEXT,
+  p_claim_ttl_seconds INTEGER
+) RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+  s sessions%ROWTYPE;
+BEGIN
+  SELECT * INTO s FROM sessions WHERE session_token = p_session_token FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('error', 'session_not_found');
+  END IF;
+
+  IF s.status = 'in_progress' THEN
+    IF s.claimed_by = p_client_id THEN
+      RETURN jsonb_build_object(
+        'status', 'already_claimed', 'session', to_jsonb(s), 'machine_id', s.machine_id
+      );
+    END IF;
+    RETURN jsonb_build_object('error', 'already_claimed');
+  END IF;
+
+  IF s.status IN ('completed', 'expired', 'dispensing')
+     OR (s.expires_at IS NOT NULL AND s.expires_at < now()) THEN
+    RETURN jsonb_build_object('error', 'expired_or_invalid');
+  END IF;
+
+  IF s.status <> 'active' THEN
+    RETURN jsonb_build_object('error', 'already_claimed');
+  END IF;
+
+  UPDATE sessions
+     SET status = 'in_progress',
+         claimed_by = p_client_id,
+         claimed_at = now(),
+         expires_at = now() + make_interval(secs => p_claim_ttl_seconds)
+   WHERE id = s.id
+  RETURNING * INTO s;
+
+  UPDATE machines SET status = 'in_use' WHERE machine_id = s.machine_id;
+  PERFORM sv_log_event(s.machine_id, s.id, 'session_claimed', p_client_id, NULL);
+
+  RETURN jsonb_build_object('status', 'claimed', 'session', to_jsonb(s), 'machine_id', s.machine_id);
+END;
+$$;
+
+
+-- IN_PROGRESS → DISPENSING (order checks, stock reservation, transaction row)
+CREATE OR REPLACE FUNCTION sv_trigger_dispense(
+  p_session_token TEXT,
+  p_client_id TEXT,
+  p_quantity INTEGER,
+  p_tx_id UUID,
+  p_transaction_id TEXT,
+  p_amount INTEGER,
+  p_order_id TEXT,
+  p_motor_timeout_seconds INTEGER
+) RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+  s sessions%ROWTYPE;
+  o orders%ROWTYPE;
+  remaining INTEGER;
+BEGIN
+  SELECT * INTO s FROM sessions WHERE session_token = p_session_token FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('error', 'session_not_found');
+  END IF;
+
+  IF s.status IN ('dispensing', 'completed') THEN
+    RETURN jsonb_build_object('error', 'already_processed', 'status', 'duplicate');
+  ELSIF s.status <> 'in_progress' THEN
+    RETURN jsonb_build_object('error', 'invalid_state', 'detail', format('Session is %s', s.status));
+  END IF;
+
+  IF s.claimed_by IS DISTINCT FROM p_client_id THEN
+    RETURN jsonb_build_object('error', 'not_owner');
+  END IF;
+
+  IF s.expires_at IS NOT NULL AND s.expires_at < now() THEN
+    RETURN jsonb_build_object('error', 'session_expired');
+  END IF;
+
+  IF p_order_id IS NOT NULL THEN
+    SELECT * INTO o FROM orders WHERE order_id = p_order_id;
+    IF NOT FOUND THEN
+      RETURN jsonb_build_object('error', 'order_not_found');
+    END IF;
+    IF o.session_id::TEXT IS DISTINCT FROM s.id::TEXT OR o.machine_id IS DISTINCT FROM s.machine_id THEN
+      RETURN jsonb_build_object(
+        'error', 'order_mismatch', 'detail', 'Order is not linked to this session or machine.'
+      );
+    END IF;
+    IF coalesce(o.client_id, '') <> '' AND o.client_id <> p_client_id THEN
+      RETURN jsonb_build_object(
+        'error', 'order_mismatch', 'detail', 'Order is not owned by this client.'
+      );
+    END IF;
+    IF coalesce(o.quantity, 0) > 0 AND p_quantity <> o.quantity THEN
+      RETURN jsonb_build_object(
+        'error', 'order_quantity_mismatch',
+        'detail', 'Requested quantity does not match paid order quantity.',
+        'expected_quantity', o.quantity
+      );
+    END IF;
+    IF coalesce(o.amount, 0) > 0 AND p_amount <> o.amount THEN
+      RETURN jsonb_build_object(
+        'error', 'order_amount_mismatch',
+        'detail', 'Requested amount does not match paid order amount.'
+      );
+    END IF;
+  END IF;
+
+  IF EXISTS (SELECT 1 FROM transactions WHERE id = p_tx_id) THEN
+    RETURN jsonb_build_object('error', 'already_processed', 'status', 'duplicate');
+  END IF;
+
+  -- Conditional decrement: reservation and check are one statement
+  UPDATE machines
+     SET current_stock = current_stock - p_quantity
+   WHERE machine_id = s.machine_id AND coalesce(current_stock, 0) >= p_quantity
+  RETURNING current_stock INTO remaining;
+  IF NOT FOUND THEN
+    SELECT coalesce(current_stock, 0) INTO remaining FROM machines WHERE machine_id = s.machine_id;
+    IF NOT FOUND THEN
+      RETURN jsonb_build_object('error', 'machine_not_found');
+    END IF;
+    RETURN jsonb_build_object('error', 'insufficient_stock', 'available', remaining);
+  END IF;
+
+  INSERT INTO transactions (id, machine_id, client_id, amount, quantity, payment_status, created_at)
+  VALUES (p_tx_id, s.machine_id, p_client_id, p_amount, p_quantity, 'paid', now());
+
+  UPDATE sessions
+     SET status = 'dispensing',
+         expires_at = now() + make_interval(secs => p_motor_timeout_seconds)
+   WHERE id = s.id;
+  UPDATE machines SET status = 'dispensing' WHERE machine_id = s.machine_id;
+  PERFORM sv_log_event(
+    s.machine_id, s.id, 'dispense_triggered', p_client_id,
+    jsonb_build_object('transaction_id', p_transaction_id, 'quantity', p_quantity)
+  );
+
+  RETURN jsonb_build_object(
+    'status', 'ok', 'session', to_jsonb(s), 'machine_id', s.machine_id,
+    'transaction_id', p_transaction_id
+  );
+EXCEPTION
+  WHEN unique_violation THEN
+    -- Lost the race to a concurrent trigger (frontend vs webhook); stock
+    -- decrement above is rolled back with the block.
+    RETURN jsonb_build_object('error', 'already_processed', 'status', 'duplicate');
+END;
+$$;
+
+
+-- DISPENSING → COMPLETED, plus the machine's next ACTIVE session.
+-- p_new_token is generated by session_db._generate_session_token() (NULL in
+-- totp rotation mode, see session_tokens.py).
+CREATE OR REPLACE FUNCTION sv_complete_session(
+  p_machine_id TEXT,
+  p_tx_id UUID,
+  p_transaction_id TEXT,
+  p_dispensed INTEGER,
+  p_new_token TEXT,
+  p_session_ttl_seconds INTEGER
+) RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+  s sessions%ROWTYPE;
+  n sessions%ROWTYPE;
+  remaining INTEGER;
+BEGIN
+  SELECT * INTO s FROM sessions
+   WHERE machine_id = p_machine_id AND status IN ('active', 'in_progress', 'dispensing')
+   ORDER BY created_at DESC
+   LIMIT 1
+   FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('error', 'no_active_session');
+  END IF;
+  IF s.status <> 'dispensing' THEN
+    RETURN jsonb_build_object('error', 'not_dispensing', 'detail', format('Session is %s', s.status));
+  END IF;
+
+  UPDATE transactions
+     SET dispensed = p_dispensed, payment_status = 'completed', completed_at = now()
+   WHERE id = p_tx_id;
+  UPDATE sessions SET status = 'completed', completed_at = now() WHERE id = s.id;
+
+  SELECT coalesce(current_stock, 0) INTO remaining FROM machines WHERE machine_id = p_machine_id;
+  remaining := coalesce(remaining, 0);
+  UPDATE machines
+     SET status = CASE WHEN remaining <= 0 THEN 'Unavailable' ELSE 'idle' END
+   WHERE machine_id = p_machine_id;
+
+  -- NULL token: totp rotation mode, no row until the next claim
+  IF p_new_token IS NOT NULL THEN
+    BEGIN
+      INSERT INTO sessions (session_token, machine_id, status, expires_at)
+      VALUES (p_new_token, p_machine_id, 'active', now() + make_interval(secs => p_session_ttl_seconds))
+      RETURNING * INTO n;
+    EXCEPTION WHEN unique_violation THEN
+      n := NULL;  -- same as create_session() returning None
+    END;
+  END IF;
+
+  PERFORM sv_log_event(
+    p_machine_id, s.id, 'session_completed', NULL,
+    jsonb_build_object(
+      'transaction_id', p_transaction_id, 'dispensed', p_dispensed, 'remaining_stock', remaining
+    )
+  );
+
+  RETURN jsonb_build_object(
+    'status', 'completed',
+    'new_session', CASE WHEN n.id IS NULL THEN NULL ELSE to_jsonb(n) END,
+    'low_stock', remaining <= 5,
+    'remaining_stock', remaining
+  );
+END;
+$$;
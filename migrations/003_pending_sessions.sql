@@ -0,0 +1,15 @@
+-- 003_pending_sessions.sql
+-- Pre-issued successor sessions (session_db.issue_successor).
+--
+-- While a machine shows session N, session N+1 already exists with
+-- status = 'pending' and starts_at = N.expires_at, so the device can swap
+-- its QR at expiry without a round trip. The row becomes 'active' when it is
+-- scanned or when N's expiry is processed. 'pending' is outside the partial
+-- unique index (active/in_progress/dispensing), so it never conflicts with N.
+-- If sessions.status has a CHECK constraint, add 'pending' to it.
+
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS starts_at TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_pending
+  ON sessions(machine_id, created_at DESC)
+  WHERE status = 'pending';
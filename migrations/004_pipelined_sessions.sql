@@ -0,0 +1,34 @@
+-- 004_pipelined_sessions.sql
+-- Pipelined sessions (SESSION_PIPELINE_ENABLED=true).
+--
+-- The single partial unique index over active/in_progress/dispensing is split
+-- in two: one customer-facing session (active/in_progress) and one motor
+-- session (dispensing) per machine. The next customer can scan and pay while
+-- the previous sale is still dispensing.
+--
+-- A paid sale that finds the motor busy is parked as 'queued', with its stock
+-- already reserved and its transaction written. The motor takes queued sales
+-- in queued_at order (session_db.start_next_dispense). dispense_transaction_id
+-- and dispense_quantity hold what the ESP32 dispense command needs.
+--
+-- Without the flag the code never creates a second live session while one is
+-- dispensing, so this index split changes nothing for non-pipelined
+-- deployments. If sessions.status has a CHECK constraint, add 'queued' to it.
+
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS dispense_transaction_id TEXT;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS dispense_quantity INTEGER;
+
+DROP INDEX IF EXISTS idx_sessions_active_machine;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_front_machine
+  ON sessions(machine_id)
+  WHERE status IN ('active', 'in_progress');
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_motor_machine
+  ON sessions(machine_id)
+  WHERE status = 'dispensing';
+
+CREATE INDEX IF NOT EXISTS idx_sessions_queued
+  ON sessions(machine_id, queued_at)
+  WHERE status = 'queued';
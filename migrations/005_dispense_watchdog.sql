@@ -0,0 +1,12 @@
+-- 005_dispense_watchdog.sql
+-- Dispensing watchdog (session_db.fail_dispense / fail_stale_dispenses).
+--
+-- A DISPENSING session's expires_at is the motor timeout set at trigger. If
+-- the ESP32 never confirms, the session moves to 'failed' and its
+-- transaction's payment_status to 'dispense_timeout'. If sessions.status has
+-- a CHECK constraint, add 'failed' to it.
+
+-- For the backstop sweep: stuck dispenses past their motor timeout
+CREATE INDEX IF NOT EXISTS idx_sessions_dispensing_expired
+  ON sessions(expires_at)
+  WHERE status = 'dispensing';
@@ -0,0 +1,32 @@
+-- 006_session_bootstrap.sql
+-- One-round-trip page load for /api/session/bootstrap
+-- (session_db.get_session_bootstrap).
+--
+-- p_machine_id may be NULL: the machine is then the session's own.
+-- Returns the raw session, machine and lock rows; session_db shapes them
+-- exactly like get_session_status and get_public_status. Without this
+-- function the backend runs the session and machine reads concurrently.
+
+CREATE OR REPLACE FUNCTION sv_session_bootstrap(
+  p_machine_id TEXT,
+  p_session_token TEXT
+) RETURNS JSONB LANGUAGE plpgsql STABLE AS $$
+DECLARE
+  v_session JSONB;
+  v_machine JSONB;
+  v_lock JSONB;
+  v_machine_id TEXT := p_machine_id;
+BEGIN
+  IF p_session_token IS NOT NULL THEN
+    SELECT to_jsonb(s) INTO v_session FROM sessions s WHERE s.session_token = p_session_token;
+    v_machine_id := COALESCE(v_machine_id, v_session->>'machine_id');
+  END IF;
+  SELECT to_jsonb(m) - 'api_key' - 'display_code' INTO v_machine
+    FROM machines m WHERE m.machine_id = v_machine_id;
+  SELECT to_jsonb(l) - 'access_code_hash' INTO v_lock
+    FROM locks l WHERE l.machine_id = v_machine_id;
+  RETURN jsonb_build_object(
+    'session', v_session, 'machine', v_machine, 'lock', v_lock, 'server_time', now()
+  );
+END;
+$$;
@@ -0,0 +1,14 @@
+-- 007_speculative_orders.sql
+-- Speculative Razorpay orders (SPECULATIVE_ORDERS_ENABLED=true).
+--
+-- Right after a claim the backend creates the order for the likeliest
+-- quantity and maps it with speculative = TRUE. /create-order for that
+-- quantity flips the flag (session_db.adopt_speculative_order) and returns
+-- it. Rows still speculative when the session expires, is cancelled or
+-- dispenses are deleted (session_db.discard_speculative_orders).
+
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS speculative BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_orders_speculative_session
+  ON orders(session_id)
+  WHERE speculative;
@@ -0,0 +1,27 @@
+-- 008_webhook_events.sql
+-- Fast-ack Razorpay webhook (webhook_queue.py).
+--
+-- /api/razorpay-webhook verifies the signature, inserts the raw event here
+-- and answers 200 at once. The primary key on event_id (Razorpay's
+-- X-Razorpay-Event-Id) turns redeliveries into a no-op insert. A worker
+-- claims a row (pending → processing) before it reconciles the payment and
+-- marks it processed or failed afterwards.
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+  event_id TEXT PRIMARY KEY,
+  event_type TEXT NOT NULL,
+  order_id TEXT,
+  payload JSONB NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',   -- pending | processing | processed | failed
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+  claimed_at TIMESTAMP WITH TIME ZONE,
+  processed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Recovery sweep: events left pending (queue full, worker restart) or
+-- stuck in processing
+CREATE INDEX IF NOT EXISTS idx_webhook_events_open
+  ON webhook_events(received_at)
+  WHERE status IN ('pending', 'processing');
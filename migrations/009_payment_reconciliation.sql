@@ -0,0 +1,33 @@
+-- 009_payment_reconciliation.sql
+-- Batch reconciliation of orders without a transaction (reconciliation.py).
+--
+-- A paid order normally ends in a transactions row whose id is
+-- uuid5(order_id). The job walks orders in (created_at, order_id) order,
+-- finds those without that row, asks Razorpay for their payments and stores
+-- one verdict per order. The cursor is saved after each batch so an
+-- interrupted run resumes where it stopped.
+
+CREATE TABLE IF NOT EXISTS payment_reconciliation (
+  order_id TEXT PRIMARY KEY,
+  session_id TEXT,
+  machine_id TEXT,
+  amount INTEGER,
+  classification TEXT NOT NULL,   -- dispense_pending | refund_needed | abandoned
+  payment_id TEXT,
+  payment_status TEXT,
+  checked_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_payment_reconciliation_classification
+  ON payment_reconciliation(classification, checked_at);
+
+CREATE TABLE IF NOT EXISTS reconciliation_checkpoints (
+  id TEXT PRIMARY KEY,            -- job name
+  cursor_created_at TIMESTAMP WITH TIME ZONE,
+  cursor_order_id TEXT,
+  updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+-- Keyset pagination over orders
+CREATE INDEX IF NOT EXISTS idx_orders_created_order
+  ON orders(created_at, order_id);
@@ -0,0 +1,97 @@
+-- 010_confirm_batch.sql
+-- Batched dispense confirmations for /api/machine/{id}/confirm-batch
+-- (session_db.confirm_batch).
+--
+-- A device back from an outage replays its pending confirmations in one
+-- call. p_items is a JSON array of {tx_id, transaction_id, dispensed}. In
+-- one transaction, each item marks its transaction completed and completes
+-- the machine's dispensing session. Transactions already completed are
+-- reported as duplicates, and ones not belonging to this machine as
+-- tx_not_found. Stock is read, the machine status is set and the next
+-- ACTIVE session is created once, after the last item, rather than once
+-- per confirmation.
+
+CREATE OR REPLACE FUNCTION sv_confirm_batch(
+  p_machine_id TEXT,
+  p_items JSONB,
+  p_new_token TEXT,
+  p_session_ttl_seconds INTEGER
+) RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+  item RECORD;
+  t transactions%ROWTYPE;
+  v_session_id UUID;
+  n sessions%ROWTYPE;
+  results JSONB := '[]'::jsonb;
+  completed INTEGER := 0;
+  remaining INTEGER;
+BEGIN
+  FOR item IN
+    SELECT * FROM jsonb_to_recordset(p_items) AS x(tx_id UUID, transaction_id TEXT, dispensed INTEGER)
+  LOOP
+    SELECT * INTO t FROM transactions
+     WHERE id = item.tx_id AND machine_id = p_machine_id
+     FOR UPDATE;
+    IF NOT FOUND THEN
+      results := results || jsonb_build_object('transaction_id', item.transaction_id, 'error', 'tx_not_found');
+      CONTINUE;
+    END IF;
+    IF t.payment_status = 'completed' THEN
+      results := results || jsonb_build_object('transaction_id', item.transaction_id, 'status', 'duplicate');
+      CONTINUE;
+    END IF;
+
+    UPDATE transactions
+       SET dispensed = item.dispensed, payment_status = 'completed', completed_at = now()
+     WHERE id = item.tx_id;
+
+    v_session_id := NULL;
+    SELECT id INTO v_session_id FROM sessions
+     WHERE machine_id = p_machine_id AND status = 'dispensing'
+     ORDER BY created_at DESC
+     LIMIT 1
+     FOR UPDATE;
+    IF v_session_id IS NOT NULL THEN
+      UPDATE sessions SET status = 'completed', completed_at = now() WHERE id = v_session_id;
+      PERFORM sv_log_event(
+        p_machine_id, v_session_id, 'session_completed', NULL,
+        jsonb_build_object('transaction_id', item.transaction_id, 'dispensed', item.dispensed, 'batch', true)
+      );
+    END IF;
+    completed := completed + 1;
+    results := results || jsonb_build_object(
+      'transaction_id', item.transaction_id, 'status', 'completed',
+      'session_id', v_session_id
+    );
+  END LOOP;
+
+  SELECT coalesce(current_stock, 0) INTO remaining FROM machines WHERE machine_id = p_machine_id;
+  remaining := coalesce(remaining, 0);
+
+  IF completed > 0 THEN
+    UPDATE machines
+       SET status = CASE WHEN remaining <= 0 THEN 'Unavailable' ELSE 'idle' END
+     WHERE machine_id = p_machine_id;
+
+    -- NULL token: totp rotation mode, no row until the next claim
+    IF p_new_token IS NOT NULL THEN
+      BEGIN
+        INSERT INTO sessions (session_token, machine_id, status, expires_at)
+        VALUES (p_new_token, p_machine_id, 'active', now() + make_interval(secs => p_session_ttl_seconds))
+        RETURNING * INTO n;
+      EXCEPTION WHEN unique_violation THEN
+        n := NULL;  -- a live session already exists
+      END;
+    END IF;
+  END IF;
+
+  RETURN jsonb_build_object(
+    'status', 'ok',
+    'results', results,
+    'completed', completed,
+    'new_session', CASE WHEN n.id IS NULL THEN NULL ELSE to_jsonb(n) END,
+    'low_stock', remaining <= 5,
+    'remaining_stock', remaining
+  );
+END;
+$$;